@@ -0,0 +1,86 @@
+"""Micro-benchmark: buildId extraction from homepage HTML.
+
+Compares the raw-bytes extractor (food_scraper.buildid.extract_build_id)
+with the selector path the spider used before (CSS/XPath selectors plus
+json.loads of the whole __NEXT_DATA__ document).
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_build_id.py [saved_homepage.html ...]
+
+Without arguments a synthetic ~0.5 MB homepage is used, once with the build
+manifest script in its <head> (found in the first HEAD_BYTES) and once
+without (the whole body is scanned for __NEXT_DATA__).
+"""
+import json
+import re
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scrapy.http import HtmlResponse  # noqa: E402
+
+from food_scraper.buildid import extract_build_id  # noqa: E402
+
+
+def synthetic_homepage(build_id='synthetic-build-id', products=2000, manifest=True):
+    """Build a homepage shaped like the real one: many scripts and a large __NEXT_DATA__."""
+    props = {'pageProps': {'products': [
+        {'name': f'Product {i}', 'slug': f'product-{i}', 'regularPrice': i / 10,
+         'description': 'lorem ipsum ' * 10}
+        for i in range(products)]}}
+    next_data = json.dumps({'props': props, 'page': '/', 'query': {},
+                            'buildId': build_id, 'isFallback': False})
+    scripts = ''.join(f'<script src="/_next/static/chunks/{i}.js"></script>' for i in range(40))
+    if manifest:
+        scripts = f'<script src="/_next/static/{build_id}/_buildManifest.js"></script>{scripts}'
+    return (
+        '<!DOCTYPE html><html><head>'
+        f'{scripts}'
+        '</head><body><div id="__next">' + '<div class="tile">x</div>' * 2000 + '</div>'
+        f'<script id="__NEXT_DATA__" type="application/json">{next_data}</script>'
+        '</body></html>'
+    ).encode('utf-8')
+
+
+def selector_build_id(body):
+    """The spider's previous extraction path."""
+    response = HtmlResponse(url='https://www.wholefoodsmarket.com/', body=body, encoding='utf-8')
+    next_data_text = response.css('script#__NEXT_DATA__::text').get()
+    if not next_data_text:
+        scripts = response.css('script').getall()
+        next_data_text = response.xpath('//script[@id="__NEXT_DATA__"]/text()').get()
+        if not next_data_text:
+            for script in scripts:
+                if "buildId" in script:
+                    match = re.search(r'({.*})', script)
+                    if match:
+                        next_data_text = match.group(1)
+                        break
+    if not next_data_text:
+        return None
+    return json.loads(next_data_text).get('buildId')
+
+
+def main():
+    fixtures = [(path, Path(path).read_bytes()) for path in sys.argv[1:]]
+    if not fixtures:
+        fixtures = [('synthetic', synthetic_homepage()),
+                    ('synthetic, no manifest', synthetic_homepage(manifest=False))]
+
+    for name, body in fixtures:
+        expected = selector_build_id(body)
+        assert extract_build_id(body) == expected, 'extractors disagree'
+        print(f'{name}: {len(body) / 1024:.0f} KiB, buildId={expected}')
+
+        for label, func in (('selector + json.loads', selector_build_id),
+                            ('extract_build_id', extract_build_id)):
+            runs = 20
+            seconds = min(timeit.repeat(lambda: func(body), number=runs, repeat=5)) / runs
+            print(f'  {label:<24} {seconds * 1000:8.3f} ms/page')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Throughput and memory benchmark: change detection.
+
+Diffs two runs of a synthetic catalog through the ChangeIndex
+(CHANGE_DETECTION_ENABLED). Between them, a share of products changes a
+field and some disappear from their listings. Reports items/s for both runs,
+the diff the second run produced, the size of the on-disk index, and the
+peak memory of the process, which stays flat as the catalog grows.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_change_detection.py [products] [churn]
+"""
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from food_scraper.changes import ChangeIndex  # noqa: E402
+
+STORE_COUNT = 20
+CATEGORIES = ['Produce', 'Dairy & Eggs', 'Meat', 'Frozen Foods', 'Beverages']
+# (store_id, category) listings every run requests
+LISTINGS = [(10200 + store, category) for store in range(STORE_COUNT) for category in CATEGORIES]
+NUTRIENTS = ['calories', 'totalFat', 'sodium', 'totalCarbohydrate', 'protein', 'totalSugars',
+             'dietaryFiber', 'cholesterol', 'calcium', 'iron', 'potassium', 'vitaminD']
+
+
+def synthetic_item(i, version=0):
+    """The i-th product of the catalog; version bumps change its price."""
+    product = i // STORE_COUNT
+    return {
+        'store_id': 10200 + i % STORE_COUNT, 'slug': f'organic-product-{product}',
+        'name': f'Organic Product {product}', 'price': round(1 + product % 2000 / 100 + version, 2),
+        'brand': f'Brand {product % 300}', 'asin': f'B0{product:08d}', 'rank': product % 500,
+        'is_available': True, 'category': CATEGORIES[product % len(CATEGORIES)],
+        'diets': ['Vegan', 'Organic'], 'ingredients': ['Organic apples', 'Water'],
+        'certifications': ['USDA Organic'],
+        'nutrition_elements': [{'key': key, 'name': key.title(), 'unit_of_measure': 'g',
+                                'amount_per_serving': (product + n) % 50 + 0.5, 'recommended_daily_value': n}
+                               for n, key in enumerate(NUTRIENTS)],
+        'serving_info': {'servingSize': 1, 'servingSizeUom': 'each'},
+        'related_products': [f'organic-product-{product + n}' for n in range(1, 9)],
+    }
+
+
+def run(index, items):
+    """Feed a run through the index, returning its diff counts and how long it took."""
+    counts = Counter()
+    start = time.perf_counter()
+    index.start()
+    for item in items:
+        for change, _, _ in index.add(item):
+            counts[change] += 1
+    for change, _, _ in index.flush():
+        counts[change] += 1
+    index.add_scope(LISTINGS)
+    counts['removed'] = sum(1 for _ in index.removed())
+    index.finish()
+    return counts, time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    churn = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    rng = random.Random(0)
+    changed = set(rng.sample(range(count), int(count * churn)))
+    removed = set(rng.sample(range(count), int(count * churn / 4))) - changed
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'change_index.sqlite3')
+        index = ChangeIndex(path)
+        first, first_time = run(index, (synthetic_item(i) for i in range(count)))
+        second, second_time = run(index, (
+            synthetic_item(i, version=int(i in changed)) for i in range(count) if i not in removed))
+        index.close()
+        size = sum(os.path.getsize(p) for p in (path, f'{path}-wal') if os.path.exists(p))
+
+    print(f'{count} products in {STORE_COUNT} stores')
+    print(f'  first run   {count / first_time:9.0f} items/s  {dict(first)}')
+    print(f'  second run  {(count - len(removed)) / second_time:9.0f} items/s  {dict(second)}')
+    print(f'  expected    changed {len(changed)}, removed {len(removed)}')
+    print(f'  index {size / 2 ** 20:.1f} MiB, peak RSS '
+          f'{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB')
+
+
+if __name__ == '__main__':
+    main()
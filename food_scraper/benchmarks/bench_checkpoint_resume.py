@@ -0,0 +1,196 @@
+"""Fault-injection check and overhead benchmark: checkpoint and resume.
+
+Runs a checkpointed wholefoods crawl (-a checkpoint=<dir>) against a fake
+Whole Foods site served by a downloader middleware, once uninterrupted and
+once killed with SIGKILL at random points and restarted until it finishes.
+Fails unless both runs wrote the same feed rows, and reports how long the
+checkpoints took to save.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_checkpoint_resume.py [kills] [seed]
+
+Each crawl runs in its own process and temporary directory, so the buildId
+and category size caches of the project directory aren't touched. Restarted
+runs find the caches the killed ones left behind, so they also take the
+cached buildId probe and speculative listing paths.
+"""
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_DIR))
+
+BUILD_ID = 'fake-build-id'
+STORE_IDS = (10001, 10002, 10003)
+CATEGORIES = ('produce', 'dairy-eggs', 'meat')
+PRODUCTS_PER_CATEGORY = 130
+# The fake API serves at most this many products per listing page
+MAX_PAGE_SIZE = 50
+FEEDS = ('store_data.jsonl', 'product_data.jsonl')
+
+
+def category_slugs(category):
+    # Every category shares a few products with the next one
+    index = CATEGORIES.index(category)
+    return [f'product-{index * (PRODUCTS_PER_CATEGORY - 10) + i}' for i in range(PRODUCTS_PER_CATEGORY)]
+
+
+def fake_body(url):
+    """JSON or HTML body the fake site serves for a Whole Foods URL, or None for a 404."""
+    parsed = urlparse(url)
+    path, query = parsed.path, parse_qs(parsed.query)
+    if path == '/':
+        return f'<html><script id="__NEXT_DATA__">{{"buildId":"{BUILD_ID}"}}</script></html>'
+    if path.startswith('/stores/'):
+        store_id = int(path.split('/')[2])
+        return json.dumps({'status': 'OPEN', 'openedAt': '2010-05-01T00:00:00Z', 'primaryLocation': {
+            'latitude': 40.0 + store_id % 100, 'longitude': -74.0,
+            'address': {'STREET_ADDRESS_LINE1': f'{store_id} Main St', 'CITY': 'New York',
+                        'STATE': 'NY', 'ZIP_CODE': '10001', 'POSTAL_CODE': '10001'}}})
+    if path.startswith('/api/products/category/'):
+        category = path.rsplit('/', 1)[1]
+        offset, limit = int(query['offset'][0]), int(query['limit'][0])
+        slugs = category_slugs(category)
+        results = [{'name': slug.replace('-', ' ').title(), 'slug': slug, 'brand': 'Fake Farms',
+                    'regularPrice': 1 + int(slug.rsplit('-', 1)[1]) / 100, 'isAvailable': True,
+                    'rank': rank, 'store': int(query['store'][0])}
+                   for rank, slug in enumerate(slugs)][offset:offset + min(limit, MAX_PAGE_SIZE)]
+        return json.dumps({'results': results, 'facets': [{'slug': 'category', 'refinements': [
+            {'slug': category, 'count': len(slugs)}]}]})
+    if path.startswith(f'/_next/data/{BUILD_ID}/product/'):
+        slug = path.rsplit('/', 1)[1][:-len('.json')]
+        number = int(slug.rsplit('-', 1)[1])
+        return json.dumps({'pageProps': {'data': {
+            'name': slug.replace('-', ' ').title(), 'slug': slug, 'brand': 'Fake Farms',
+            'asin': f'B{number:09d}', 'id': f'[B{number:09d}]', 'rank': 1, 'isAvailable': True,
+            'categories': {'name': 'Produce', 'slug': 'produce'},
+            'diets': [{'name': 'Vegan', 'slug': 'vegan'}],
+            'ingredients': [f'Ingredient {number}'], 'allergens': [], 'certifications': [],
+            'nutritionElements': [{'key': 'calories', 'name': 'Calories', 'uom': 'kcal',
+                                   'perServing': number % 7, 'fullDvp': 0}],
+            'servingInfo': {'servingSize': 1, 'servingSizeUom': 'each'},
+            'images': [{'image': f'https://example.com/{slug}.jpg'}],
+            'related': [{'slug': f'product-{number + 1}'}],
+        }}})
+    if path == f'/_next/data/{BUILD_ID}/index.json':
+        return '{"pageProps": {}}'
+    return None
+
+
+class FakeWholeFoodsMiddleware:
+    """Answer every request from the fake site after a short random delay."""
+
+    def process_request(self, request, spider):
+        from scrapy.http import HtmlResponse, TextResponse
+        from twisted.internet import reactor
+        from twisted.internet.task import deferLater
+
+        url = request.meta.get('proxy_original_url', request.url)
+        body = fake_body(url)
+        response_cls = HtmlResponse if urlparse(url).path == '/' else TextResponse
+        return deferLater(reactor, random.uniform(0.002, 0.02), lambda: response_cls(
+            url=request.url, status=200 if body is not None else 404,
+            body=(body or 'Not found').encode('utf-8'), encoding='utf-8', request=request))
+
+
+def run_worker(checkpoint_dir):
+    """Crawl the fake site with the project settings plus the fake site middleware."""
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    middlewares = settings.getdict('DOWNLOADER_MIDDLEWARES')
+    middlewares[f'{__name__}.FakeWholeFoodsMiddleware'] = 990
+    settings.set('DOWNLOADER_MIDDLEWARES', middlewares)
+    settings.set('CHECKPOINT_INTERVAL', 0.2)
+    settings.set('LOG_LEVEL', 'WARNING')
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler('wholefoods')
+    process.crawl(crawler, checkpoint=checkpoint_dir,
+                  store_ids=','.join(map(str, STORE_IDS)), categories=','.join(CATEGORIES))
+    process.start()
+    stats = crawler.stats.get_stats()
+    print(json.dumps({key: stats.get(key) for key in (
+        'checkpoint/saved_count', 'checkpoint/paused_count', 'checkpoint/last_save_ms',
+        'item_scraped_count')}))
+
+
+def start_worker(work_dir):
+    env = dict(os.environ, SCRAPY_SETTINGS_MODULE='food_scraper.settings',
+               PYTHONPATH=os.pathsep.join([str(PROJECT_DIR), str(Path(__file__).parent)]))
+    return subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve()), '--worker', 'crawl_state'],
+        cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def finish_worker(process):
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        lines = stderr.strip().splitlines() or ['no output']
+        raise SystemExit(f'crawl failed: {lines[-1]}')
+    return json.loads(stdout.strip().splitlines()[-1])
+
+
+def feed_rows(work_dir):
+    """Sorted feed rows of a finished crawl, failing on duplicate rows."""
+    rows = {}
+    for name in FEEDS:
+        path = Path(work_dir) / 'crawl_state' / name
+        lines = path.read_text().splitlines() if path.exists() else []
+        canonical = sorted(json.dumps(json.loads(line), sort_keys=True) for line in lines)
+        if len(set(canonical)) != len(canonical):
+            raise SystemExit(f'{name} has duplicate rows')
+        rows[name] = canonical
+    return rows
+
+
+def main():
+    kills = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rng = random.Random(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+
+    with tempfile.TemporaryDirectory() as baseline_dir, tempfile.TemporaryDirectory() as killed_dir:
+        started = time.perf_counter()
+        stats = finish_worker(start_worker(baseline_dir))
+        runtime = time.perf_counter() - started
+        baseline = feed_rows(baseline_dir)
+        print(f'uninterrupted: {stats["item_scraped_count"]} items in {runtime:.1f}s, '
+              f'{stats["checkpoint/saved_count"]} checkpoints, last took {stats["checkpoint/last_save_ms"]} ms')
+
+        for kill in range(kills):
+            process = start_worker(killed_dir)
+            delay = rng.uniform(0.5, runtime)
+            time.sleep(delay)
+            if process.poll() is not None:
+                print(f'run {kill + 1}: finished before the kill at {delay:.2f}s')
+                finish_worker(process)
+                break
+            os.kill(process.pid, signal.SIGKILL)
+            process.communicate()
+            print(f'run {kill + 1}: killed after {delay:.2f}s')
+        else:
+            finish_worker(start_worker(killed_dir))
+            print(f'run {kills + 1}: finished')
+
+        resumed = feed_rows(killed_dir)
+        for name in FEEDS:
+            if resumed[name] != baseline[name]:
+                raise SystemExit(
+                    f'{name} differs: {len(resumed[name])} rows after kills, '
+                    f'{len(baseline[name])} uninterrupted')
+            print(f'{name}: {len(baseline[name])} rows, identical')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--worker']:
+        run_worker(sys.argv[2])
+    else:
+        main()
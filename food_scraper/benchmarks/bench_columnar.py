@@ -0,0 +1,143 @@
+"""Output benchmark: JSON feed vs columnar Parquet export.
+
+Writes the same synthetic ProductItems once as the product_data.json feed
+(format json, indent 4, as in FEEDS) and once through the columnar export
+(COLUMNAR_EXPORT_ENABLED), then reports write time, size on disk, the time
+to load everything back, and the time to load just the nutrition amounts
+of one store.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_columnar.py [products]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scrapy.exporters import JsonItemExporter  # noqa: E402
+
+from food_scraper.items import ProductItem  # noqa: E402
+
+try:
+    import pyarrow.dataset as ds  # noqa: E402
+
+    from food_scraper.columnar import ParquetProductWriter, read_nutrition, read_products  # noqa: E402
+except ImportError:
+    ParquetProductWriter = None
+
+STORE_IDS = list(range(10200, 10220))
+CATEGORIES = ['Produce', 'Dairy & Eggs', 'Meat', 'Bread, Rolls & Bakery', 'Frozen Foods',
+              'Snacks, Chips, Salsas & Dips', 'Beverages', 'Pantry Essentials']
+BRANDS = [f'Brand {i}' for i in range(300)]
+NUTRIENTS = [('calories', 'Calories', 'kcal'), ('totalFat', 'Total Fat', 'g'),
+             ('saturatedFat', 'Saturated Fat', 'g'), ('transFat', 'Trans Fat', 'g'),
+             ('cholesterol', 'Cholesterol', 'mg'), ('sodium', 'Sodium', 'mg'),
+             ('totalCarbohydrate', 'Total Carbohydrate', 'g'), ('dietaryFiber', 'Dietary Fiber', 'g'),
+             ('totalSugars', 'Total Sugars', 'g'), ('addedSugars', 'Added Sugars', 'g'),
+             ('protein', 'Protein', 'g'), ('vitaminD', 'Vitamin D', 'mcg'),
+             ('calcium', 'Calcium', 'mg'), ('iron', 'Iron', 'mg'), ('potassium', 'Potassium', 'mg')]
+
+
+def synthetic_items(count, seed=0):
+    """ProductItems shaped like the spider's output, spread over stores and categories."""
+    rng = random.Random(seed)
+    items = []
+    for i in range(count):
+        slug = f'organic-product-{i % (count // len(STORE_IDS) or 1)}'
+        items.append(ProductItem(
+            store_id=STORE_IDS[i % len(STORE_IDS)], name=slug.replace('-', ' ').title(),
+            price=round(rng.uniform(0.99, 29.99), 2), slug=slug, brand=rng.choice(BRANDS),
+            asin=f'B0{i:08d}', amazon_product_id=f'B0{i:08d}', rank=rng.randint(1, 500),
+            is_available=rng.random() > 0.1, category=rng.choice(CATEGORIES),
+            category_2='Fresh Fruit', category_3='Apples', diets=['Organic', 'Vegan'],
+            ingredients=['Organic apples', 'Water', 'Sea salt'], allergens=['Tree Nuts'],
+            certifications=['USDA Organic'], nutrition_group='standard', nutrition_label_format='standard',
+            nutrition_elements=[{
+                'key': key, 'name': name, 'unit_of_measure': unit,
+                'amount_per_serving': round(rng.uniform(0.1, 300), 1),
+                'recommended_daily_value': rng.randint(0, 100),
+            } for key, name, unit in NUTRIENTS],
+            serving_info={'servingSize': 1, 'servingSizeUom': 'medium apple', 'totalSize': 1},
+            is_alcoholic=False, unit_of_measure='each',
+            image=f'https://m.media-amazon.com/images/S/{i}.jpg',
+            related_products=[f'related-{i + j}' for j in range(12)]))
+    return items
+
+
+def directory_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def write_json(items, path):
+    with open(path, 'wb') as f:
+        exporter = JsonItemExporter(f, encoding='utf8', indent=4)
+        exporter.start_exporting()
+        for item in items:
+            exporter.export_item(item)
+        exporter.finish_exporting()
+
+
+def write_columnar(items, directory):
+    writer = ParquetProductWriter(directory, 'bench', '2026-10-17', batch_rows=5000,
+                                  max_buffered_rows=50000)
+    for item in items:
+        writer.add(dict(item))
+    writer.close()
+    return writer
+
+
+def load_json_nutrition(path, store_id):
+    with open(path, encoding='utf-8') as f:
+        products = json.load(f)
+    return [element['amount_per_serving'] for product in products if product['store_id'] == store_id
+            for element in product['nutrition_elements']]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    if ParquetProductWriter is None:
+        raise SystemExit('pyarrow is not installed, pip install pyarrow')
+    items = synthetic_items(count)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'product_data.json')
+        columnar_dir = os.path.join(tmp, 'columnar')
+
+        json_write, _ = timed(lambda: write_json(items, json_path))
+        columnar_write, writer = timed(lambda: write_columnar(items, columnar_dir))
+        json_load, products = timed(lambda: json.load(open(json_path, encoding='utf-8')))
+        columnar_load, (table, nutrition) = timed(
+            lambda: (read_products(columnar_dir), read_nutrition(columnar_dir)))
+        assert table.num_rows == len(products) == count
+        assert nutrition.num_rows == sum(len(item['nutrition_elements']) for item in items)
+
+        store_id = STORE_IDS[0]
+        json_query, amounts = timed(lambda: load_json_nutrition(json_path, store_id))
+        columnar_query, store_nutrition = timed(lambda: read_nutrition(
+            columnar_dir, columns=['slug', 'key', 'amount_per_serving'],
+            filter=ds.field('store_id') == store_id))
+        assert store_nutrition.num_rows == len(amounts)
+
+        print(f'{count} products, {nutrition.num_rows} nutrition elements, '
+              f'{writer.files_written} Parquet files')
+        print(f'  {"":<10} {"write s":>8} {"size MiB":>9} {"load s":>8} {"1 store nutrition s":>20}')
+        print(f'  {"json":<10} {json_write:8.2f} {os.path.getsize(json_path) / 2 ** 20:9.1f} '
+              f'{json_load:8.2f} {json_query:20.3f}')
+        print(f'  {"parquet":<10} {columnar_write:8.2f} {directory_size(columnar_dir) / 2 ** 20:9.1f} '
+              f'{columnar_load:8.2f} {columnar_query:20.3f}')
+
+
+if __name__ == '__main__':
+    main()
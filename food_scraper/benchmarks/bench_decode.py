@@ -0,0 +1,172 @@
+"""Throughput benchmark: listing and product detail parsing.
+
+Runs the parse stage of both decoding paths on synthetic responses: the
+stdlib path (response.json() and ItemLoader processing) and the typed
+msgspec fast path (FAST_DECODE_ENABLED). Reports responses/sec on one core
+and checks that both paths build the same items.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_decode.py [seconds_per_case]
+"""
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scrapy.http import TextResponse  # noqa: E402
+
+from food_scraper.items import PartialProduct  # noqa: E402
+from food_scraper.spiders.wholefoods import WholeFoodsSpider, decoding  # noqa: E402
+
+PAGE_SIZE = 60
+
+
+class NullStats:
+    def inc_value(self, *args, **kwargs):
+        pass
+
+
+class BenchCrawler:
+    stats = NullStats()
+
+
+def synthetic_listing(page_size=PAGE_SIZE):
+    """Build a category listing body shaped like the real API response."""
+    results = [{
+        'name': f'Organic Product {i}',
+        'slug': f'organic-product-{i}',
+        'brand': 'Whole Foods Market',
+        'regularPrice': 3.99,
+        'salePrice': None,
+        'isAvailable': True,
+        'rank': i,
+        'imageThumbnail': f'https://m.media-amazon.com/images/I/{i}._SL160_.jpg',
+        'uom': 'each',
+        'store': 10259,
+        'isLocal': False,
+    } for i in range(page_size)]
+    refinements = [{'slug': 'produce', 'label': 'Produce', 'count': 1000}] + [
+        {'slug': f'facet-{i}', 'label': f'Facet {i}', 'count': i} for i in range(40)]
+    return json.dumps({'results': results, 'facets': [{'slug': 'category', 'refinements': refinements}],
+                       'meta': {'total': {'value': 1000}}})
+
+
+def synthetic_detail():
+    """Build a _next/data product detail body shaped like the real one."""
+    nutrition = [{
+        'key': f'nutrient-{i}', 'name': f'Nutrient {i}', 'uom': 'g',
+        'perServing': 0 if i % 3 == 0 else i * 1.5, 'fullDvp': i, 'dvp': i,
+        'isSubNutrient': False, 'order': i,
+    } for i in range(30)]
+    data = {
+        'name': 'Organic Honeycrisp Apple', 'slug': 'organic-honeycrisp-apple',
+        'brand': 'Produce', 'asin': 'B07R6VKGTB', 'id': '[B07R6VKGTB]',
+        'rank': 3, 'isAvailable': True, 'regularPrice': 2.49,
+        'categories': {'name': 'Produce', 'slug': 'produce', 'childCategory': {
+            'name': 'Fresh Fruit', 'slug': 'fresh-fruit',
+            'childCategory': {'name': 'Apples', 'slug': 'apples'}}},
+        'diets': [{'name': 'Organic', 'slug': 'organic'}, {'name': 'Vegan', 'slug': 'vegan'}],
+        'ingredients': ['Organic apples'],
+        'allergens': [],
+        'additives': [],
+        'certifications': [{'name': 'USDA Organic'}],
+        'nutritionGroup': 'standard',
+        'nutritionLabelFormat': 'standard',
+        'nutritionElements': nutrition,
+        'servingInfo': {'servingSize': 1, 'servingSizeUom': 'medium apple', 'totalSize': 1},
+        'isAlcoholic': False,
+        'uom': 'lb',
+        'images': [{'image': f'https://m.media-amazon.com/images/S/{i}.jpg', 'thumbnail': ''}
+                   for i in range(6)],
+        'related': [{'slug': f'related-{i}', 'name': f'Related {i}', 'regularPrice': 1.0}
+                    for i in range(12)],
+        'description': 'Crisp, sweet and juicy. ' * 40,
+        'reviews': [{'rating': 5, 'text': 'Great apples ' * 10} for _ in range(10)],
+    }
+    return json.dumps({'pageProps': {'data': data, 'store': {'id': 10259, 'name': 'Columbus Circle'}},
+                       '__N_SSP': True})
+
+
+def make_response(url, body):
+    # A fresh response every time: TextResponse.json() caches what it decoded
+    return TextResponse(url=url, body=body, encoding='utf-8')
+
+
+def parse_listing(spider, body):
+    """Decode a listing and build the PartialProduct for every result."""
+    response = make_response(
+        'https://www.wholefoodsmarket.com/api/products/category/produce', body)
+    data = spider.decode_json(response, 'decode_listing_page')
+    return [PartialProduct.from_listing(product, 10259, 'produce')
+            for product in data.get('results', [])]
+
+
+def parse_detail(spider, body, partial):
+    """Decode a detail response and build its ProductItem."""
+    response = make_response(
+        'https://www.wholefoodsmarket.com/_next/data/build/product/apple.json', body)
+    product_data = spider.decode_json(response, 'decode_product_page')
+    details = spider.extract_product_details(
+        product_data.get('pageProps', {}).get('data', {}), 'produce')
+    return spider.load_product_item(partial, details)
+
+
+def throughput(func, seconds):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        for _ in range(50):
+            func()
+        count += 50
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    listing = synthetic_listing().encode('utf-8')
+    detail = synthetic_detail().encode('utf-8')
+    partial = PartialProduct('Organic Honeycrisp Apple', 2.49, 'organic-honeycrisp-apple',
+                             'Produce', 10259, 'produce')
+
+    paths = [('stdlib', False)]
+    if decoding is not None:
+        paths.append(('msgspec', True))
+    else:
+        print('msgspec is not installed, only the stdlib path is measured')
+
+    spiders = {}
+    for label, fast_decode in paths:
+        spider = WholeFoodsSpider()
+        spider.crawler = BenchCrawler()
+        spider.fast_decode = fast_decode
+        spiders[label] = spider
+
+    if len(spiders) == 2:
+        assert parse_detail(spiders['stdlib'], detail, partial) == parse_detail(
+            spiders['msgspec'], detail, partial), 'paths built different items'
+        assert [p.__getstate__() for p in parse_listing(spiders['stdlib'], listing)] == [
+            p.__getstate__() for p in parse_listing(spiders['msgspec'], listing)], \
+            'paths built different listing records'
+
+    print(f'listing body {len(listing) / 1024:.1f} KiB ({PAGE_SIZE} products), '
+          f'detail body {len(detail) / 1024:.1f} KiB')
+    rates = {}
+    for label, spider in spiders.items():
+        rates[label] = (
+            throughput(lambda: parse_listing(spider, listing), seconds),
+            throughput(lambda: parse_detail(spider, detail, partial), seconds),
+        )
+        print(f'  {label:<8} listings {rates[label][0]:9.0f} responses/s   '
+              f'details {rates[label][1]:9.0f} responses/s')
+    if len(rates) == 2:
+        print(f'  speedup  listings {rates["msgspec"][0] / rates["stdlib"][0]:8.1f}x'
+              f'              details {rates["msgspec"][1] / rates["stdlib"][1]:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
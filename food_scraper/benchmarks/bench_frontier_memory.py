@@ -0,0 +1,149 @@
+"""Memory benchmark: pending product detail requests.
+
+Builds a synthetic frontier of detail requests the way parse_product_listings
+queues them, once carrying an ItemLoader bound to the listing response (the
+previous approach) and once carrying a PartialProduct, and reports peak RSS
+and the memory per pending request for each. Every variant runs in its own
+interpreter so peaks don't overlap.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_frontier_memory.py [products] [item_loader_products]
+
+The default frontier holds 100,000 products from listing pages of 60. Each
+ItemLoader built with a response parses it into a selector tree, about
+150 KiB per pending request, so a 100,000 product frontier of the old
+variant needs about 15 GiB. It is measured with item_loader_products
+(3,000 by default) and its memory scaled up to the full frontier instead.
+Each variant is also limited to half the physical memory and
+VARIANT_TIMEOUT seconds, and reported as failed past either.
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+PAGE_SIZE = 60
+VARIANTS = ('baseline', 'item_loader', 'partial_product')
+VARIANT_TIMEOUT = 600
+
+
+def synthetic_listing(page, page_size=PAGE_SIZE):
+    """Build a category listing body shaped like the real API response."""
+    results = [{
+        'name': f'Organic Product {page}-{i}',
+        'slug': f'organic-product-{page}-{i}',
+        'brand': 'Whole Foods Market',
+        'regularPrice': 3.99,
+        'salePrice': None,
+        'isAvailable': True,
+        'rank': i,
+        'imageThumbnail': f'https://m.media-amazon.com/images/I/{page}{i}._SL160_.jpg',
+        'uom': 'each',
+        'store': 10259,
+        'isLocal': False,
+        'description': 'Sourced from farms that meet our quality standards. ' * 8,
+    } for i in range(page_size)]
+    facets = [{'slug': f'facet-{i}', 'label': f'Facet {i}', 'count': i} for i in range(200)]
+    return json.dumps({'results': results, 'facets': facets, 'meta': {'total': {'value': 1000}}})
+
+
+def build_frontier(variant, products):
+    """Queue one detail request per product and return the pending requests."""
+    from scrapy import Request
+    from scrapy.http import TextResponse
+    from scrapy.loader import ItemLoader
+
+    from food_scraper.items import PartialProduct, ProductItem
+
+    pending = []
+    for page in range(-(-products // PAGE_SIZE)):
+        response = TextResponse(
+            url=f'https://www.wholefoodsmarket.com/api/products/category/produce?offset={page * PAGE_SIZE}',
+            body=synthetic_listing(page), encoding='utf-8')
+        for product in response.json()['results']:
+            if variant == 'item_loader':
+                product_loader = ItemLoader(item=ProductItem(), response=response)
+                product_loader.add_value('name', product.get('name'))
+                product_loader.add_value('price', product.get('regularPrice'))
+                product_loader.add_value('slug', product.get('slug'))
+                product_loader.add_value('brand', product.get('brand'))
+                product_loader.add_value('store_id', 10259)
+                product_loader.add_value('category', 'produce')
+                meta = {'product_loader': product_loader}
+            else:
+                meta = {'partial_product': PartialProduct.from_listing(product, 10259, 'produce')}
+            pending.append(Request(
+                f'https://www.wholefoodsmarket.com/_next/data/build/product/{product["slug"]}.json',
+                meta=meta, priority=30))
+        del response
+    return pending
+
+
+def run_variant(variant, products):
+    if variant != 'baseline':
+        pending = build_frontier(variant, products)
+        assert len(pending) >= products
+    else:
+        import scrapy  # noqa: F401  (same imports, no frontier)
+        import food_scraper.items  # noqa: F401
+    # ru_maxrss is in KiB on Linux
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def limit_memory():
+    """Cap the address space of a variant's interpreter at half the physical memory."""
+    limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def measure_variant(variant, products):
+    """Peak RSS in MiB of a variant built in its own interpreter, or the reason it failed."""
+    try:
+        result = subprocess.run(
+            [sys.executable, __file__, '--variant', variant, str(products)],
+            capture_output=True, text=True, timeout=VARIANT_TIMEOUT, preexec_fn=limit_memory)
+    except subprocess.TimeoutExpired:
+        return None, f'timed out after {VARIANT_TIMEOUT}s'
+    if result.returncode != 0:
+        if 'MemoryError' in result.stderr or result.returncode == -9:
+            return None, 'out of memory'
+        error = (result.stderr.strip().splitlines() or ['no output'])[-1]
+        return None, f'exit code {result.returncode}: {error}'
+    # ru_maxrss is in KiB on Linux
+    return int(result.stdout.split()[-1]) / 1024, None
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--variant':
+        run_variant(sys.argv[2], int(sys.argv[3]))
+        return
+
+    products = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    item_loader_products = min(products, int(sys.argv[2]) if len(sys.argv) > 2 else 3_000)
+    print(f'{products:,} pending detail requests, listing pages of {PAGE_SIZE}')
+    baseline = None
+    for variant in VARIANTS:
+        measured = item_loader_products if variant == 'item_loader' else products
+        peak, error = measure_variant(variant, measured)
+        if error:
+            print(f'  {variant:<16} failed ({error})')
+            continue
+        if variant == 'baseline':
+            baseline = peak
+            print(f'  {variant:<16} peak RSS {peak:8.1f} MiB')
+            continue
+        extra = peak - baseline if baseline is not None else peak
+        line = (f'  {variant:<16} peak RSS {peak:8.1f} MiB  (+{extra:.1f} MiB over imports, '
+                f'{extra * 1024 / measured:.1f} KiB per request)')
+        if measured != products:
+            line += f', about {extra * products / measured / 1024:.1f} GiB at {products:,} (measured at {measured:,})'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Listing membership benchmark: ListingMemberships vs a set of (store_id, slug) tuples.
+
+Lists a synthetic catalog the way the spider's category listings do: every
+store lists the same products, each under its own category and a share of
+them under a second one too. Reports the time per listing and the memory
+each structure holds once the crawl has been listed; the set only
+deduplicates pairs, ListingMemberships also keeps every pair's categories.
+Slugs are built per listing, as decoding a listing page does.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_listing_memberships.py [stores] [products] [categories]
+"""
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from food_scraper.listings import ListingMemberships  # noqa: E402
+
+# Share of products also listed under a second category
+MULTI_CATEGORY_SHARE = 0.1
+
+
+def listings(store_count, product_count, category_count):
+    """(store_id, slug, category) of every listing, the second listings of a store after its first ones."""
+    categories = [f'category-{i}' for i in range(category_count)]
+    second_every = round(1 / MULTI_CATEGORY_SHARE)
+    for store_id in range(10000, 10000 + store_count):
+        for i in range(product_count):
+            yield store_id, f'organic-product-{i}', categories[i % category_count]
+        for i in range(0, product_count, second_every):
+            yield store_id, f'organic-product-{i}', categories[(i + 1) % category_count]
+
+
+def measure(add, store_count, product_count, category_count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    new = sum(add(*listing) for listing in listings(store_count, product_count, category_count))
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return new, elapsed, memory
+
+
+def main():
+    store_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    product_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    category_count = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    listing_count = store_count * (product_count + len(range(0, product_count, round(1 / MULTI_CATEGORY_SHARE))))
+
+    memberships = ListingMemberships([f'category-{i}' for i in range(category_count)])
+    new, elapsed, memory = measure(memberships.add, store_count, product_count, category_count)
+    pairs = store_count * product_count
+    assert new == len(memberships) == pairs, 'pairs were lost or duplicated'
+    assert memberships.categories(10000, 'organic-product-0') == ['category-0', 'category-1']
+
+    pair_set = set()
+
+    def add_pair(store_id, slug, category):
+        pair = (store_id, slug)
+        if pair in pair_set:
+            return False
+        pair_set.add(pair)
+        return True
+
+    set_new, set_elapsed, set_memory = measure(add_pair, store_count, product_count, category_count)
+    assert set_new == pairs
+
+    print(f'{pairs} (store, slug) pairs from {listing_count} listings '
+          f'({store_count} stores x {product_count} products, {category_count} categories)')
+    print(f'  ListingMemberships: {elapsed / listing_count * 1e6:4.2f} us per listing, '
+          f'{memory / 2 ** 20:6.1f} MiB ({memberships.nbytes / 2 ** 20:.1f} MiB of bitsets), '
+          f'{memberships.multi_category_count} pairs in several categories')
+    print(f'  set of tuples:      {set_elapsed / listing_count * 1e6:4.2f} us per listing, '
+          f'{set_memory / 2 ** 20:6.1f} MiB, no categories')
+
+
+if __name__ == '__main__':
+    main()
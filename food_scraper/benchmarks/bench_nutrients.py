@@ -0,0 +1,191 @@
+"""Nutrient analytics benchmark: NutrientMatrix vs a pure-Python reference.
+
+Writes a columnar export (COLUMNAR_EXPORT_ENABLED layout) of synthetic
+product-store rows, the same products in every store at store-specific
+prices, with nutrients in g, mg, mcg, IU, kcal and kJ and serving sizes in
+g, oz, ml or pieces. Loads it into a NutrientMatrix, runs cost per gram of
+protein, top products by protein per dollar and per-category fiber per
+100g, and checks every result against plain loops over the rows as dicts.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_nutrients.py [rows] [products]
+"""
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+try:
+    import numpy as np  # noqa: E402
+    import pyarrow as pa  # noqa: E402
+
+    from food_scraper.columnar import ParquetProductWriter, PartitionBuffer, partition_path  # noqa: E402
+    from food_scraper.nutrients import (  # noqa: E402
+        NutrientMatrix, serving_grams, servings_per_price, unit_conversion)
+except ImportError:
+    NutrientMatrix = None
+
+CATEGORIES = ['Produce', 'Dairy & Eggs', 'Meat', 'Pantry Essentials', 'Frozen Foods', 'Beverages']
+NUTRIENTS = [('calories', 'Calories', ('kcal', 'kJ')), ('totalFat', 'Total Fat', ('g',)),
+             ('sodium', 'Sodium', ('mg',)), ('dietaryFiber', 'Dietary Fiber', ('g', 'mg')),
+             ('protein', 'Protein', ('g',)), ('vitaminD', 'Vitamin D', ('mcg', 'IU')),
+             ('calcium', 'Calcium', ('mg',)), ('iron', 'Iron', ('mg', 'mcg'))]
+SERVINGS = [{'servingSize': 28, 'servingSizeUom': 'g', 'servingsPerContainer': 'about 12'},
+            {'servingSize': 1, 'servingSizeUom': 'oz', 'totalSize': 16, 'totalSizeUom': 'oz'},
+            {'servingSize': 240, 'servingSizeUom': 'ml', 'servingsPerContainer': 4},
+            {'servingSize': 1, 'servingSizeUom': 'medium apple', 'totalSize': 1},
+            {'servingSize': 112, 'servingSizeUom': 'g'}]
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def synthetic_products(count, seed=0):
+    """Store-independent product values, shaped like ProductItems."""
+    rng = random.Random(seed)
+    products = []
+    for i in range(count):
+        serving_info = dict(rng.choice(SERVINGS))
+        products.append({
+            'slug': f'product-{i}', 'name': f'Product {i}', 'category': CATEGORIES[i % len(CATEGORIES)],
+            'serving_info': serving_info,
+            # Produce sold by weight: the price is per lb
+            'unit_of_measure': 'lb' if i % 7 == 0 and serving_info['servingSizeUom'] == 'g' else 'each',
+            'nutrition_elements': [
+                {'key': key, 'name': name, 'unit_of_measure': rng.choice(units),
+                 'amount_per_serving': round(rng.uniform(0.1, 30), 1), 'recommended_daily_value': 10}
+                for key, name, units in NUTRIENTS if rng.random() > 0.15],
+        })
+    return products
+
+
+def store_prices(products, store_id):
+    rng = random.Random(store_id)
+    return [round(rng.uniform(0.99, 29.99), 2) for _ in products]
+
+
+def write_columnar(products, store_ids, directory):
+    """One partition per store and category, writing each category's products table once per store."""
+    writer = ParquetProductWriter(directory, 'bench', '2026-10-17', batch_rows=0, max_buffered_rows=0)
+    buffers = {}
+    for product in products:
+        buffers.setdefault(product['category'], PartitionBuffer()).add(dict(product, price=0.0))
+    tables = {category: buffer.tables() for category, buffer in buffers.items()}
+    positions = {category: [i for i, product in enumerate(products) if product['category'] == category]
+                 for category in buffers}
+    for store_id in store_ids:
+        prices = store_prices(products, store_id)
+        for category, (product_table, nutrition_table) in tables.items():
+            column = product_table.schema.get_field_index('price')
+            product_table = product_table.set_column(
+                column, 'price', pa.array([prices[i] for i in positions[category]], pa.float64()))
+            path = partition_path('2026-10-17', store_id, category)
+            writer.write_table(product_table, os.path.join(directory, 'products', path, 'part-0.parquet'))
+            writer.write_table(nutrition_table, os.path.join(directory, 'nutrition', path, 'part-0.parquet'))
+
+
+def rows(products, store_ids):
+    """Every product-store row as a dict, in the order of the columnar export's stores."""
+    for store_id in store_ids:
+        for product, price in zip(products, store_prices(products, store_id)):
+            yield dict(product, store_id=store_id, price=price)
+
+
+def reference_amount(row, key):
+    """Amount of a nutrient per serving in its canonical unit, None if missing."""
+    for element in row['nutrition_elements']:
+        if element['key'] == key:
+            unit, factor = unit_conversion(key, element['unit_of_measure'])
+            return unit, element['amount_per_serving'] * factor
+    return None, None
+
+
+def reference(products, store_ids, fiber_unit):
+    """Cost per gram of protein, the best protein per dollar and fiber per 100g per category, in loops.
+
+    Fiber amounts count when given in fiber_unit after conversion, the unit
+    the matrix picked for its column.
+    """
+    cost_per_protein, protein_per_dollar, fiber = [], [], {}
+    for row in rows(products, store_ids):
+        servings = servings_per_price(row['serving_info'], row['unit_of_measure'])
+        unit, protein = reference_amount(row, 'protein')
+        bought = protein * servings if protein is not None and servings is not None else None
+        cost_per_protein.append(row['price'] / bought if bought else math.nan)
+        protein_per_dollar.append(
+            (bought / row['price'], row['store_id'], row['slug']) if bought is not None else None)
+        grams = serving_grams(row['serving_info'])
+        unit, amount = reference_amount(row, 'dietaryFiber')
+        if grams and amount is not None and unit == fiber_unit:
+            fiber.setdefault(row['category'], []).append(amount * 100 / grams)
+    top = sorted((value for value in protein_per_dollar if value is not None),
+                 key=lambda value: -value[0])[:10]
+    distributions = {}
+    for category, values in fiber.items():
+        values.sort()
+        quantiles = {}
+        for q in QUANTILES:
+            position = (len(values) - 1) * q
+            low = math.floor(position)
+            high = min(low + 1, len(values) - 1)
+            quantiles[f'p{round(q * 100)}'] = values[low] + (values[high] - values[low]) * (position - low)
+        distributions[category] = {'count': len(values), 'mean': sum(values) / len(values), **quantiles}
+    return cost_per_protein, top, distributions
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    product_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    if NutrientMatrix is None:
+        raise SystemExit('numpy and pyarrow are needed, pip install numpy pyarrow')
+    products = synthetic_products(product_count)
+    store_ids = list(range(10000, 10000 + max(1, count // product_count)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_columnar(products, store_ids, tmp)
+        load, matrix = timed(lambda: NutrientMatrix.from_columnar(tmp))
+    cost, cost_per_protein = timed(lambda: matrix.cost_per('protein'))
+    top, best = timed(lambda: matrix.top_per_dollar('protein', 10))
+    distribution, fiber = timed(lambda: matrix.category_distribution('dietaryFiber', '100g'))
+    fiber_unit = matrix.units[matrix.column('dietaryFiber')]
+    reference_time, (expected_cost, expected_top, expected_fiber) = timed(
+        lambda: reference(products, store_ids, fiber_unit))
+
+    # Compare row by row, keyed by (store, slug): the export groups rows by category
+    slug_rows = {slug: i for i, slug in enumerate(product['slug'] for product in products)}
+    expected = np.array(expected_cost).reshape(len(store_ids), len(products))
+    actual = np.full_like(expected, np.nan)
+    actual[matrix.store_ids - store_ids[0],
+           [slug_rows[slug] for slug in matrix.slugs[matrix.product_index]]] = cost_per_protein
+    assert np.allclose(actual, expected, equal_nan=True), 'cost per gram of protein differs'
+    assert [(row['store_id'], row['slug']) for row in best] == \
+        [(store_id, slug) for _, store_id, slug in expected_top], 'top protein per dollar differs'
+    assert np.allclose([row['value'] for row in best], [value for value, _, _ in expected_top]), \
+        'top protein per dollar differs'
+    for category, values in expected_fiber.items():
+        for name, value in values.items():
+            assert math.isclose(fiber[category][name], value, rel_tol=1e-9), f'{category} fiber {name} differs'
+
+    print(f'{len(matrix)} product-store rows ({len(store_ids)} stores x {product_count} products), '
+          f'{len(matrix.nutrients)} nutrients in {dict(zip(matrix.nutrients, matrix.units))}')
+    print(f'  load columnar export      {load:7.2f} s')
+    print(f'  cost per g protein        {cost:7.3f} s')
+    print(f'  top 10 protein per dollar {top:7.3f} s')
+    print(f'  fiber per 100g per cat.   {distribution:7.3f} s')
+    print(f'  pure-Python reference     {reference_time:7.2f} s (same results)')
+    print(f'  best: {best[0]["slug"]} at store {best[0]["store_id"]}, '
+          f'{best[0]["value"]:.1f} g protein per dollar')
+
+
+if __name__ == '__main__':
+    main()
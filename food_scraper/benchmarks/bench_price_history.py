@@ -0,0 +1,90 @@
+"""Storage and write cost benchmark: price history vs nightly snapshots.
+
+Records several runs of a synthetic catalog in the price history store
+(PRICE_HISTORY_ENABLED), with a small share of prices, availability and
+ranks changing between runs. For each run it reports the write time, the
+observations stored and how much the database grew, next to the size of a
+full jsonlines snapshot of the same run. Then it times the two indexed
+queries: a slug's price series and a run's changes.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_price_history.py [products] [runs] [churn]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from food_scraper.history import PriceHistory  # noqa: E402
+
+STORE_COUNT = 20
+
+
+def database_size(path):
+    # WAL contents count until they're checkpointed into the database
+    return sum(os.path.getsize(p) for p in (path, f'{path}-wal') if os.path.exists(p))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    churn = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+    rng = random.Random(0)
+
+    products = [{
+        'store_id': 10200 + i % STORE_COUNT, 'slug': f'organic-product-{i // STORE_COUNT}',
+        'name': f'Organic Product {i // STORE_COUNT}', 'brand': f'Brand {i % 300}', 'category': 'Produce',
+        'price': round(rng.uniform(0.99, 29.99), 2), 'is_available': True, 'rank': i % 500,
+    } for i in range(count)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'price_history.sqlite3')
+        history = PriceHistory(path)
+        print(f'{count} products in {STORE_COUNT} stores, {churn:.1%} changing per run')
+        print(f'  {"run":>4} {"write s":>8} {"stored":>8} {"growth KiB":>11} {"snapshot KiB":>13}')
+        for run in range(1, runs + 1):
+            if run > 1:
+                for product in rng.sample(products, int(count * churn)):
+                    field = rng.choice(('price', 'is_available', 'rank'))
+                    if field == 'price':
+                        product['price'] = round(product['price'] * rng.uniform(0.8, 1.2), 2)
+                    elif field == 'is_available':
+                        product['is_available'] = not product['is_available']
+                    else:
+                        product['rank'] += 1
+            snapshot_size = sum(len(json.dumps(product)) + 1 for product in products)
+
+            size_before = database_size(path)
+            start = time.perf_counter()
+            history.start_run(f'run-{run}')
+            for product in products:
+                history.add(product['store_id'], product['slug'], product['price'],
+                            product['is_available'], product['rank'],
+                            product['name'], product['brand'], product['category'])
+            history.finish_run()
+            elapsed = time.perf_counter() - start
+            growth = database_size(path) - size_before
+            print(f'  {run:>4} {elapsed:8.2f} {history.change_count:>8} {growth / 1024:11.0f} '
+                  f'{snapshot_size / 1024:13.0f}')
+            history.change_count = history.observed_count = 0
+
+        slug = products[0]['slug']
+        start = time.perf_counter()
+        series = history.price_series(slug)
+        series_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        changes = history.changes(runs)
+        changes_ms = (time.perf_counter() - start) * 1000
+        print(f'price series of {slug}: {len(series)} observations in {series_ms:.2f} ms')
+        print(f'changes in run {runs}: {len(changes)} observations in {changes_ms:.2f} ms')
+        history.close()
+
+
+if __name__ == '__main__':
+    main()
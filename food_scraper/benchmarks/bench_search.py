@@ -0,0 +1,133 @@
+"""Search index benchmark: SearchIndex queries vs scanning every row.
+
+Builds the index of synthetic product-store rows, the same products in
+every store at store-specific prices, with ingredient lists drawn from a
+skewed vocabulary and random allergens, diets, additives and
+certifications. Reports the build, write and load times and the index
+size, then times a few filtered queries against a pure-Python scan of the
+rows (with the terms of every product tokenized up front), and checks
+both find the same rows.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_search.py [rows] [products]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+try:
+    from food_scraper.search import (  # noqa: E402
+        FIELDS, SearchIndex, SearchIndexBuilder, field_terms, parse_query, values_of)
+except ImportError:
+    SearchIndex = None
+
+INGREDIENTS = ['Organic Rolled Oats', 'Cane Sugar', 'Sea Salt', 'Water', 'Whole Wheat Flour',
+               'Organic Brown Rice', 'Sunflower Oil', 'Almonds', 'Cocoa Butter', 'Natural Flavors',
+               'Honey', 'Blueberries', 'Tomatoes', 'Garlic', 'Onions', 'Cultured Milk', 'Eggs',
+               'Soy Lecithin', 'Quinoa', 'Coconut Sugar'] + [f'Ingredient {i}' for i in range(2000)]
+ALLERGENS = ['Milk', 'Soy', 'Wheat', 'Tree Nuts', 'Eggs', 'Peanuts', 'Fish', 'Sesame']
+DIETS = ['Vegan', 'Vegetarian', 'Gluten-Free', 'Dairy-Free', 'Keto-Friendly', 'Paleo-Friendly',
+         'Low Sodium', 'Sugar-Conscious']
+ADDITIVES = ['Xanthan Gum', 'Citric Acid', 'Guar Gum', 'Ascorbic Acid', 'Carrageenan']
+CERTIFICATIONS = ['USDA Organic', 'Non-GMO Project Verified', 'Kosher', 'Fair Trade Certified',
+                  'Certified Gluten-Free']
+QUERIES = [
+    "diet:gluten-free ingredient:oats -ingredient:sugar store:{store} price<5",
+    "diet:vegan -allergen:soy 'certification:usda organic'",
+    "ingredient:'brown rice' price<=3",
+    "allergen:'tree nuts' additive:'xanthan gum' store:{store},{other_store}",
+    "-allergen:milk -allergen:eggs -allergen:wheat price>=20",
+]
+
+
+def synthetic_products(count, seed=0):
+    """Store-independent product values, shaped like ProductItems."""
+    rng = random.Random(seed)
+    # A few ingredients are everywhere, most are rare
+    weights = [1 / (rank + 1) for rank in range(len(INGREDIENTS))]
+    products = []
+    for i in range(count):
+        products.append({
+            'slug': f'product-{i}', 'name': f'Product {i}', 'brand': f'Brand {i % 300}',
+            'ingredients': rng.choices(INGREDIENTS, weights, k=rng.randint(1, 12)),
+            'allergens': rng.sample(ALLERGENS, rng.randint(0, 3)),
+            'diets': rng.sample(DIETS, rng.randint(0, 4)),
+            'additives': rng.sample(ADDITIVES, rng.randint(0, 2)),
+            'certifications': rng.sample(CERTIFICATIONS, rng.randint(0, 2)),
+        })
+    return products
+
+
+def rows(products, store_ids):
+    for store_id in store_ids:
+        rng = random.Random(store_id)
+        for product in products:
+            yield dict(product, store_id=store_id, price=round(rng.uniform(0.99, 29.99), 2))
+
+
+def reference(products, store_ids, query):
+    """(store_id, slug) of the matching rows, scanning every row."""
+    terms = {product['slug']: {field: {term for value in values_of(product[field])
+                                       for term in field_terms(field, value)} for field in FIELDS}
+             for product in products}
+
+    def has(slug, field, value):
+        return set(field_terms(field, value)) <= terms[slug][field]
+
+    found = set()
+    for row in rows(products, store_ids):
+        if query['store_ids'] is not None and row['store_id'] not in query['store_ids']:
+            continue
+        if query['min_price'] is not None and not row['price'] >= query['min_price']:
+            continue
+        if query['max_price'] is not None and not row['price'] <= query['max_price']:
+            continue
+        if all(has(row['slug'], field, value) for field, value in query['include']) and \
+                not any(has(row['slug'], field, value) for field, value in query['exclude']):
+            found.add((row['store_id'], row['slug']))
+    return found
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    product_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    if SearchIndex is None:
+        raise SystemExit('numpy is needed, pip install numpy')
+    products = synthetic_products(product_count)
+    store_ids = list(range(10000, 10000 + max(1, count // product_count)))
+
+    build, builder = timed(lambda: SearchIndexBuilder.from_items(rows(products, store_ids)))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'search_index.bin')
+        write, size = timed(lambda: builder.write(path))
+        load, index = timed(lambda: SearchIndex(path))
+        print(f'{len(index)} product-store rows ({len(store_ids)} stores x {product_count} products), '
+              f'{builder.term_count} terms')
+        print(f'  build {build:.2f} s, write {write:.2f} s, load {load * 1000:.1f} ms, '
+              f'{size / 2 ** 20:.1f} MiB on disk')
+        for query_text in QUERIES:
+            query_text = query_text.format(store=store_ids[0], other_store=store_ids[-1])
+            query = parse_query(query_text)
+            runs = 20
+            elapsed, found = timed(lambda: [index.rows(**query) for _ in range(runs)][-1])
+            scan, expected = timed(lambda: reference(products, store_ids, query))
+            assert {(index.row(row)['store_id'], index.row(row)['slug']) for row in found} == expected, \
+                f'{query_text} differs from the scan'
+            print(f'  {len(found):>7} rows  {elapsed / runs * 1000:7.2f} ms  (scan {scan:5.2f} s)  {query_text}')
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
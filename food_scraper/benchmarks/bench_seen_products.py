@@ -0,0 +1,67 @@
+"""Seen-product set benchmark: SeenProducts (Bloom filter + SQLite) vs a Python set.
+
+Adds synthetic (store_id, slug) pairs the way related product discovery
+does: every pair once as new, then every pair again as an already seen
+link, and reports the time per pair, the memory each structure holds and
+the Bloom filter's false positives (new pairs that needed a SQLite lookup).
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_seen_products.py [pairs] [stores]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from food_scraper.discovery import SeenProducts  # noqa: E402
+
+
+def pairs(count, store_count):
+    for i in range(count):
+        yield 10000 + i % store_count, f'organic-product-{i // store_count}'
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    store_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'related_seen.sqlite3')
+        seen = SeenProducts(path, capacity=count)
+        start = time.perf_counter()
+        new = sum(seen.add(store_id, slug, 1) for store_id, slug in pairs(count, store_count))
+        seen.commit()
+        add_time = time.perf_counter() - start
+        start = time.perf_counter()
+        again = sum(seen.add(store_id, slug, 2) for store_id, slug in pairs(count, store_count))
+        seen_time = time.perf_counter() - start
+        assert new == count and again == 0, 'pairs were lost or duplicated'
+        false_positives = seen.false_positive_count
+        seen.close()
+        disk = os.path.getsize(path) + sum(
+            os.path.getsize(path + suffix) for suffix in ('-wal', '-shm') if os.path.exists(path + suffix))
+
+    tracemalloc.start()
+    exact = set()
+    start = time.perf_counter()
+    for pair in pairs(count, store_count):
+        exact.add(pair)
+    set_time = time.perf_counter() - start
+    set_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f'{count} (store, slug) pairs over {store_count} stores')
+    print(f'  SeenProducts: {add_time / count * 1e6:5.1f} us per new pair, '
+          f'{seen_time / count * 1e6:5.1f} us per seen pair, '
+          f'{len(seen.bloom.bits) / 2 ** 20:.1f} MiB in memory, {disk / 2 ** 20:.1f} MiB on disk, '
+          f'{false_positives} false positives ({false_positives / count:.2%})')
+    print(f'  Python set:   {set_time / count * 1e6:5.1f} us per pair, {set_memory / 2 ** 20:.1f} MiB in memory')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""Attribution check and scheduler benchmark: many stores in one crawl.
+
+First times StoreRoundRobinPriorityQueue push and pop on their own for
+growing numbers of stores; the time per request should stay flat.
+
+Then crawls a fake Whole Foods site, served by a downloader middleware,
+for many stores at once (40 by default). StoreRoundRobinPriorityQueue
+interleaves them, and random response delays reorder them further. Each
+store lists its own subset of products, and its listing prices, detail
+ranks and availability and its store summary are all derived from the
+store id. The check fails unless every store and product row carries its
+own store's values and every listed (store, slug) pair was written once.
+It also reports how interleaved the crawl was.
+
+Run from the project directory (next to scrapy.cfg):
+
+    python benchmarks/bench_store_interleaving.py [stores] [seed]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_DIR))
+
+BUILD_ID = 'fake-build-id'
+CATEGORIES = ('produce', 'dairy-eggs', 'meat')
+PRODUCTS_PER_CATEGORY = 90
+MAX_PAGE_SIZE = 50
+
+
+def listed_slugs(store_id, category):
+    """Slugs a store lists in a category: its own subset of the category's products"""
+    index = CATEGORIES.index(category)
+    return [f'product-{index * PRODUCTS_PER_CATEGORY + i}' for i in range(PRODUCTS_PER_CATEGORY)
+            if (i + store_id) % 4 != 0]
+
+
+def listing_price(store_id, slug):
+    return round(1 + (store_id % 97) / 100 + int(slug.rsplit('-', 1)[1]) / 1000, 3)
+
+
+def detail_rank(store_id, slug):
+    return store_id * 1000 + int(slug.rsplit('-', 1)[1])
+
+
+def detail_available(store_id, slug):
+    return (store_id + int(slug.rsplit('-', 1)[1])) % 3 != 0
+
+
+def fake_body(url):
+    """JSON or HTML body the fake site serves for a Whole Foods URL, or None for a 404."""
+    parsed = urlparse(url)
+    path, query = parsed.path, parse_qs(parsed.query)
+    if path == '/':
+        return f'<html><script id="__NEXT_DATA__">{{"buildId":"{BUILD_ID}"}}</script></html>'
+    if path.startswith('/stores/'):
+        store_id = int(path.split('/')[2])
+        return json.dumps({'status': 'OPEN', 'openedAt': '2010-05-01T00:00:00Z', 'primaryLocation': {
+            'latitude': store_id / 1000, 'longitude': -store_id / 1000,
+            'address': {'STREET_ADDRESS_LINE1': f'{store_id} Main St', 'CITY': f'City {store_id}',
+                        'STATE': 'NY', 'ZIP_CODE': str(store_id), 'POSTAL_CODE': str(store_id)}}})
+    if path.startswith('/api/products/category/'):
+        category = path.rsplit('/', 1)[1]
+        store_id = int(query['store'][0])
+        offset, limit = int(query['offset'][0]), int(query['limit'][0])
+        slugs = listed_slugs(store_id, category)
+        results = [{'name': slug.replace('-', ' ').title(), 'slug': slug, 'brand': 'Fake Farms',
+                    'regularPrice': listing_price(store_id, slug), 'isAvailable': True,
+                    'rank': rank, 'store': store_id}
+                   for rank, slug in enumerate(slugs)][offset:offset + min(limit, MAX_PAGE_SIZE)]
+        return json.dumps({'results': results, 'facets': [{'slug': 'category', 'refinements': [
+            {'slug': category, 'count': len(slugs)}]}]})
+    if path.startswith(f'/_next/data/{BUILD_ID}/product/'):
+        slug = path.rsplit('/', 1)[1][:-len('.json')]
+        store_id = int(query['store'][0])
+        return json.dumps({'pageProps': {'data': {
+            'name': slug.replace('-', ' ').title(), 'slug': slug, 'brand': 'Fake Farms',
+            'rank': detail_rank(store_id, slug), 'isAvailable': detail_available(store_id, slug),
+            'categories': {'name': 'Produce', 'slug': 'produce'},
+            'nutritionElements': [{'key': 'calories', 'name': 'Calories', 'uom': 'kcal',
+                                   'perServing': 10, 'fullDvp': 0}],
+        }}})
+    return None
+
+
+class FakeWholeFoodsMiddleware:
+    """Answer every request from the fake site after a random delay, so stores finish out of order."""
+
+    def process_request(self, request, spider):
+        from scrapy.http import HtmlResponse, TextResponse
+        from twisted.internet import reactor
+        from twisted.internet.task import deferLater
+
+        url = request.meta.get('proxy_original_url', request.url)
+        body = fake_body(url)
+        response_cls = HtmlResponse if urlparse(url).path == '/' else TextResponse
+        return deferLater(reactor, random.uniform(0, 0.03), lambda: response_cls(
+            url=request.url, status=200 if body is not None else 404,
+            body=(body or 'Not found').encode('utf-8'), encoding='utf-8', request=request))
+
+
+def crawl(store_ids, feed_path):
+    """Crawl the fake site for every store with the project settings plus the fake site middleware."""
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    middlewares = settings.getdict('DOWNLOADER_MIDDLEWARES')
+    middlewares[f'{__name__}.FakeWholeFoodsMiddleware'] = 990
+    settings.set('DOWNLOADER_MIDDLEWARES', middlewares)
+    settings.set('FEEDS', {feed_path: {'format': 'jsonlines'}})
+    settings.set('LOG_LEVEL', 'WARNING')
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler('wholefoods')
+    process.crawl(crawler, store_ids=','.join(map(str, store_ids)), categories=','.join(CATEGORIES))
+    process.start()
+    return crawler.stats.get_stats()
+
+
+def check_rows(rows, store_ids):
+    """Fail unless every row carries its own store's values and every listed pair is there once."""
+    stores = [row for row in rows if 'slug' not in row]
+    products = [row for row in rows if 'slug' in row]
+    assert sorted(row['store_id'] for row in stores) == sorted(store_ids), 'store rows are missing or repeated'
+    for row in stores:
+        store_id = row['store_id']
+        assert row['city'] == f'City {store_id}' and row['zip_code'] == str(store_id), \
+            f'store {store_id} has the summary of another store'
+
+    expected = {(store_id, slug) for store_id in store_ids
+                for category in CATEGORIES for slug in listed_slugs(store_id, category)}
+    pairs = [(row['store_id'], row['slug']) for row in products]
+    assert len(pairs) == len(set(pairs)), 'a product was written twice for a store'
+    assert set(pairs) == expected, f'{len(expected - set(pairs))} listed products are missing, ' \
+                                   f'{len(set(pairs) - expected)} are attributed to stores that do not list them'
+    for row in products:
+        store_id, slug = row['store_id'], row['slug']
+        assert row['price'] == listing_price(store_id, slug), f'{slug} has another store\'s listing price'
+        assert row['rank'] == detail_rank(store_id, slug), f'{slug} has another store\'s details'
+        assert row['is_available'] == detail_available(store_id, slug), f'{slug} has another store\'s availability'
+    return products
+
+
+def interleaving(products):
+    """Store switches between consecutive product rows, and the most stores with rows still to come at once"""
+    switches = sum(a['store_id'] != b['store_id'] for a, b in zip(products, products[1:]))
+    first, last = {}, {}
+    for position, row in enumerate(products):
+        first.setdefault(row['store_id'], position)
+        last[row['store_id']] = position
+    open_stores = max(sum(first[store] <= position <= last[store] for store in first)
+                      for position in range(0, len(products), max(1, len(products) // 100)))
+    return switches, open_stores
+
+
+def time_queue(store_count, requests_per_store=100):
+    """Microseconds per push and per pop of StoreRoundRobinPriorityQueue with this many stores"""
+    import scrapy
+    from scrapy.crawler import Crawler
+    from scrapy.squeues import FifoMemoryQueue
+
+    from food_scraper.context import CrawlContext
+    from food_scraper.scheduler import StoreRoundRobinPriorityQueue
+
+    queue = StoreRoundRobinPriorityQueue.from_crawler(
+        Crawler(scrapy.Spider), FifoMemoryQueue, 'bench')
+    requests = [scrapy.Request(f'https://www.wholefoodsmarket.com/{store_id}/{i}',
+                               meta={'crawl_context': CrawlContext(store_id=store_id)},
+                               priority=40 if i % 10 == 0 else 30)
+                for i in range(requests_per_store) for store_id in range(store_count)]
+    start = time.perf_counter()
+    for request in requests:
+        queue.push(request)
+    push = time.perf_counter() - start
+    start = time.perf_counter()
+    popped = [queue.pop() for _ in requests]
+    pop = time.perf_counter() - start
+    assert queue.pop() is None and len(popped) == len(requests)
+    # Priority first, then stores in turn
+    assert [request.priority for request in popped] == sorted((request.priority for request in requests),
+                                                             reverse=True)
+    assert len({request.meta['crawl_context'].store_id for request in popped[:store_count]}) == store_count
+    return push / len(requests) * 1e6, pop / len(requests) * 1e6
+
+
+def main():
+    store_count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    random.seed(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'food_scraper.settings')
+    store_ids = list(range(10001, 10001 + store_count))
+
+    for queue_stores in (10, 100, 1000):
+        push, pop = time_queue(queue_stores)
+        print(f'queue with {queue_stores:>4} stores: {push:5.1f} us per push, {pop:5.1f} us per pop')
+
+    project_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The crawl's caches and stats file go to the temporary directory
+        os.chdir(work_dir)
+        try:
+            started = time.perf_counter()
+            stats = crawl(store_ids, os.path.join(work_dir, 'rows.jsonl'))
+            runtime = time.perf_counter() - started
+            with open('rows.jsonl', encoding='utf-8') as f:
+                rows = [json.loads(line) for line in f]
+        finally:
+            os.chdir(project_dir)
+
+    products = check_rows(rows, store_ids)
+    switches, open_stores = interleaving(products)
+    print(f'{len(products)} products of {store_count} stores in {runtime:.1f}s '
+          f'({stats.get("downloader/request_count")} requests), every row attributed to its own store')
+    print(f'  {switches} store switches between consecutive rows, up to {open_stores} stores in progress at once')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import json
+import os
+import re
+import time
+
+
+BUILD_ID_PATTERN = re.compile(rb'"buildId"\s*:\s*"([^"\\]+)"')
+# Next.js also references the buildId in the build manifest script URL
+BUILD_MANIFEST_PATTERN = re.compile(rb'/_next/static/([^/"\s]+)/_buildManifest\.js')
+
+
+# The build manifest script is in the <head>, so the buildId is usually in the first bytes
+HEAD_BYTES = 64 * 1024
+
+
+def extract_build_id(body):
+    """Pull the Next.js buildId straight out of raw homepage HTML bytes.
+
+    The first HEAD_BYTES are scanned first and the whole body only if they
+    hold no buildId. Within them, only the bytes after the __NEXT_DATA__
+    marker are scanned for the buildId key, falling back to the build
+    manifest script URL, so no DOM is built and the (large) __NEXT_DATA__
+    JSON is never decoded. Returns None if no buildId is found.
+    """
+    if len(body) > HEAD_BYTES:
+        build_id = find_build_id(body[:HEAD_BYTES])
+        if build_id is not None:
+            return build_id
+    return find_build_id(body)
+
+
+def find_build_id(body):
+    """The buildId of the __NEXT_DATA__ script, else of the build manifest URL, in body, or None."""
+    start = body.find(b'__NEXT_DATA__')
+    if start != -1:
+        # bytes.find is much faster than a regex scan over the whole script
+        key = body.find(b'"buildId"', start)
+        while key != -1:
+            match = BUILD_ID_PATTERN.match(body, key)
+            if match:
+                return match.group(1).decode('utf-8')
+            key = body.find(b'"buildId"', key + 1)
+
+    match = BUILD_MANIFEST_PATTERN.search(body)
+    if match:
+        return match.group(1).decode('utf-8')
+    return None
+
+
+class BuildIdCache:
+    """Last known Next.js buildId on disk, plus a product URL to cheaply check it is still live."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('BUILD_ID_CACHE_PATH'))
+
+    def load(self):
+        """Return the cached record (build_id, probe_slug, probe_store_id, saved_at) or None."""
+        try:
+            with open(self.path) as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return record if record.get('build_id') else None
+
+    def save(self, build_id, probe_slug=None, probe_store_id=None):
+        record = {
+            'build_id': build_id,
+            'probe_slug': probe_slug,
+            'probe_store_id': probe_store_id,
+            'saved_at': time.time(),
+        }
+        # Write atomically, several workers may share the file
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self.path)
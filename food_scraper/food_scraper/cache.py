@@ -0,0 +1,107 @@
+import hashlib
+import json
+import sqlite3
+import time
+from collections import namedtuple
+
+
+# details is None for products that were dropped (negative result)
+CachedDetails = namedtuple('CachedDetails', ['details', 'store_fields'])
+
+
+class ProductDetailCache:
+    """Persistent SQLite cache of parsed product details for incremental crawls.
+
+    Store-independent details are keyed by slug. Each (store_id, slug) listing row
+    is stamped with a fingerprint of the listing data it was fetched for, so a
+    cached entry is only used while that store's listing row is unchanged and
+    the details are younger than the TTL. Listing rows written while details
+    were shared across stores have no store-specific fields (those came from
+    the listing), so they are only served to runs that share details too.
+    """
+
+    # Bumped whenever the cached payload format changes; older caches are dropped.
+    # 2: payloads hold final ProductItem values instead of raw detail values
+    # 3: store_fields is NULL for listing rows cached while sharing details
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path, ttl, commit_every=500):
+        self.path = path
+        self.ttl = ttl
+        self.commit_every = commit_every
+        self.pending_writes = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.connection.execute('DROP TABLE IF EXISTS details')
+            self.connection.execute('DROP TABLE IF EXISTS listings')
+            self.connection.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS details ('
+            'slug TEXT PRIMARY KEY, payload TEXT, fetched_at REAL NOT NULL)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS listings ('
+            'store_id INTEGER NOT NULL, slug TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+            'store_fields TEXT, PRIMARY KEY (store_id, slug)) WITHOUT ROWID')
+        self.connection.commit()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('DETAIL_CACHE_PATH'),
+                   settings.getfloat('DETAIL_CACHE_TTL'))
+
+    @staticmethod
+    def fingerprint(product):
+        """Fingerprint the listing fields that signal a product has changed."""
+        listing = [product.get('name'), product.get('regularPrice'),
+                   product.get('slug'), product.get('brand')]
+        return hashlib.sha1(json.dumps(listing).encode('utf-8')).hexdigest()
+
+    def get(self, store_id, slug, fingerprint, need_store_fields=True):
+        """Return CachedDetails for a fresh entry matching the listing fingerprint, otherwise None.
+
+        With need_store_fields, entries cached without store-specific fields
+        are misses, unless they remember a dropped product.
+        """
+        row = self.connection.execute(
+            'SELECT d.payload, d.fetched_at, l.store_fields FROM listings l '
+            'JOIN details d ON d.slug = l.slug '
+            'WHERE l.store_id = ? AND l.slug = ? AND l.fingerprint = ?',
+            (store_id, slug, fingerprint)).fetchone()
+        if row is None:
+            return None
+
+        payload, fetched_at, store_fields = row
+        if time.time() - fetched_at > self.ttl:
+            return None
+
+        if store_fields is None and need_store_fields and payload is not None:
+            return None
+        details = json.loads(payload) if payload is not None else None
+        return CachedDetails(details, json.loads(store_fields) if store_fields is not None else {})
+
+    def set(self, store_id, slug, fingerprint, details, store_fields=None):
+        """Cache details for a slug (None to remember a dropped product) and the listing they belong to.
+
+        store_fields is None when the details were shared and the store's
+        fields came from its listing.
+        """
+        payload = json.dumps(details) if details is not None else None
+        self.connection.execute(
+            'INSERT OR REPLACE INTO details (slug, payload, fetched_at) VALUES (?, ?, ?)',
+            (slug, payload, time.time()))
+        self.connection.execute(
+            'INSERT OR REPLACE INTO listings (store_id, slug, fingerprint, store_fields) '
+            'VALUES (?, ?, ?, ?)',
+            (store_id, slug, fingerprint, json.dumps(store_fields) if store_fields is not None else None))
+
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
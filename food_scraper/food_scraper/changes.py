@@ -0,0 +1,185 @@
+import hashlib
+import json
+import sqlite3
+
+from food_scraper.items import ProductItem
+
+# Fields hashed for change detection, in the order of the packed field hashes
+HASHED_FIELDS = tuple(sorted(ProductItem.fields))
+FIELD_HASH_SIZE = 4
+
+# json.dumps() with options builds a new encoder on every call
+encode_json = json.JSONEncoder(sort_keys=True, default=str).encode
+
+
+def canonical(value):
+    """Canonical JSON text of a field value, with lists sorted so reordering isn't a change."""
+    if isinstance(value, (list, tuple)):
+        if all(type(element) is str for element in value):
+            return encode_json(sorted(value))
+        return '[' + ','.join(sorted(canonical(element) for element in value)) + ']'
+    return encode_json(value)
+
+
+def field_hashes(item):
+    """Packed 4-byte hashes of every HASHED_FIELDS value of an item (as a dict)."""
+    return b''.join(
+        hashlib.blake2b(canonical(item.get(field)).encode('utf-8'), digest_size=FIELD_HASH_SIZE).digest()
+        for field in HASHED_FIELDS)
+
+
+def changed_fields(old_hashes, new_hashes):
+    """Names of the fields whose hashes differ."""
+    return [field for index, field in enumerate(HASHED_FIELDS)
+            if old_hashes[index * FIELD_HASH_SIZE:(index + 1) * FIELD_HASH_SIZE]
+            != new_hashes[index * FIELD_HASH_SIZE:(index + 1) * FIELD_HASH_SIZE]]
+
+
+class ChangeIndex:
+    """On-disk index of product content hashes, diffed run against run.
+
+    Holds an 8-byte content hash and the packed per-field hashes of every
+    (store_id, slug) of the last complete run in `previous`. A run writes
+    its own hashes to `current` in batches, looking each batch up against
+    `previous` with one join, so only a batch is held in memory. At the
+    end of a run, removed() lists what disappeared and finish() makes
+    `current` the new `previous`.
+    """
+
+    # Bumped whenever the hashes change meaning; older indexes are dropped
+    SCHEMA_VERSION = 1
+
+    # Products of the previous run that this run didn't see
+    MISSING = ('FROM previous p WHERE NOT EXISTS ('
+               'SELECT 1 FROM current c WHERE c.store_id = p.store_id AND c.slug = p.slug)')
+    # ... in a (store_id, category) this run listed
+    IN_SCOPE = ('EXISTS (SELECT 1 FROM temp.scope s '
+                'WHERE s.store_id = p.store_id AND s.category IS p.category)')
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA temp_store=MEMORY')
+        # The packed field hashes depend on ProductItem's fields too
+        version = (self.SCHEMA_VERSION << 16) | int.from_bytes(
+            hashlib.blake2b(' '.join(HASHED_FIELDS).encode('utf-8'), digest_size=2).digest(), 'big')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != version:
+            self.connection.execute('DROP TABLE IF EXISTS previous')
+            self.connection.execute('DROP TABLE IF EXISTS current')
+            self.connection.execute(f'PRAGMA user_version = {version}')
+        self.connection.execute(self.table_sql('previous'))
+        self.connection.execute(
+            'CREATE TEMP TABLE batch (store_id INTEGER NOT NULL, slug TEXT NOT NULL, category TEXT, '
+            'digest BLOB NOT NULL, fields BLOB NOT NULL, position INTEGER NOT NULL, '
+            'PRIMARY KEY (store_id, slug)) WITHOUT ROWID')
+        # (store_id, category) listings this run requested, the scope of removal detection
+        self.connection.execute(
+            'CREATE TEMP TABLE scope (store_id INTEGER NOT NULL, category TEXT, '
+            'UNIQUE (store_id, category))')
+        self.pending = []
+
+    @staticmethod
+    def table_sql(name):
+        return (f'CREATE TABLE IF NOT EXISTS {name} ('
+                'store_id INTEGER NOT NULL, slug TEXT NOT NULL, category TEXT, '
+                'digest BLOB NOT NULL, fields BLOB NOT NULL, '
+                'PRIMARY KEY (store_id, slug)) WITHOUT ROWID')
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('CHANGE_INDEX_PATH'), settings.getint('CHANGE_INDEX_BATCH_SIZE'))
+
+    def start(self, resume=False):
+        """Start a run, or continue the interrupted one whose hashes are in `current`."""
+        if not resume:
+            self.connection.execute('DROP TABLE IF EXISTS current')
+        self.connection.execute(self.table_sql('current'))
+
+    def add(self, item):
+        """Queue an item (as a dict). Returns the diffs of the batch it completes, if any."""
+        self.pending.append(item)
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Diff the queued items against `previous` and record their hashes in `current`.
+
+        Returns ('added', item, None) and ('changed', item, field names) tuples.
+        """
+        if not self.pending:
+            return []
+        rows = []
+        for position, item in enumerate(self.pending):
+            fields = field_hashes(item)
+            rows.append((item.get('store_id'), item.get('slug'), item.get('category'),
+                         hashlib.blake2b(fields, digest_size=8).digest(), fields, position))
+
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # The last item of a (store_id, slug) seen twice in a batch wins
+            connection.executemany('INSERT OR REPLACE INTO batch VALUES (?, ?, ?, ?, ?, ?)', rows)
+            diffs = connection.execute(
+                'SELECT b.position, b.fields, p.fields FROM temp.batch b '
+                'LEFT JOIN previous p ON p.store_id = b.store_id AND p.slug = b.slug '
+                'WHERE p.digest IS NULL OR p.digest != b.digest ORDER BY b.position').fetchall()
+            connection.execute(
+                'INSERT OR REPLACE INTO current SELECT store_id, slug, category, digest, fields FROM temp.batch')
+            connection.execute('DELETE FROM temp.batch')
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        changes = []
+        for position, new_fields, old_fields in diffs:
+            item = self.pending[position]
+            if old_fields is None:
+                changes.append(('added', item, None))
+            else:
+                changes.append(('changed', item, changed_fields(old_fields, new_fields)))
+        self.pending = []
+        return changes
+
+    def add_scope(self, listings):
+        """Add the (store_id, category) listings this run requested to the scope of removed().
+
+        The scope comes from the requests, not the items, so a category whose
+        products all disappeared still has them reported as removed.
+        """
+        self.connection.executemany('INSERT OR IGNORE INTO temp.scope VALUES (?, ?)', listings)
+
+    def removed(self):
+        """Yield (store_id, slug, category) of every product of the previous run
+        missing from a (store_id, category) this run listed. Call after flush() and add_scope()."""
+        yield from self.connection.execute(
+            f'SELECT p.store_id, p.slug, p.category {self.MISSING} AND {self.IN_SCOPE} '
+            'ORDER BY p.store_id, p.slug')
+
+    def finish(self, drop_removed=True):
+        """Make this run's hashes the ones the next run is compared against.
+
+        Products missing from this run are kept as they were, except for the
+        removed() ones when drop_removed is set. Call after flush().
+        """
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if drop_removed:
+                connection.execute(f'INSERT INTO current SELECT p.* {self.MISSING} AND NOT {self.IN_SCOPE}')
+            else:
+                connection.execute(f'INSERT INTO current SELECT p.* {self.MISSING}')
+            connection.execute('DROP TABLE previous')
+            connection.execute('ALTER TABLE current RENAME TO previous')
+            connection.execute('DELETE FROM temp.scope')
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,144 @@
+import os
+import pickle
+import time
+
+from scrapy.extensions.feedexport import FileFeedStorage
+from scrapy.utils.request import request_from_dict
+
+
+def item_key(item):
+    """Identity of a feed row: one store row per store, one product or price row per store and slug."""
+    return (type(item).__name__, item.get('store_id'), item.get('slug'))
+
+
+class CrawlCheckpoint:
+    """Crash-safe snapshot of a running crawl, for resuming it after the process dies.
+
+    Every scheduled request is tracked until it leaves the downloader for
+    good, so the scheduler queue, in-flight downloads and retries waiting out
+    their backoff are all covered. Rows written to the checkpoint feeds are
+    tracked by item_key. save() flushes the feeds and atomically replaces
+    checkpoint.pickle with the outstanding requests, the feed lengths and the
+    spider's own state; CheckpointMiddleware only calls it while no response
+    is being processed, so a completed request's callback has always run.
+
+    A resumed crawl truncates the feeds back to their length at the last
+    checkpoint, re-issues the outstanding requests and drops items that were
+    already written, so its feeds end up the same as an uninterrupted run's.
+    """
+
+    filename = 'checkpoint.pickle'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.filename)
+        snapshot = self.load()
+        if snapshot is not None and snapshot['finished']:
+            # The crawl in this directory completed, start a new one
+            snapshot = None
+        self.resumed = snapshot is not None
+        snapshot = snapshot or {}
+
+        # checkpoint id -> Request.to_dict() of every request not completed yet
+        self.requests = snapshot.get('requests', {})
+        self.next_id = snapshot.get('next_id', 0)
+        # item_key() of every row in the feeds
+        self.emitted = snapshot.get('emitted', set())
+        # feed path -> length at the last checkpoint
+        self.feed_sizes = snapshot.get('feed_sizes', {})
+        self.spider_state = snapshot.get('spider_state', {})
+        self.feed_paths = set()
+        self.feed_files = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def track(self, request, spider):
+        """Remember a scheduled request until it completes; retries keep the id of their first attempt."""
+        checkpoint_id = request.meta.get('checkpoint_id')
+        if checkpoint_id is None:
+            checkpoint_id = request.meta['checkpoint_id'] = self.next_id
+            self.next_id += 1
+        if checkpoint_id not in self.requests:
+            record = request.to_dict(spider=spider)
+            # Later meta changes (download slot, proxy routing) aren't part of the request
+            record['meta'] = dict(record['meta'])
+            self.requests[checkpoint_id] = record
+
+    def complete(self, request):
+        self.requests.pop(request.meta.get('checkpoint_id'), None)
+
+    def pending_requests(self, spider):
+        """Rebuild the requests that were outstanding at the last checkpoint, oldest first."""
+        for checkpoint_id in sorted(self.requests):
+            yield request_from_dict(self.requests[checkpoint_id], spider=spider)
+
+    def accepts(self, item):
+        """Whether an item isn't in the feeds yet."""
+        return item_key(item) not in self.emitted
+
+    def item_written(self, item):
+        self.emitted.add(item_key(item))
+
+    def register_feed(self, path):
+        """Cut a feed file back to its length at the last checkpoint (empty for a new crawl)."""
+        self.feed_paths.add(path)
+        if os.path.exists(path):
+            os.truncate(path, self.feed_sizes.get(path, 0))
+
+    def open_feed(self, path):
+        f = open(path, 'ab')
+        self.feed_files[path] = f
+        return f
+
+    def save(self, spider_state, finished=False):
+        """Flush the feeds and atomically write the checkpoint."""
+        for f in self.feed_files.values():
+            if not f.closed:
+                f.flush()
+                os.fsync(f.fileno())
+        for path in self.feed_paths:
+            if os.path.exists(path):
+                self.feed_sizes[path] = os.path.getsize(path)
+
+        snapshot = {
+            'requests': self.requests,
+            'next_id': self.next_id,
+            'emitted': self.emitted,
+            'feed_sizes': self.feed_sizes,
+            'spider_state': spider_state,
+            'finished': finished,
+            'saved_at': time.time(),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class CheckpointFeedStorage(FileFeedStorage):
+    """Local feed file of a checkpointed crawl, appended to across resumes.
+
+    Registered for checkpoint:<path> URIs (see CHECKPOINT_FEEDS).
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler, uri, *, feed_options=None):
+        return cls(uri, crawler.spider.checkpoint_store, feed_options=feed_options)
+
+    def __init__(self, uri, checkpoint, *, feed_options=None):
+        self.path = uri.split(':', 1)[1]
+        self.write_mode = 'ab'
+        self.checkpoint = checkpoint
+        checkpoint.register_feed(self.path)
+
+    def open(self, spider):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        return self.checkpoint.open_feed(self.path)
@@ -0,0 +1,273 @@
+"""Columnar Parquet output for ProductItems.
+
+Requires the optional ``pyarrow`` package. Products are written as a
+Hive-partitioned dataset, one directory per run date, store and category:
+
+    <dir>/products/run_date=2026-10-17/store_id=10509/category=Produce/part-<run_id>-00000.parquet
+    <dir>/nutrition/run_date=2026-10-17/store_id=10509/category=Produce/part-<run_id>-00000.parquet
+
+``products`` has one row per ProductItem without its nutrition_elements,
+which go to the long-format ``nutrition`` table, one row per element, keyed
+by (store_id, slug). Low-cardinality strings (brand, categories, nutrient
+keys and units) are dictionary-encoded. The partition columns are only in
+the directory names; read_products() and read_nutrition() add them back.
+"""
+import json
+import os
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+
+PRODUCT_SCHEMA = pa.schema([
+    ('slug', pa.string()),
+    ('name', pa.string()),
+    ('price', pa.float64()),
+    ('brand', DICTIONARY),
+    ('asin', pa.string()),
+    ('amazon_product_id', pa.string()),
+    ('rank', pa.int64()),
+    ('is_available', pa.bool_()),
+    ('category_2', DICTIONARY),
+    ('category_3', DICTIONARY),
+    ('listed_categories', pa.list_(pa.string())),
+    ('diets', pa.list_(pa.string())),
+    ('ingredients', pa.list_(pa.string())),
+    ('allergens', pa.list_(pa.string())),
+    ('additives', pa.list_(pa.string())),
+    ('certifications', pa.list_(pa.string())),
+    ('nutrition_group', DICTIONARY),
+    ('nutrition_label_format', DICTIONARY),
+    # JSON text, its keys vary between products
+    ('serving_info', pa.string()),
+    ('is_alcoholic', pa.bool_()),
+    ('unit_of_measure', DICTIONARY),
+    ('image', pa.string()),
+    ('related_products', pa.list_(pa.string())),
+])
+
+NUTRITION_SCHEMA = pa.schema([
+    ('slug', pa.string()),
+    ('key', DICTIONARY),
+    ('name', DICTIONARY),
+    ('unit_of_measure', DICTIONARY),
+    ('amount_per_serving', pa.float64()),
+    ('recommended_daily_value', pa.float64()),
+])
+
+PARTITIONING = ds.partitioning(pa.schema([
+    ('run_date', pa.string()),
+    ('store_id', pa.int64()),
+    ('category', pa.string()),
+]), flavor='hive')
+
+# Directory name pyarrow reads back as a null partition value
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def to_float(value):
+    """Numeric value as a float, None if it isn't a number."""
+    if type(value) is float:
+        return value
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_int(value):
+    value = to_float(value)
+    return int(value) if value is not None else None
+
+
+def to_strings(values):
+    """List field as strings: names of {'name': ...} objects, other objects as JSON."""
+    if values is None:
+        return None
+    if all(type(value) is str for value in values):
+        return values
+    strings = []
+    for value in values:
+        if isinstance(value, dict) and 'name' in value:
+            value = value['name']
+        strings.append(value if isinstance(value, str) or value is None else json.dumps(value))
+    return strings
+
+
+def product_values(item):
+    """Products table values of a ProductItem (as a dict), in PRODUCT_SCHEMA order."""
+    serving_info = item.get('serving_info')
+    return (
+        item.get('slug'),
+        item.get('name'),
+        to_float(item.get('price')),
+        item.get('brand'),
+        item.get('asin'),
+        item.get('amazon_product_id'),
+        to_int(item.get('rank')),
+        item.get('is_available'),
+        item.get('category_2'),
+        item.get('category_3'),
+        item.get('listed_categories'),
+        to_strings(item.get('diets')),
+        to_strings(item.get('ingredients')),
+        to_strings(item.get('allergens')),
+        to_strings(item.get('additives')),
+        to_strings(item.get('certifications')),
+        item.get('nutrition_group'),
+        item.get('nutrition_label_format'),
+        json.dumps(serving_info) if serving_info is not None else None,
+        item.get('is_alcoholic'),
+        item.get('unit_of_measure'),
+        item.get('image'),
+        to_strings(item.get('related_products')),
+    )
+
+
+def partition_path(run_date, store_id, category):
+    """Relative directory of a partition."""
+    return os.path.join(
+        f'run_date={run_date}',
+        f'store_id={store_id if store_id is not None else NULL_PARTITION}',
+        f"category={quote(category, safe='') if category else NULL_PARTITION}")
+
+
+class PartitionBuffer:
+    """Rows of one (run date, store, category) partition waiting to be written, column by column."""
+    __slots__ = ('products', 'nutrition', 'rows')
+
+    def __init__(self):
+        self.products = [[] for _ in PRODUCT_SCHEMA]
+        self.nutrition = [[] for _ in NUTRITION_SCHEMA]
+        self.rows = 0
+
+    def add(self, item):
+        for column, value in zip(self.products, product_values(item)):
+            column.append(value)
+        self.rows += 1
+
+        elements = item.get('nutrition_elements')
+        if elements:
+            slugs, keys, names, units, amounts, daily_values = self.nutrition
+            slug = item.get('slug')
+            for element in elements:
+                slugs.append(slug)
+                keys.append(element.get('key'))
+                names.append(element.get('name'))
+                units.append(element.get('unit_of_measure'))
+                amounts.append(to_float(element.get('amount_per_serving')))
+                daily_values.append(to_float(element.get('recommended_daily_value')))
+
+    def tables(self):
+        """The buffered products and nutrition tables."""
+        return (pa.Table.from_arrays(self.products, schema=PRODUCT_SCHEMA),
+                pa.Table.from_arrays(self.nutrition, schema=NUTRITION_SCHEMA))
+
+    def __len__(self):
+        return self.rows
+
+
+class ParquetProductWriter:
+    """Buffer ProductItems per partition and write them as Parquet files.
+
+    A partition is written once it holds `batch_rows` products, and the
+    largest partitions are written early whenever more than
+    `max_buffered_rows` products are buffered in total, so memory stays
+    bounded however many stores and categories a crawl covers.
+    """
+
+    def __init__(self, directory, run_id, run_date, batch_rows, max_buffered_rows,
+                 compression='zstd'):
+        self.directory = directory
+        self.run_id = run_id
+        self.run_date = run_date
+        self.batch_rows = batch_rows
+        self.max_buffered_rows = max_buffered_rows
+        self.compression = compression
+        self.buffers = {}
+        self.buffered_rows = 0
+        self.next_part = 0
+        self.files_written = 0
+        self.product_rows_written = 0
+        self.nutrition_rows_written = 0
+
+    @classmethod
+    def from_settings(cls, settings, run_id, run_date):
+        return cls(settings.get('COLUMNAR_EXPORT_DIR'), run_id, run_date,
+                   settings.getint('COLUMNAR_BATCH_ROWS'),
+                   settings.getint('COLUMNAR_MAX_BUFFERED_ROWS'),
+                   settings.get('COLUMNAR_COMPRESSION'))
+
+    def add(self, item):
+        partition = (item.get('store_id'), item.get('category'))
+        buffer = self.buffers.get(partition)
+        if buffer is None:
+            buffer = self.buffers[partition] = PartitionBuffer()
+        buffer.add(item)
+        self.buffered_rows += 1
+
+        if len(buffer) >= self.batch_rows:
+            self.flush(partition)
+        elif self.buffered_rows > self.max_buffered_rows:
+            # Write the largest partitions until half the limit is buffered
+            for partition in sorted(self.buffers, key=lambda key: len(self.buffers[key]), reverse=True):
+                self.flush(partition)
+                if self.buffered_rows <= self.max_buffered_rows // 2:
+                    break
+
+    def flush(self, partition):
+        """Write the buffered rows of a partition to one products and one nutrition file."""
+        buffer = self.buffers.pop(partition)
+        self.buffered_rows -= len(buffer)
+        path = partition_path(self.run_date, *partition)
+        filename = f'part-{self.run_id}-{self.next_part:05d}.parquet'
+        self.next_part += 1
+
+        products, nutrition = buffer.tables()
+        self.write_table(products, os.path.join(self.directory, 'products', path, filename))
+        self.write_table(nutrition, os.path.join(self.directory, 'nutrition', path, filename))
+        self.product_rows_written += products.num_rows
+        self.nutrition_rows_written += nutrition.num_rows
+
+    def write_table(self, table, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Dot files are skipped by dataset readers, which never see a half-written file
+        tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp')
+        dictionary_columns = [field.name for field in table.schema
+                              if pa.types.is_dictionary(field.type)]
+        pq.write_table(table, tmp_path, compression=self.compression,
+                       use_dictionary=dictionary_columns)
+        os.replace(tmp_path, path)
+        self.files_written += 1
+
+    def close(self):
+        for partition in list(self.buffers):
+            self.flush(partition)
+
+
+def read_dataset(path, columns=None, filter=None):
+    table = ds.dataset(path, format='parquet', partitioning=PARTITIONING).to_table(
+        columns=columns, filter=filter)
+    if 'category' in table.column_names:
+        index = table.column_names.index('category')
+        table = table.set_column(index, 'category', table.column('category').dictionary_encode())
+    return table
+
+
+def read_products(directory, columns=None, filter=None):
+    """Load the products table of a columnar export as a pyarrow Table.
+
+    `filter` is a pyarrow.dataset expression, e.g. ds.field('store_id') == 10509,
+    and only the matching partitions are read.
+    """
+    return read_dataset(os.path.join(directory, 'products'), columns, filter)
+
+
+def read_nutrition(directory, columns=None, filter=None):
+    """Load the long-format nutrition table of a columnar export as a pyarrow Table."""
+    return read_dataset(os.path.join(directory, 'nutrition'), columns, filter)
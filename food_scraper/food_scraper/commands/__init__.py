@@ -0,0 +1 @@
+# Custom scrapy commands for the food_scraper project (see COMMANDS_MODULE)
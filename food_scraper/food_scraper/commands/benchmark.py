@@ -0,0 +1,203 @@
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+from food_scraper.fixtures import FixtureArchive, FixtureCatalog
+from food_scraper.spiders.wholefoods import WholeFoodsSpider
+
+# Callbacks reported even when they didn't run, so reports line up
+CALLBACKS = ('parse', 'parse_store_summary', 'parse_product_listings', 'parse_product_details')
+# CPU per call of callbacks called fewer times than this is too noisy to compare
+MIN_COMPARED_CALLS = 10
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "--fixtures FILE [options]"
+
+    def short_desc(self):
+        return "Benchmark a wholefoods crawl replayed offline from recorded fixtures"
+
+    def long_desc(self):
+        return (
+            "Crawl a fixture archive (recorded with FIXTURE_RECORD_PATH) through the "
+            "FixtureDownloadHandler, without network access, proxies or fake headers, in "
+            "a scratch directory so no cache of the project is read or written. Reports "
+            "items/s, CPU time per spider callback, peak RSS and feed sizes. With "
+            "--stores and --products, the recorded catalog is scaled up synthetically. "
+            "With --baseline, exits with status 1 when items/s, CPU per callback call "
+            "or peak RSS regressed by more than --max-regression against an earlier "
+            "--json report.")
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--fixtures", help="fixture archive to replay")
+        parser.add_argument("--stores", type=int, default=0,
+                            help="crawl this many synthetic stores instead of the recorded ones")
+        parser.add_argument("--products", type=int, default=0,
+                            help="synthetic products across all stores (with --stores)")
+        parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE",
+                            help="set spider argument (may be repeated)")
+        parser.add_argument("--json", dest="json_path", help="also write the report to this JSON file")
+        parser.add_argument("--baseline", help="JSON report to compare against")
+        parser.add_argument("--max-regression", type=float, default=0.2,
+                            help="largest tolerated regression against --baseline (default: 0.2)")
+        parser.add_argument("--keep", metavar="DIR",
+                            help="run in DIR and keep its feeds instead of a temporary directory")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        if not opts.fixtures:
+            raise UsageError("--fixtures is required", print_help=False)
+        if not os.path.exists(opts.fixtures):
+            raise UsageError(f"No fixture archive at {opts.fixtures}", print_help=False)
+        if bool(opts.stores) != bool(opts.products):
+            raise UsageError("--stores and --products go together", print_help=False)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError("Invalid -a value, use -a NAME=VALUE", print_help=False)
+
+        opts.fixtures = os.path.abspath(opts.fixtures)
+        for name in ('json_path', 'baseline'):
+            if getattr(opts, name):
+                setattr(opts, name, os.path.abspath(getattr(opts, name)))
+
+        archive = FixtureArchive(opts.fixtures)
+        try:
+            catalog = FixtureCatalog(archive)
+        finally:
+            archive.close()
+        if not catalog.category_products:
+            raise UsageError(f"No listing pages recorded in {opts.fixtures}", print_help=False)
+        if opts.stores:
+            store_ids = range(10000, 10000 + opts.stores)
+        else:
+            store_ids = sorted(catalog.store_ids)
+        opts.spargs.setdefault('store_ids', ','.join(map(str, store_ids)))
+        opts.spargs.setdefault('categories', ','.join(catalog.categories()))
+
+        handler = 'food_scraper.fixtures.FixtureDownloadHandler'
+        middlewares = self.settings.getdict('DOWNLOADER_MIDDLEWARES')
+        middlewares['food_scraper.middlewares.ScrapeOpsFakeBrowserHeadersMiddleware'] = None
+        for name, value in {
+            'DOWNLOAD_HANDLERS': {'http': handler, 'https': handler},
+            'DOWNLOADER_MIDDLEWARES': middlewares,
+            'FIXTURE_REPLAY_PATH': opts.fixtures,
+            'FIXTURE_SYNTHETIC_STORES': opts.stores,
+            'FIXTURE_SYNTHETIC_PRODUCTS': opts.products,
+            'FIXTURE_RECORD_PATH': None,
+            'CALLBACK_PROFILE_ENABLED': True,
+            'SCRAPEOPS_PROXY_ENABLED': False,
+            # Replayed responses are instant, there is no server to adapt to
+            'ADAPTIVE_CONCURRENCY_ENABLED': False,
+            'DETAIL_CACHE_ENABLED': False,
+        }.items():
+            self.settings.set(name, value, priority='cmdline')
+        if not opts.loglevel:
+            self.settings.set('LOG_LEVEL', 'WARNING', priority='cmdline')
+
+        # Feeds, caches, dead letters and the stats file all use relative paths
+        if opts.keep:
+            os.makedirs(opts.keep, exist_ok=True)
+            self.work_dir = os.path.abspath(opts.keep)
+        else:
+            self.work_dir = tempfile.mkdtemp(prefix='food_scraper_benchmark_')
+        os.chdir(self.work_dir)
+
+    def run(self, args, opts):
+        try:
+            crawler = self.crawler_process.create_crawler(WholeFoodsSpider.name)
+            started = time.perf_counter()
+            self.crawler_process.crawl(crawler, **opts.spargs)
+            self.crawler_process.start()
+            elapsed = time.perf_counter() - started
+            report = self.report(crawler, opts, elapsed)
+        finally:
+            if not opts.keep:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        self.print_report(report)
+        if opts.json_path:
+            with open(opts.json_path, 'w') as f:
+                json.dump(report, f, indent=4)
+        if opts.baseline:
+            with open(opts.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare(report, baseline, opts.max_regression)
+            for regression in regressions:
+                print(f"REGRESSION {regression}")
+            if regressions:
+                self.exitcode = 1
+
+    def report(self, crawler, opts, elapsed):
+        stats = crawler.stats.get_stats()
+        items = stats.get('item_scraped_count', 0)
+        callbacks = {name: {'seconds': 0.0, 'calls': 0} for name in CALLBACKS}
+        for key, value in stats.items():
+            if key.startswith('callback_cpu/'):
+                _, name, field = key.split('/')
+                callbacks.setdefault(name, {'seconds': 0.0, 'calls': 0})[field] = value
+        feeds = {}
+        for uri in crawler.settings.getdict('FEEDS'):
+            if os.path.exists(uri):
+                feeds[uri] = os.path.getsize(uri)
+        return {
+            'fixtures': opts.fixtures,
+            'stores': len(opts.spargs['store_ids'].split(',')),
+            'synthetic_products': opts.products,
+            'items': items,
+            'seconds': round(elapsed, 3),
+            'items_per_second': round(items / elapsed, 1) if elapsed else 0,
+            'requests': stats.get('downloader/request_count', 0),
+            'fixtures_missing': stats.get('fixtures/missing', 0),
+            'callbacks': {name: {'seconds': round(values['seconds'], 4), 'calls': values['calls']}
+                          for name, values in callbacks.items()},
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'feed_bytes': feeds,
+        }
+
+    @staticmethod
+    def print_report(report):
+        print(f"{report['items']} items from {report['requests']} requests in {report['seconds']:.2f}s: "
+              f"{report['items_per_second']:.0f} items/s")
+        print(f"  {'callback':<24} {'cpu s':>8} {'calls':>7} {'ms/call':>8}")
+        for name, values in report['callbacks'].items():
+            per_call = values['seconds'] / values['calls'] * 1000 if values['calls'] else 0
+            print(f"  {name:<24} {values['seconds']:8.3f} {values['calls']:>7} {per_call:8.3f}")
+        print(f"  peak RSS {report['peak_rss_mib']:.0f} MiB")
+        for uri, size in report['feed_bytes'].items():
+            print(f"  {uri} {size / 1024:.0f} KiB")
+        if report['fixtures_missing']:
+            print(f"  {report['fixtures_missing']} requests were not in the fixtures and got a 404")
+
+
+def per_call(values):
+    if values.get('calls', 0) < MIN_COMPARED_CALLS:
+        return None
+    return values['seconds'] / values['calls']
+
+
+def compare(report, baseline, tolerance):
+    """Describe every measure of a report that regressed by more than tolerance against a baseline."""
+    regressions = []
+    if baseline.get('items_per_second') and \
+            report['items_per_second'] < baseline['items_per_second'] * (1 - tolerance):
+        regressions.append(f"items/s {baseline['items_per_second']:.0f} -> {report['items_per_second']:.0f}")
+    for name, values in report['callbacks'].items():
+        old, new = per_call(baseline.get('callbacks', {}).get(name, {})), per_call(values)
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f"{name} CPU per call {old * 1000:.3f} ms -> {new * 1000:.3f} ms")
+    if baseline.get('peak_rss_mib') and report['peak_rss_mib'] > baseline['peak_rss_mib'] * (1 + tolerance):
+        regressions.append(f"peak RSS {baseline['peak_rss_mib']:.0f} MiB -> {report['peak_rss_mib']:.0f} MiB")
+    return regressions
@@ -0,0 +1,111 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+from food_scraper.frontier import expand_work_units, merge_worker_feeds, open_frontier
+from food_scraper.spiders.wholefoods import WholeFoodsSpider
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Split a wholefoods crawl into (store, category) units and run worker processes over them"
+
+    def long_desc(self):
+        return (
+            "Expand store_ids x categories into work units in a shared frontier, run "
+            "worker processes that lease them (restarting workers while units remain), "
+            "then merge the per-worker feeds. Use --join on other machines to add "
+            "workers to a frontier another coordinator filled.")
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                            help="number of worker processes on this machine (default: CPU count)")
+        parser.add_argument("--frontier", default=None,
+                            help="frontier URI (default: FRONTIER_URI setting)")
+        parser.add_argument("--output-dir", default="crawl_output",
+                            help="directory for per-worker and merged feeds")
+        parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE",
+                            help="spider argument passed to every worker (may be repeated)")
+        parser.add_argument("--join", action="store_true",
+                            help="work on an existing frontier instead of filling a new one")
+        parser.add_argument("--no-merge", action="store_true",
+                            help="leave per-worker feeds unmerged")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError("Invalid -a value, use -a NAME=VALUE", print_help=False)
+        if opts.workers < 1:
+            raise UsageError("--workers must be at least 1", print_help=False)
+
+    def run(self, args, opts):
+        frontier_uri = opts.frontier or self.settings.get('FRONTIER_URI')
+        frontier = open_frontier(frontier_uri)
+        os.makedirs(opts.output_dir, exist_ok=True)
+
+        # Parse store_ids/categories/mode exactly like the spider does
+        spider = WholeFoodsSpider(**opts.spargs)
+        if not opts.join:
+            if spider.select_stores:
+                spider.store_ids = spider.pick_store_ids(self.settings)
+            units = expand_work_units(
+                spider.store_ids, spider.categories,
+                include_store_summaries=spider.mode == 'full')
+            frontier.reset()
+            frontier.put(units)
+            print(f"Queued {len(units)} work units in {frontier_uri}")
+
+        self.run_workers(frontier, frontier_uri, opts)
+        frontier.close()
+
+        if not opts.no_merge:
+            for path, count in merge_worker_feeds(opts.output_dir, spider.categories).items():
+                print(f"Merged {count} rows into {path}")
+
+    def run_workers(self, frontier, frontier_uri, opts):
+        """Keep up to opts.workers worker processes running while units are available."""
+        workers = []
+        spawned = 0
+        while True:
+            workers = [worker for worker in workers if worker.poll() is None]
+            counts = frontier.counts()
+            if counts['available'] == 0 and not workers:
+                if counts['leased'] == 0:
+                    break
+                # Units leased by a dead worker become available once the lease expires
+            elif counts['available'] > 0 and len(workers) < opts.workers:
+                spawned += 1
+                workers.append(self.spawn_worker(frontier_uri, opts, spawned))
+                continue
+            time.sleep(1)
+
+        print(f"Frontier finished: {counts['done']} units done by {spawned} worker processes")
+
+    def spawn_worker(self, frontier_uri, opts, number):
+        worker_id = f'{socket.gethostname()}-{os.getpid()}-{number}'
+        command = [
+            sys.executable, '-m', 'scrapy', 'crawl', WholeFoodsSpider.name,
+            '-a', f'frontier={frontier_uri}',
+            '-a', f'worker_id={worker_id}',
+            '-a', f'output_dir={opts.output_dir}',
+            '--logfile', os.path.join(opts.output_dir, f'{worker_id}.log'),
+        ]
+        for name, value in opts.spargs.items():
+            command += ['-a', f'{name}={value}']
+        for setting in opts.set:
+            command += ['-s', setting]
+        return subprocess.Popen(command)
@@ -0,0 +1,63 @@
+import json
+import os
+from datetime import datetime
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from food_scraper.history import PriceHistory
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Query the price history recorded by PriceHistoryPipeline"
+
+    def long_desc(self):
+        return (
+            "Without options, list the recorded runs. With --slug, print the price "
+            "series of a product across stores; with --run, print every product that "
+            "was new or changed in that run. Observations are printed as JSON lines.")
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--db", default=None,
+                            help="history database (default: PRICE_HISTORY_PATH setting)")
+        parser.add_argument("--slug", help="print the observations of this product slug")
+        parser.add_argument("--store-ids", default=None,
+                            help="comma-separated stores to limit --slug to")
+        parser.add_argument("--run", type=int, help="print the changes recorded in this run")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        if opts.slug and opts.run is not None:
+            raise UsageError("Use either --slug or --run", print_help=False)
+        if opts.store_ids and not opts.slug:
+            raise UsageError("--store-ids only applies to --slug", print_help=False)
+
+    def run(self, args, opts):
+        path = opts.db or self.settings.get('PRICE_HISTORY_PATH')
+        if not os.path.exists(path):
+            raise UsageError(f"No price history at {path}", print_help=False)
+        history = PriceHistory(path)
+        try:
+            if opts.slug:
+                store_ids = [int(store_id) for store_id in opts.store_ids.split(',')] if opts.store_ids else None
+                observations = history.price_series(opts.slug, store_ids)
+            elif opts.run is not None:
+                observations = history.changes(opts.run)
+            else:
+                for run in history.runs():
+                    started = datetime.fromtimestamp(run.started_at).strftime('%Y-%m-%d %H:%M:%S')
+                    print(f"{run.run_id:>6}  {started}  {run.name}  mode={run.mode}  "
+                          f"observed={run.observed_count}  changed={run.change_count}"
+                          f"{'' if run.finished_at else '  (unfinished)'}")
+                return
+            for observation in observations:
+                print(json.dumps(observation._asdict()))
+        finally:
+            history.close()
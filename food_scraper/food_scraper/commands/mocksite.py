@@ -0,0 +1,82 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from food_scraper.mocksite import LatencyModel, MockCatalog, MockSite
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Serve a local mock of the Whole Foods site and the ScrapeOps proxy for load tests"
+
+    def long_desc(self):
+        return (
+            "Serve the homepage, store summary, listing and product detail endpoints, "
+            "plus the ScrapeOps proxy API at /v1/, from a catalog generated on the fly. "
+            "Latencies are given as fixed:MS, uniform:MIN,MAX, exponential:MEAN or "
+            "lognormal:MEDIAN,SIGMA in milliseconds. Point a crawl at the mock with "
+            "-s MOCK_SITE_URL=http://HOST:PORT. Response counts are printed every "
+            "--stats-interval seconds.")
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--host", default="127.0.0.1", help="interface to listen on (default: 127.0.0.1)")
+        parser.add_argument("--port", type=int, default=8800, help="port to listen on (default: 8800)")
+        parser.add_argument("--products", type=int, default=400,
+                            help="largest category size per store (default: 400)")
+        parser.add_argument("--latency", default="lognormal:80,0.5",
+                            help="latency of every response (default: lognormal:80,0.5)")
+        parser.add_argument("--proxy-latency", default="lognormal:400,0.6",
+                            help="extra latency of proxied responses (default: lognormal:400,0.6)")
+        parser.add_argument("--rate-429", type=float, default=0.0, help="share of responses that are 429s")
+        parser.add_argument("--rate-5xx", type=float, default=0.0, help="share of responses that are 5xx errors")
+        parser.add_argument("--block-rate", type=float, default=0.0,
+                            help="share of direct requests answered with a captcha page")
+        parser.add_argument("--rate-limit", type=float, default=0,
+                            help="direct requests per second served before 429s (default: unlimited)")
+        parser.add_argument("--rotate-build-id", type=float, default=0, metavar="SECONDS",
+                            help="deploy a new buildId every SECONDS")
+        parser.add_argument("--page-size-cap", type=int, default=60,
+                            help="most products served per listing page (default: 60)")
+        parser.add_argument("--seed", type=int, default=0, help="seed of the latency and error draws")
+        parser.add_argument("--stats-interval", type=float, default=10,
+                            help="seconds between response count lines (default: 10)")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        try:
+            opts.latency = LatencyModel.parse(opts.latency)
+            opts.proxy_latency = LatencyModel.parse(opts.proxy_latency)
+        except ValueError as e:
+            raise UsageError(str(e), print_help=False)
+        for name in ('rate_429', 'rate_5xx', 'block_rate'):
+            if not 0 <= getattr(opts, name) <= 1:
+                raise UsageError(f"--{name.replace('_', '-')} must be between 0 and 1", print_help=False)
+
+    def run(self, args, opts):
+        from twisted.internet import reactor
+        from twisted.internet.task import LoopingCall
+        from twisted.web.server import Site
+
+        site = MockSite(
+            MockCatalog(opts.products), opts.latency, opts.proxy_latency,
+            error_429_rate=opts.rate_429, error_5xx_rate=opts.rate_5xx, block_rate=opts.block_rate,
+            rate_limit=opts.rate_limit, build_id_rotation=opts.rotate_build_id,
+            page_size_cap=opts.page_size_cap, seed=opts.seed)
+        factory = Site(site)
+        # No access log, it would cost more than serving the requests
+        factory.log = lambda request: None
+        reactor.listenTCP(opts.port, factory, backlog=1024, interface=opts.host)
+
+        def print_stats():
+            count, counts = site.summary()
+            print(f"{count / opts.stats_interval:7.0f} req/s  buildId {site.build_id}  {counts}", flush=True)
+
+        LoopingCall(print_stats).start(opts.stats_interval, now=False)
+        print(f"Serving the mock site on http://{opts.host}:{opts.port}, crawl it with "
+              f"-s MOCK_SITE_URL=http://{opts.host}:{opts.port}", flush=True)
+        reactor.run()
@@ -0,0 +1,58 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.conf import arglist_to_dict
+
+from food_scraper.deadletter import DeadLetterStore
+from food_scraper.spiders.wholefoods import WholeFoodsSpider
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options] [dead_letter_file ...]"
+
+    def short_desc(self):
+        return "Re-run only the requests a wholefoods crawl recorded as dead letters"
+
+    def long_desc(self):
+        return (
+            "Read dead letter files (default: the newest file in DEAD_LETTER_DIR) and "
+            "crawl only the requests they record, writing REPLAY_FEEDS. Requests that "
+            "fail again are recorded in a new dead letter file.")
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("-a", dest="spargs", action="append", default=[], metavar="NAME=VALUE",
+                            help="set spider argument (may be repeated)")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError("Invalid -a value, use -a NAME=VALUE", print_help=False)
+
+    def run(self, args, opts):
+        paths = args
+        if not paths:
+            latest = DeadLetterStore.latest(self.settings.get('DEAD_LETTER_DIR'))
+            if latest is None:
+                raise UsageError("No dead letter files found", print_help=False)
+            paths = [latest]
+
+        # Replay in the mode the failed run used
+        modes = {record['mode'] for record in DeadLetterStore.load(paths)}
+        if not modes:
+            print(f"No dead letters in {', '.join(paths)}")
+            return
+        if len(modes) > 1 and 'mode' not in opts.spargs:
+            raise UsageError(
+                f"Dead letters come from several modes ({', '.join(sorted(modes))}), pick one with -a mode=",
+                print_help=False)
+        opts.spargs.setdefault('mode', modes.pop())
+
+        print(f"Replaying dead letters from {', '.join(paths)}")
+        self.crawler_process.crawl(
+            WholeFoodsSpider.name, replay=','.join(paths), **opts.spargs)
+        self.crawler_process.start()
@@ -0,0 +1,97 @@
+import json
+import os
+from itertools import chain
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+try:
+    from food_scraper.nutrients import feed_items
+    from food_scraper.search import SearchIndex, SearchIndexBuilder, columnar_items, parse_query
+except ImportError:
+    # numpy is optional, it's only needed for the search index
+    SearchIndex = None
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options] [QUERY]"
+
+    def short_desc(self):
+        return "Query the product search index, or build it from feeds"
+
+    def long_desc(self):
+        return (
+            "Print the product-store rows matching a query as JSON lines, cheapest first "
+            "within each store. A query combines 'ingredient:oats', 'allergen:milk', "
+            "'diet:gluten-free', 'additive:...' and 'certification:...' terms, negated "
+            "with a leading '-', with 'store:10509,10510' and 'price<5' style bounds, e.g. "
+            "\"diet:gluten-free ingredient:oats -ingredient:sugar store:10509 price<5\". "
+            "Without a query, summarize the index. The index is written by "
+            "SearchIndexPipeline at the end of a crawl; --build rebuilds it from product "
+            "feeds or a columnar export directory.")
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--index", default=None,
+                            help="search index (default: SEARCH_INDEX_PATH setting)")
+        parser.add_argument("--build", dest="build_paths", action="append", default=[], metavar="FEED",
+                            help="rebuild the index from a product feed or columnar export (may be repeated)")
+        parser.add_argument("--count", action="store_true", help="only print the number of matching rows")
+        parser.add_argument("--limit", type=int, default=None, help="print at most this many rows")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        if SearchIndex is None:
+            raise UsageError("The search index needs numpy, pip install numpy", print_help=False)
+        if len(args) > 1:
+            raise UsageError("Give the query as one argument, quote it", print_help=False)
+        if (opts.count or opts.limit is not None) and not args:
+            raise UsageError("--count and --limit need a query", print_help=False)
+        for path in opts.build_paths:
+            if not os.path.exists(path):
+                raise UsageError(f"No feed at {path}", print_help=False)
+
+    def run(self, args, opts):
+        path = opts.index or self.settings.get('SEARCH_INDEX_PATH')
+        if opts.build_paths:
+            builder = SearchIndexBuilder.from_items(chain.from_iterable(
+                columnar_items(build_path) if os.path.isdir(build_path) else feed_items(build_path)
+                for build_path in opts.build_paths))
+            size = builder.write(path)
+            print(f"Indexed {len(builder.product_ids)} products in {len(builder)} store rows, "
+                  f"{builder.term_count} terms, to {path} ({size / 2 ** 20:.1f} MiB)")
+        elif not os.path.exists(path):
+            raise UsageError(f"No search index at {path}, crawl with -s SEARCH_INDEX_ENABLED=True "
+                             f"or build it with --build product_data.json", print_help=False)
+
+        index = SearchIndex(path)
+        try:
+            if not args:
+                if not opts.build_paths:
+                    print(f"{index.product_count} products in {len(index)} rows of "
+                          f"{len(index.store_ids)} stores in {path}")
+                for field, terms in index.terms.items():
+                    common = sorted(terms, key=lambda term: -terms[term][1])[:10]
+                    print(f"  {field:<15} {len(terms):>6} terms"
+                          + (f", most common: {', '.join(f'{term} ({terms[term][1]})' for term in common)}"
+                             if common else ''))
+                return
+
+            try:
+                query = parse_query(args[0])
+            except ValueError as e:
+                raise UsageError(str(e), print_help=False)
+            try:
+                if opts.count:
+                    print(len(index.rows(**query)))
+                    return
+                rows = index.search(**query, limit=opts.limit)
+            except ValueError as e:
+                raise UsageError(str(e), print_help=False)
+            for row in rows:
+                print(json.dumps(row, ensure_ascii=False))
+        finally:
+            index.close()
@@ -0,0 +1,84 @@
+import json
+import os
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from food_scraper.stores import StoreIndex, is_open
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return "[options] [SELECTOR]"
+
+    def short_desc(self):
+        return "Query the store index, or fill it from store_data.json feeds"
+
+    def long_desc(self):
+        return (
+            "Without a selector, summarize the stores in the index (kept up to date by "
+            "StoreIndexPipeline, filled by -a mode=stores crawls) per state. With a "
+            "selector, print the stores it picks as JSON lines, the same ones "
+            "-a select_stores=SELECTOR would crawl: 'near:LAT,LON,KM', 'state:MA,NH', "
+            "'per:state' or 'per:zip3', chained with ';', plus 'all' for stores that "
+            "aren't open. --ids prints them as a store_ids value instead. --import adds "
+            "the stores of store_data.json feeds.")
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument("--db", default=None,
+                            help="store index (default: STORE_INDEX_PATH setting)")
+        parser.add_argument("--ids", action="store_true",
+                            help="print the selected store ids comma-separated")
+        parser.add_argument("--import", dest="import_paths", action="append", default=[], metavar="FILE",
+                            help="add the stores of a store_data.json feed (may be repeated)")
+
+    def process_options(self, args, opts):
+        super().process_options(args, opts)
+        if len(args) > 1:
+            raise UsageError("Give at most one selector, chain steps with ';'", print_help=False)
+        if opts.ids and not args:
+            raise UsageError("--ids needs a selector", print_help=False)
+        for path in opts.import_paths:
+            if not os.path.exists(path):
+                raise UsageError(f"No feed at {path}", print_help=False)
+
+    def run(self, args, opts):
+        path = opts.db or self.settings.get('STORE_INDEX_PATH')
+        if not os.path.exists(path) and not opts.import_paths:
+            raise UsageError(f"No store index at {path}, discover stores with "
+                             f"`scrapy crawl wholefoods -a mode=stores`", print_help=False)
+        index = StoreIndex(path, self.settings.getfloat('STORE_INDEX_CELL_DEGREES'))
+        try:
+            for import_path in opts.import_paths:
+                with open(import_path, encoding='utf-8') as f:
+                    stores = json.load(f)
+                for store in stores:
+                    index.add(store)
+                index.commit()
+                print(f"Imported {len(stores)} stores from {import_path}")
+
+            if not args:
+                states = {}
+                for store in index.stores.values():
+                    counts = states.setdefault(store.state or '?', [0, 0])
+                    counts[0] += 1
+                    counts[1] += is_open(store)
+                print(f"{len(index.stores)} stores in {path}")
+                for state, (count, open_count) in sorted(states.items()):
+                    print(f"  {state:<3} {count:>5} stores, {open_count:>5} open")
+                return
+
+            try:
+                store_ids = index.select(args[0])
+            except ValueError as e:
+                raise UsageError(str(e), print_help=False)
+            if opts.ids:
+                print(','.join(map(str, store_ids)))
+                return
+            for store_id in store_ids:
+                print(json.dumps(index.stores[store_id]._asdict()))
+        finally:
+            index.close()
@@ -0,0 +1,66 @@
+class AIMDWindow:
+    """Concurrency window with additive increase and multiplicative decrease.
+
+    Every successful response grows the window by increase / size, so it grows
+    by about `increase` requests per round trip, as long as the recent latency
+    stays within latency_tolerance times the lowest latency seen and the recent
+    error rate stays under error_tolerance. Each error (429/5xx, block, download
+    failure) multiplies it by backoff, at most once per round trip so a burst of
+    errors from one window only counts once.
+    """
+
+    # Weight of the newest sample in the latency and error rate moving averages
+    alpha = 0.1
+    # How fast the latency baseline drifts up towards the average, so it can
+    # recover when conditions change for good
+    baseline_drift = 0.01
+
+    def __init__(self, start, minimum, maximum, increase=1.0, backoff=0.5,
+                 latency_tolerance=2.0, error_tolerance=0.05):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = float(min(max(start, minimum), maximum))
+        self.increase = increase
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.error_tolerance = error_tolerance
+
+        self.base_latency = None
+        self.latency = None
+        self.error_rate = 0.0
+        self.last_decrease = None
+
+    @property
+    def concurrency(self):
+        return int(self.size)
+
+    def is_flat(self):
+        """Whether latency and errors leave room to grow the window."""
+        if self.error_rate > self.error_tolerance:
+            return False
+        return self.latency is None or self.latency <= self.base_latency * self.latency_tolerance
+
+    def record_success(self, latency=None):
+        """Record a good response and grow the window if the endpoint is keeping up."""
+        self.error_rate *= 1 - self.alpha
+        if latency is not None:
+            if self.latency is None:
+                self.latency = self.base_latency = latency
+            else:
+                self.latency += self.alpha * (latency - self.latency)
+                drifted = self.base_latency + self.baseline_drift * (self.latency - self.base_latency)
+                self.base_latency = min(latency, drifted)
+
+        if self.is_flat():
+            self.size = min(self.maximum, self.size + self.increase / self.size)
+
+    def record_error(self, now):
+        """Record a throttling or failure signal. Returns True if the window was cut."""
+        self.error_rate += self.alpha * (1 - self.error_rate)
+        round_trip = self.latency or 0
+        if self.last_decrease is not None and now - self.last_decrease < round_trip:
+            return False
+
+        self.last_decrease = now
+        self.size = max(self.minimum, self.size * self.backoff)
+        return True
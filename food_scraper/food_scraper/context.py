@@ -0,0 +1,25 @@
+from dataclasses import dataclass, replace
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class CrawlContext:
+    """Where a request sits in the store -> category -> page -> product chain.
+
+    Every request carries its own context in ``meta['crawl_context']`` so
+    callbacks never depend on spider-level state, and many stores can be
+    crawled concurrently in one process.
+    """
+    store_id: int
+    category: Optional[str] = None
+    offset: int = 0
+    limit: Optional[int] = None
+    slug: Optional[str] = None
+
+    def replace(self, **changes):
+        """Return a copy of this context with the given fields changed."""
+        return replace(self, **changes)
+
+    @classmethod
+    def from_request(cls, request):
+        return request.meta.get('crawl_context')
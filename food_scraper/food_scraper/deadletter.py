@@ -0,0 +1,75 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+
+class DeadLetterStore:
+    """Append-only record of requests that failed for good, for `scrapy replay`.
+
+    Each run appends JSON lines to its own <run_id>.jsonl file in the dead
+    letter directory: the request's endpoint, URL, crawl context and listing
+    fields, and why it failed. The first DEAD_LETTER_BODY_SAMPLE_BYTES of the
+    failing body are saved once under bodies/, named by their SHA-1, so the
+    same error page seen a thousand times is stored once and nothing is
+    overwritten.
+    """
+
+    def __init__(self, directory, run_id, body_sample_bytes):
+        self.directory = directory
+        self.path = os.path.join(directory, f'{run_id}.jsonl')
+        self.bodies_dir = os.path.join(directory, 'bodies')
+        self.body_sample_bytes = body_sample_bytes
+        self.count = 0
+        self.file = None
+
+    @classmethod
+    def from_settings(cls, settings, run_id):
+        return cls(settings.get('DEAD_LETTER_DIR'), run_id,
+                   settings.getint('DEAD_LETTER_BODY_SAMPLE_BYTES'))
+
+    def save_body(self, body):
+        """Save a capped sample of a response body and return its content address."""
+        sample = body[:self.body_sample_bytes]
+        digest = hashlib.sha1(sample).hexdigest()
+        path = os.path.join(self.bodies_dir, digest)
+        if not os.path.exists(path):
+            os.makedirs(self.bodies_dir, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(sample)
+            os.replace(tmp_path, path)
+        return digest
+
+    def add(self, record, body=None):
+        """Append a dead letter, with a sample of the failing body if there is one."""
+        record = dict(record, failed_at=time.time())
+        record['body_sample'] = self.save_body(body) if body else None
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.count += 1
+        return record['body_sample']
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @staticmethod
+    def load(paths):
+        """Yield the dead letters recorded in the given files."""
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    @staticmethod
+    def latest(directory):
+        """Return the most recently written dead letter file in a directory, or None."""
+        paths = glob.glob(os.path.join(directory, '*.jsonl'))
+        return max(paths, key=os.path.getmtime) if paths else None
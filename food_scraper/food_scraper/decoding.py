@@ -0,0 +1,189 @@
+"""Typed fast path for decoding listing and product detail JSON.
+
+Requires the optional ``msgspec`` package. Responses are decoded straight
+into the structs below, so only the fields the spider uses are materialized
+and unknown keys are skipped while parsing. Struct attributes keep the API's
+key names, and every record supports ``get`` and ``in`` like the dicts the
+stdlib decoder returns, so the spider reads both the same way.
+
+Anything that doesn't fit the schema raises msgspec.DecodeError; the spider
+then falls back to the stdlib path for that response, which keeps its output
+identical for unusual payloads too.
+"""
+from typing import Any, List, Optional, Union
+
+import msgspec
+
+from food_scraper.items import collect, process_amazon_product_id, take_first
+
+DecodeError = msgspec.DecodeError
+UNSET = msgspec.UNSET
+
+
+class Record(msgspec.Struct):
+    """Struct readable through the dict interface the spider uses."""
+
+    def get(self, key, default=None):
+        # Missing keys were already replaced by the field default while decoding
+        value = getattr(self, key, default)
+        return default if value is UNSET else value
+
+    def __contains__(self, key):
+        return getattr(self, key, UNSET) is not UNSET
+
+
+class Refinement(Record):
+    slug: Any = None
+    count: int = 0
+
+
+class Facet(Record):
+    refinements: List[Refinement] = []
+
+
+class ListingProduct(Record):
+    name: Any = None
+    slug: Any = None
+    brand: Any = None
+    regularPrice: Any = None
+    isAvailable: Any = None
+    rank: Any = None
+
+
+class ListingPage(Record):
+    results: List[ListingProduct] = []
+    facets: List[Facet] = msgspec.field(default_factory=lambda: [Facet()])
+
+
+class NutritionElement(msgspec.Struct):
+    """Nutrition element, renamed to the ProductItem keys while decoding."""
+    key: Any = None
+    name: Any = None
+    unit_of_measure: Any = msgspec.field(default=None, name='uom')
+    amount_per_serving: Any = msgspec.field(default=None, name='perServing')
+    recommended_daily_value: Any = msgspec.field(default=None, name='fullDvp')
+
+    @property
+    def is_valid(self):
+        amount = self.amount_per_serving
+        return not (amount is None or amount == 0 or amount == '' or amount == '0')
+
+
+class Category(Record):
+    name: Any = None
+    slug: Any = None
+    # UNSET (instead of None) tells a missing child apart from an explicit null,
+    # which the stdlib path fails on
+    childCategory: Union['Category', msgspec.UnsetType] = UNSET
+
+
+class Diet(msgspec.Struct):
+    name: Any = None
+
+
+class RelatedProduct(msgspec.Struct):
+    slug: Any = None
+
+
+class Image(msgspec.Struct):
+    image: Any = None
+
+
+class ProductDetail(Record):
+    name: Any = None
+    brand: Any = None
+    regularPrice: Any = None
+    asin: Any = None
+    id: Optional[str] = None
+    rank: Any = None
+    isAvailable: Any = None
+    categories: Category = msgspec.field(default_factory=Category)
+    diets: Optional[List[Diet]] = None
+    ingredients: Any = None
+    allergens: Any = None
+    additives: Any = None
+    certifications: Any = None
+    nutritionGroup: Any = None
+    nutritionLabelFormat: Any = None
+    nutritionElements: Optional[List[NutritionElement]] = None
+    servingInfo: Any = None
+    isAlcoholic: Any = None
+    uom: Any = None
+    images: Optional[List[Image]] = msgspec.field(default_factory=lambda: [Image()])
+    related: Optional[List[RelatedProduct]] = None
+
+    def __post_init__(self):
+        # Elements without an amount per serving are dropped during decode
+        if self.nutritionElements:
+            self.nutritionElements = [
+                elem for elem in self.nutritionElements if elem.is_valid]
+
+
+class PageProps(Record):
+    data: ProductDetail = msgspec.field(default_factory=ProductDetail)
+
+
+class ProductPage(Record):
+    pageProps: Union[PageProps, msgspec.UnsetType] = UNSET
+
+
+_listing_decoder = msgspec.json.Decoder(ListingPage)
+_product_decoder = msgspec.json.Decoder(ProductPage)
+
+
+def decode_listing_page(body):
+    """Decode a category listing response body."""
+    return _listing_decoder.decode(body)
+
+
+def decode_product_page(body):
+    """Decode a _next/data product detail response body."""
+    return _product_decoder.decode(body)
+
+
+def product_detail_values(detail, url_category=None):
+    """Build the ProductItem detail values for a decoded ProductDetail.
+
+    Gives the same dict as running the raw detail values through an ItemLoader
+    for ProductItem: fields are in the same order and only present when the
+    loader would set them. Returns None when the product has no valid
+    nutrition elements and should be skipped.
+    """
+    if not detail.nutritionElements:
+        return None
+
+    values = {
+        'asin': take_first(detail.asin),
+        'amazon_product_id': take_first(
+            process_amazon_product_id(detail.id) if detail.id is not None else None),
+        'rank': take_first(detail.rank),
+        'is_available': take_first(detail.isAvailable),
+    }
+
+    categories = detail.categories
+    # Fall back to the category from the listing URL
+    values['category'] = take_first(categories.name or url_category or None)
+    child_category = categories.childCategory
+    if child_category is not UNSET:
+        values['category_2'] = take_first(child_category.name)
+        if child_category.childCategory is not UNSET:
+            values['category_3'] = take_first(child_category.childCategory.name)
+
+    values['diets'] = [diet.name for diet in detail.diets] if detail.diets else None
+    values['ingredients'] = collect(detail.ingredients)
+    values['allergens'] = collect(detail.allergens)
+    values['additives'] = collect(detail.additives)
+    values['certifications'] = collect(detail.certifications)
+    values['nutrition_group'] = take_first(detail.nutritionGroup)
+    values['nutrition_label_format'] = take_first(detail.nutritionLabelFormat)
+    values['nutrition_elements'] = [
+        msgspec.structs.asdict(elem) for elem in detail.nutritionElements]
+    values['serving_info'] = take_first(detail.servingInfo)
+    values['is_alcoholic'] = take_first(detail.isAlcoholic)
+    values['unit_of_measure'] = take_first(detail.uom)
+    if detail.images:
+        values['image'] = take_first(detail.images[0].image)
+    values['related_products'] = (
+        [product.slug for product in detail.related] if detail.related else None)
+
+    return {field: value for field, value in values.items() if value is not None}
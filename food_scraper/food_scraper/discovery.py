@@ -0,0 +1,116 @@
+import hashlib
+import math
+import sqlite3
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings.
+
+    Sized for `capacity` keys at `error_rate` false positives (about 1.2 MB
+    per million keys at 1%); past its capacity it keeps working, with more
+    false positives. Bit positions come from one blake2b digest by double
+    hashing.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        """Add a key, returning whether it may have been added before."""
+        present = True
+        bits = self.bits
+        for position in self.positions(key):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                present = False
+                bits[byte] |= mask
+        return present
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class SeenProducts:
+    """(store_id, slug) pairs a crawl has seen, with the depth each was first seen at.
+
+    The exact set is a SQLite table; a BloomFilter in front of it answers
+    most lookups of new pairs without touching the disk, so memory stays at
+    the filter's size however many pairs a crawl sees. The table also keeps
+    the depth of every pair, and is the queue of pairs still to be crawled
+    at each depth.
+    """
+
+    def __init__(self, path, capacity, error_rate=0.01, resume=False):
+        self.path = path
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS seen ('
+            'store_id INTEGER NOT NULL, slug TEXT NOT NULL, depth INTEGER NOT NULL, '
+            'PRIMARY KEY (store_id, slug)) WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS seen_depth ON seen (depth)')
+        if resume:
+            for store_id, slug in self.connection.execute('SELECT store_id, slug FROM seen'):
+                self.bloom.add(self.key(store_id, slug))
+        else:
+            self.connection.execute('DELETE FROM seen')
+        self.connection.commit()
+        # Lookups the filter couldn't answer, of pairs that turned out to be new or not
+        self.false_positive_count = 0
+        self.exact_lookup_count = 0
+
+    @classmethod
+    def from_settings(cls, settings, resume=False):
+        return cls(settings.get('RELATED_SEEN_PATH'), settings.getint('RELATED_SEEN_CAPACITY'),
+                   settings.getfloat('RELATED_SEEN_ERROR_RATE'), resume)
+
+    @staticmethod
+    def key(store_id, slug):
+        return f'{store_id}/{slug}'
+
+    def add(self, store_id, slug, depth):
+        """Record a pair at a depth unless it was seen before, returning whether it is new."""
+        if self.bloom.add(self.key(store_id, slug)):
+            self.exact_lookup_count += 1
+            if self.connection.execute('SELECT 1 FROM seen WHERE store_id = ? AND slug = ?',
+                                       (store_id, slug)).fetchone():
+                return False
+            self.false_positive_count += 1
+        self.connection.execute('INSERT INTO seen (store_id, slug, depth) VALUES (?, ?, ?)',
+                                (store_id, slug, depth))
+        return True
+
+    def __contains__(self, pair):
+        store_id, slug = pair
+        if self.key(store_id, slug) not in self.bloom:
+            return False
+        return self.connection.execute('SELECT 1 FROM seen WHERE store_id = ? AND slug = ?',
+                                       (store_id, slug)).fetchone() is not None
+
+    def at_depth(self, depth):
+        """(store_id, slug) of the pairs first seen at a depth, in order."""
+        return self.connection.execute(
+            'SELECT store_id, slug FROM seen WHERE depth = ? ORDER BY store_id, slug', (depth,))
+
+    def count(self, depth=None):
+        if depth is None:
+            return self.connection.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+        return self.connection.execute('SELECT COUNT(*) FROM seen WHERE depth = ?', (depth,)).fetchone()[0]
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,53 @@
+from urllib.parse import parse_qs, urlparse
+
+
+# Endpoint classes of the Whole Foods site, cheapest-to-fetch JSON last
+ENDPOINTS = ('homepage', 'store_summary', 'listing', 'detail', 'other')
+JSON_ENDPOINTS = ('store_summary', 'listing', 'detail')
+BLOCK_STATUSES = (403, 429)
+
+
+def unwrap_proxy_url(url):
+    """Return the target URL of a ScrapeOps proxy URL, or the URL itself."""
+    parsed = urlparse(url)
+    if parsed.netloc == 'proxy.scrapeops.io':
+        return parse_qs(parsed.query).get('url', [url])[0]
+    return url
+
+
+def endpoint_for_url(url):
+    """Classify a (possibly proxied) Whole Foods URL into one of ENDPOINTS."""
+    path = urlparse(unwrap_proxy_url(url)).path
+    if path.startswith('/_next/data/'):
+        return 'detail'
+    if path.startswith('/api/products/category/'):
+        return 'listing'
+    if path.startswith('/stores/') and path.endswith('/summary'):
+        return 'store_summary'
+    if path in ('', '/'):
+        return 'homepage'
+    return 'other'
+
+
+def endpoint_for_request(request):
+    return request.meta.get('endpoint') or endpoint_for_url(request.url)
+
+
+def is_blocked_response(request, response, endpoint):
+    """Whether a response is a block: 403/429, captcha HTML from a JSON endpoint or a stub listing."""
+    if response.status in BLOCK_STATUSES:
+        return True
+
+    if endpoint in JSON_ENDPOINTS:
+        head = response.body[:2048].lstrip().lower()
+        if head.startswith(b'<') and b'captcha' in response.body.lower():
+            return True
+
+    if endpoint == 'listing':
+        # An empty first page without facets is a stub, not a real (empty) category
+        context = request.meta.get('crawl_context')
+        body = response.body.replace(b' ', b'')
+        if (context is not None and context.offset == 0
+                and b'"results":[]' in body and b'"facets"' not in body):
+            return True
+    return False
@@ -0,0 +1,194 @@
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+
+from food_scraper.endpoints import endpoint_for_request
+from food_scraper.metrics import CPU_BUCKETS, MetricsRegistry, current_rss_bytes
+
+
+class MetricsResource(Resource):
+    """Serve a MetricsRegistry in the Prometheus text format."""
+    isLeaf = True
+
+    def __init__(self, registry, before_render=None):
+        super().__init__()
+        self.registry = registry
+        self.before_render = before_render
+
+    def render_GET(self, request):
+        if request.path.rstrip(b'/') not in (b'', b'/metrics'):
+            request.setResponseCode(404)
+            return b'Not found, metrics are at /metrics\n'
+        if self.before_render is not None:
+            self.before_render()
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.registry.render().encode('utf-8')
+
+
+class MetricsExtension:
+    """Latency histograms and hot-path counters per endpoint class and proxy tier.
+
+    Fed from the engine signals, so nothing is added to the middleware chains:
+    queue wait (scheduled until handed to the downloader, across the proxy
+    rewrite), download latency, bytes downloaded, responses per status and
+    items scraped, plus the callback CPU time the CallbackProfilerMiddleware
+    measures. Pending, downloading and processing request counts and RSS are
+    sampled every METRICS_SAMPLE_INTERVAL seconds and kept as a bounded time
+    series. With METRICS_PORT set, everything is served live at
+    http://METRICS_HOST:METRICS_PORT/metrics for Prometheus; summary() is what
+    ends up in the spider's stats file. Enabled with METRICS_ENABLED.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        extension = cls(crawler)
+        for handler, signal in (
+                (extension.spider_opened, signals.spider_opened),
+                (extension.spider_closed, signals.spider_closed),
+                (extension.request_scheduled, signals.request_scheduled),
+                (extension.request_reached_downloader, signals.request_reached_downloader),
+                (extension.response_downloaded, signals.response_downloaded),
+                (extension.item_scraped, signals.item_scraped)):
+            crawler.signals.connect(handler, signal=signal)
+        return extension
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.tiers = crawler.settings.getlist('PROXY_TIERS')
+        self.host = crawler.settings.get('METRICS_HOST')
+        self.port = crawler.settings.get('METRICS_PORT')
+        self.sample_interval = crawler.settings.getfloat('METRICS_SAMPLE_INTERVAL')
+        self.max_samples = crawler.settings.getint('METRICS_MAX_SAMPLES')
+
+        self.registry = registry = MetricsRegistry('wholefoods')
+        labels = ('endpoint', 'tier')
+        self.queue_wait = registry.histogram(
+            'queue_wait_seconds', 'Time from scheduling to the downloader', labels)
+        self.download_latency = registry.histogram(
+            'download_latency_seconds', 'Time from sending a request to its full response', labels)
+        self.callback_cpu = registry.histogram(
+            'callback_cpu_seconds', 'CPU time of a spider callback per response',
+            ('endpoint', 'callback'), CPU_BUCKETS)
+        self.response_bytes = registry.counter(
+            'response_bytes_total', 'Response body bytes downloaded, before decompression', labels)
+        self.responses = registry.counter(
+            'responses_total', 'Responses downloaded', labels + ('status',))
+        self.items = registry.counter('items_total', 'Items scraped', labels)
+        self.pending = registry.gauge('pending_requests', 'Requests waiting in the scheduler')
+        self.downloading = registry.gauge('downloading_requests', 'Requests in the downloader')
+        self.processing = registry.gauge(
+            'processing_responses', 'Responses and failures being processed by the spider')
+        self.rss = registry.gauge('resident_memory_bytes', 'Resident set size of the crawl process')
+
+        self.started = None
+        # Dicts of elapsed_s, pending, downloading, processing and rss_mib
+        self.samples = []
+        self.sample_step = 1
+        self.sample_count = 0
+        self.sample_loop = None
+        self.listening_port = None
+
+    def labels(self, request):
+        tier = request.meta.get('proxy_tier')
+        return endpoint_for_request(request), self.tiers[tier] if tier is not None else 'direct'
+
+    def spider_opened(self, spider):
+        self.started = time.monotonic()
+        self.sample_loop = LoopingCall(self.sample)
+        self.sample_loop.start(self.sample_interval)
+        if self.port is not None:
+            self.listen(spider)
+
+    def listen(self, spider):
+        # Imported late, like everywhere a command may import this module
+        # before the reactor is installed
+        from twisted.internet import reactor
+        from twisted.internet.error import CannotListenError
+        from twisted.web.server import Site
+
+        factory = Site(MetricsResource(self.registry, self.sample_gauges))
+        factory.log = lambda request: None
+        try:
+            self.listening_port = reactor.listenTCP(int(self.port), factory, interface=self.host)
+        except CannotListenError as e:
+            spider.logger.warning(f"Not serving metrics: {e}")
+            return
+        address = self.listening_port.getHost()
+        spider.logger.info(f"Serving metrics on http://{address.host}:{address.port}/metrics")
+
+    def spider_closed(self, spider):
+        if self.sample_loop is not None and self.sample_loop.running:
+            self.sample_loop.stop()
+        if self.listening_port is not None:
+            self.listening_port.stopListening()
+            self.listening_port = None
+
+    def request_scheduled(self, request, spider):
+        # A request scheduled with its proxy tier already set is the proxied
+        # copy TieredProxyMiddleware made of a request just taken from the
+        # scheduler, its wait goes on. Retries and escalations are stripped of
+        # their routing and start over.
+        if 'proxy_tier' not in request.meta or 'queued_at' not in request.meta:
+            request.meta['queued_at'] = time.time()
+
+    def request_reached_downloader(self, request, spider):
+        queued_at = request.meta.pop('queued_at', None)
+        if queued_at is not None:
+            self.queue_wait.observe(self.labels(request), max(0.0, time.time() - queued_at))
+
+    def response_downloaded(self, response, request, spider):
+        labels = self.labels(request)
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.download_latency.observe(labels, latency)
+        self.response_bytes.inc(labels, len(response.body))
+        self.responses.inc(labels + (response.status,))
+
+    def item_scraped(self, item, response, spider):
+        if response is not None and response.request is not None:
+            self.items.inc(self.labels(response.request))
+
+    def observe_callback(self, request, callback, seconds):
+        """Record the CPU time of one callback call (from CallbackProfilerMiddleware)."""
+        self.callback_cpu.observe((endpoint_for_request(request), callback), seconds)
+
+    def sample_gauges(self):
+        engine = self.crawler.engine
+        # The scheduler is only reachable through the engine's private slot
+        slot = getattr(engine, '_slot', None)
+        if slot is not None and slot.scheduler is not None:
+            self.pending.set((), len(slot.scheduler))
+        self.downloading.set((), len(engine.downloader.active))
+        if engine.scraper.slot is not None:
+            self.processing.set((), len(engine.scraper.slot.active))
+        self.rss.set((), current_rss_bytes())
+
+    def sample(self):
+        """Update the gauges and keep every sample_step-th of them in the time series."""
+        self.sample_gauges()
+        self.sample_count += 1
+        if (self.sample_count - 1) % self.sample_step:
+            return
+        gauges = {name: family.series.get((), 0) for name, family in
+                  (('pending', self.pending), ('downloading', self.downloading),
+                   ('processing', self.processing))}
+        self.samples.append({'elapsed_s': round(time.monotonic() - self.started, 1), **gauges,
+                             'rss_mib': round(self.rss.series[()] / 2 ** 20, 1)})
+        if len(self.samples) >= self.max_samples:
+            # Keep the series bounded on long crawls by halving its resolution
+            self.samples = self.samples[::2]
+            self.sample_step *= 2
+
+    def summary(self):
+        """Quantiles of the histograms, totals of the counters and the sampled time series."""
+        self.sample_gauges()
+        summary = self.registry.summary()
+        summary['peak_rss_mib'] = round(
+            max([sample['rss_mib'] for sample in self.samples] + [self.rss.series[()] / 2 ** 20]), 1)
+        summary['samples'] = self.samples
+        return summary
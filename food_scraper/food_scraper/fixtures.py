@@ -0,0 +1,249 @@
+import hashlib
+import json
+import re
+import sqlite3
+import zlib
+from urllib.parse import parse_qs, urlparse
+
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from twisted.internet.task import deferLater
+from w3lib.url import canonicalize_url
+
+from food_scraper.endpoints import endpoint_for_url, unwrap_proxy_url
+from food_scraper.pagination import category_total
+
+# Suffix of the synthetic copies of a recorded product slug
+SYNTHETIC_SLUG = re.compile(r'--s(\d+)$')
+
+
+class FixtureArchive:
+    """Recorded Whole Foods responses for offline replays and benchmarks.
+
+    One SQLite file maps each canonicalized request URL to its status, final
+    URL (after Sops-Final-Url), Content-Type and body. Bodies are
+    zlib-compressed and stored once per SHA-1, so the many identical error
+    and empty listing pages of a crawl take no extra space.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS bodies (digest TEXT PRIMARY KEY, body BLOB NOT NULL) WITHOUT ROWID')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'url TEXT PRIMARY KEY, endpoint TEXT NOT NULL, status INTEGER NOT NULL, '
+            'final_url TEXT NOT NULL, content_type TEXT, digest TEXT NOT NULL) WITHOUT ROWID')
+        self.connection.commit()
+
+    @staticmethod
+    def key(url):
+        """Archive key of a (possibly proxied) request URL."""
+        return canonicalize_url(unwrap_proxy_url(url))
+
+    def add(self, url, status, final_url, content_type, body):
+        """Record a response, replacing an earlier one for the same URL (e.g. a failed attempt)."""
+        digest = hashlib.sha1(body).hexdigest()
+        self.connection.execute(
+            'INSERT OR IGNORE INTO bodies (digest, body) VALUES (?, ?)', (digest, zlib.compress(body, 9)))
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses (url, endpoint, status, final_url, content_type, digest) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (self.key(url), endpoint_for_url(url), status, final_url, content_type, digest))
+        self.connection.commit()
+
+    def get(self, url):
+        """Return (status, final_url, content_type, body) recorded for a URL, or None."""
+        row = self.connection.execute(
+            'SELECT r.status, r.final_url, r.content_type, b.body FROM responses r '
+            'JOIN bodies b ON b.digest = r.digest WHERE r.url = ?', (self.key(url),)).fetchone()
+        if row is None:
+            return None
+        status, final_url, content_type, body = row
+        return status, final_url, content_type, zlib.decompress(body)
+
+    def responses(self, endpoint):
+        """Yield (url, status, body) of every recorded response of an endpoint class."""
+        for url, status, body in self.connection.execute(
+                'SELECT r.url, r.status, b.body FROM responses r JOIN bodies b ON b.digest = r.digest '
+                'WHERE r.endpoint = ? ORDER BY r.url', (endpoint,)):
+            yield url, status, zlib.decompress(body)
+
+    def counts(self):
+        """Number of recorded responses per endpoint class."""
+        return dict(self.connection.execute(
+            'SELECT endpoint, COUNT(*) FROM responses GROUP BY endpoint'))
+
+    def close(self):
+        self.connection.close()
+
+
+class FixtureCatalog:
+    """What a fixture archive knows about the site, for answering requests it didn't record.
+
+    Built from the recorded responses: the products of every category's
+    listing pages, the largest page the API served, and one store summary
+    and one detail body per slug. With synthetic_stores / synthetic_products
+    it stands for a bigger site: every store serves the same categories, each
+    category of each store lists synthetic_products / (stores x categories)
+    products, and products past the recorded ones are copies of them with a
+    '--s<n>' slug suffix whose details are the original's.
+    """
+
+    def __init__(self, archive, synthetic_stores=0, synthetic_products=0):
+        # category -> recorded products, first seen first
+        self.category_products = {}
+        # Stores with a recorded summary or listing
+        self.store_ids = set()
+        # category -> (store_id -> recorded product count)
+        self.category_totals = {}
+        self.page_cap = 0
+        self.listing_templates = {}
+        for url, status, body in archive.responses('listing'):
+            if status != 200:
+                continue
+            data = json.loads(body)
+            category = urlparse(url).path.rsplit('/', 1)[1]
+            store_id = parse_qs(urlparse(url).query).get('store', [None])[0]
+            if store_id is not None:
+                self.store_ids.add(int(store_id))
+            products = self.category_products.setdefault(category, {})
+            for product in data.get('results', []):
+                products.setdefault(product.get('slug'), product)
+            self.page_cap = max(self.page_cap, len(data.get('results', [])))
+            total = category_total(data, category)
+            if total is not None:
+                self.category_totals.setdefault(category, {})[store_id] = total
+            self.listing_templates.setdefault(category, data)
+        self.category_products = {category: list(products.values())
+                                  for category, products in self.category_products.items()}
+
+        self.store_summary = None
+        for url, status, body in archive.responses('store_summary'):
+            if status == 200:
+                self.store_ids.add(int(urlparse(url).path.split('/')[2]))
+                self.store_summary = self.store_summary or body
+        # slug -> recorded detail URL
+        self.detail_urls = {}
+        for url, status, _ in archive.responses('detail'):
+            if status == 200:
+                self.detail_urls[urlparse(url).path.rsplit('/', 1)[1][:-len('.json')]] = url
+
+        self.synthetic_products = 0
+        if synthetic_stores and synthetic_products and self.category_products:
+            self.synthetic_products = max(
+                1, synthetic_products // (synthetic_stores * len(self.category_products)))
+
+    def categories(self):
+        return sorted(self.category_products)
+
+    def listing_total(self, category, store_id):
+        if self.synthetic_products:
+            return self.synthetic_products
+        totals = self.category_totals.get(category, {})
+        return totals.get(store_id, max(totals.values(), default=len(self.category_products[category])))
+
+    def listing_body(self, category, store_id, offset, limit):
+        """A listing page of a category, built from its recorded products."""
+        recorded = self.category_products[category]
+        total = self.listing_total(category, store_id)
+        results = []
+        for position in range(offset, min(total, offset + min(limit, self.page_cap or limit))):
+            product = recorded[position % len(recorded)]
+            copy = position // len(recorded)
+            if copy:
+                product = dict(product, slug=f"{product.get('slug')}--s{copy}")
+            results.append(dict(product, rank=position))
+        data = dict(self.listing_templates[category], results=results)
+        data['facets'] = [{'slug': 'category', 'refinements': [{'slug': category, 'count': total}]}]
+        return json.dumps(data).encode('utf-8')
+
+    def detail_url(self, slug):
+        """Recorded detail URL of a slug or of the product a synthetic slug copies."""
+        return self.detail_urls.get(SYNTHETIC_SLUG.sub('', slug))
+
+
+class FixtureDownloadHandler:
+    """Download handler answering every request from a fixture archive, without network access.
+
+    Enabled for http and https by `scrapy benchmark` (or by hand through
+    DOWNLOAD_HANDLERS) with FIXTURE_REPLAY_PATH set. Recorded URLs get their
+    recorded response; listing pages, details and store summaries that
+    weren't recorded (other page sizes, stores or synthetic products) are
+    answered from the FixtureCatalog; anything else is a 404.
+    """
+    lazy = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('FIXTURE_REPLAY_PATH')
+        if not path:
+            raise NotConfigured('FIXTURE_REPLAY_PATH is not set')
+        return cls(FixtureArchive(path), crawler.stats,
+                   crawler.settings.getint('FIXTURE_SYNTHETIC_STORES'),
+                   crawler.settings.getint('FIXTURE_SYNTHETIC_PRODUCTS'))
+
+    def __init__(self, archive, stats, synthetic_stores=0, synthetic_products=0):
+        self.archive = archive
+        self.stats = stats
+        self.catalog = FixtureCatalog(archive, synthetic_stores, synthetic_products)
+        # Synthetic listing pages are the same for every store
+        self.listing_bodies = {}
+
+    def download_request(self, request, spider):
+        # Imported late, `scrapy benchmark` imports this module before the reactor is installed
+        from twisted.internet import reactor
+
+        # Answer on the next reactor iteration, like a download that's already done
+        return deferLater(reactor, 0, self.respond, request)
+
+    def respond(self, request):
+        url = unwrap_proxy_url(request.url)
+        endpoint = endpoint_for_url(url)
+        parsed = urlparse(url)
+        recorded = None
+        if endpoint == 'listing':
+            if not self.catalog.synthetic_products:
+                recorded = self.archive.get(url)
+            if recorded is None:
+                category = parsed.path.rsplit('/', 1)[1]
+                if category in self.catalog.category_products:
+                    query = parse_qs(parsed.query)
+                    store_id = query.get('store', [None])[0]
+                    offset, limit = int(query['offset'][0]), int(query['limit'][0])
+                    key = (category, None if self.catalog.synthetic_products else store_id, offset, limit)
+                    body = self.listing_bodies.get(key)
+                    if body is None:
+                        body = self.listing_bodies[key] = self.catalog.listing_body(
+                            category, store_id, offset, limit)
+                    recorded = (200, url, 'application/json', body)
+        elif endpoint == 'detail':
+            detail_url = self.catalog.detail_url(parsed.path.rsplit('/', 1)[1][:-len('.json')])
+            if detail_url is not None:
+                status, _, content_type, body = self.archive.get(detail_url)
+                recorded = (status, url, content_type, body)
+        else:
+            recorded = self.archive.get(url)
+            if recorded is None and endpoint == 'store_summary' and self.catalog.store_summary:
+                recorded = (200, url, 'application/json', self.catalog.store_summary)
+
+        if recorded is None:
+            self.stats.inc_value('fixtures/missing')
+            status, final_url, content_type, body = 404, url, 'text/plain', b'Not recorded'
+        else:
+            status, final_url, content_type, body = recorded
+            self.stats.inc_value(f'fixtures/served/{endpoint}')
+
+        headers = Headers({'Content-Type': content_type} if content_type else {})
+        if final_url != request.url:
+            # Answer proxied requests the way the proxy does
+            headers['Sops-Final-Url'] = final_url
+        response_cls = responsetypes.from_args(headers=headers, url=final_url, body=body)
+        return response_cls(url=request.url, status=status, headers=headers, body=body,
+                            request=request)
+
+    def close(self):
+        self.archive.close()
@@ -0,0 +1,285 @@
+import glob
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+from scrapy.exporters import JsonItemExporter, JsonLinesItemExporter
+
+from food_scraper.listings import ordered_categories
+
+
+# category is None for the unit that fetches the store summary
+WorkUnit = namedtuple('WorkUnit', ['store_id', 'category'])
+
+
+def expand_work_units(store_ids, categories, include_store_summaries=True):
+    """Expand stores x categories into work units, one store summary unit per store."""
+    units = []
+    for store_id in store_ids:
+        if include_store_summaries:
+            units.append(WorkUnit(store_id, None))
+        for category in categories:
+            units.append(WorkUnit(store_id, category))
+    return units
+
+
+def open_frontier(uri):
+    """Open a frontier backend from a URI: sqlite:///path/to/file or redis://host:port/db."""
+    if uri.startswith('redis://') or uri.startswith('rediss://'):
+        return RedisFrontier(uri)
+    if uri.startswith('sqlite:///'):
+        uri = uri[len('sqlite:///'):]
+    return SQLiteFrontier(uri)
+
+
+class Frontier:
+    """Shared queue of work units leased by crawl workers.
+
+    A leased unit belongs to one worker until its lease expires. Workers extend
+    their leases with heartbeats while they run, so units held by a worker that
+    died become available again once the lease times out.
+    """
+
+    def reset(self):
+        """Remove all units."""
+        raise NotImplementedError
+
+    def put(self, units):
+        """Add work units to the queue."""
+        raise NotImplementedError
+
+    def lease(self, worker_id, count, timeout):
+        """Lease up to count available units, returning (unit_id, WorkUnit) pairs."""
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id, unit_ids, timeout):
+        """Extend the leases a worker holds on unit_ids."""
+        raise NotImplementedError
+
+    def complete(self, worker_id, unit_ids):
+        """Mark units as done. Units whose lease the worker lost are left alone."""
+        raise NotImplementedError
+
+    def counts(self):
+        """Return counts of 'available', 'leased' and 'done' units."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteFrontier(Frontier):
+    """Frontier stored in a local SQLite file, shared by worker processes on one machine."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS units ('
+            'id INTEGER PRIMARY KEY, store_id INTEGER NOT NULL, category TEXT, '
+            'state TEXT NOT NULL DEFAULT \'available\', worker_id TEXT, '
+            'lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_expires)')
+
+    def reset(self):
+        self.connection.execute('DELETE FROM units')
+
+    def put(self, units):
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.executemany(
+            'INSERT INTO units (store_id, category) VALUES (?, ?)',
+            [(unit.store_id, unit.category) for unit in units])
+        self.connection.execute('COMMIT')
+
+    def lease(self, worker_id, count, timeout):
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.connection.execute(
+                'SELECT id, store_id, category FROM units '
+                'WHERE state = \'available\' OR (state = \'leased\' AND lease_expires < ?) '
+                'ORDER BY id LIMIT ?', (now, count)).fetchall()
+            self.connection.executemany(
+                'UPDATE units SET state = \'leased\', worker_id = ?, lease_expires = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                [(worker_id, now + timeout, row[0]) for row in rows])
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return [(row[0], WorkUnit(row[1], row[2])) for row in rows]
+
+    def heartbeat(self, worker_id, unit_ids, timeout):
+        self.connection.executemany(
+            'UPDATE units SET lease_expires = ? '
+            'WHERE id = ? AND worker_id = ? AND state = \'leased\'',
+            [(time.time() + timeout, unit_id, worker_id) for unit_id in unit_ids])
+
+    def complete(self, worker_id, unit_ids):
+        self.connection.executemany(
+            'UPDATE units SET state = \'done\', lease_expires = NULL '
+            'WHERE id = ? AND worker_id = ? AND state = \'leased\'',
+            [(unit_id, worker_id) for unit_id in unit_ids])
+
+    def counts(self):
+        now = time.time()
+        available, leased, done = self.connection.execute(
+            'SELECT '
+            'SUM(state = \'available\' OR (state = \'leased\' AND lease_expires < ?)), '
+            'SUM(state = \'leased\' AND lease_expires >= ?), '
+            'SUM(state = \'done\') FROM units', (now, now)).fetchone()
+        return {'available': available or 0, 'leased': leased or 0, 'done': done or 0}
+
+    def close(self):
+        self.connection.close()
+
+
+class RedisFrontier(Frontier):
+    """Frontier stored in Redis (or any server speaking its protocol), shared across machines.
+
+    Requires the optional ``redis`` package.
+    """
+
+    # Requeue expired leases, then move up to ARGV[2] units from available to leased
+    LEASE_SCRIPT = """
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+    for _, id in ipairs(expired) do
+        redis.call('ZREM', KEYS[2], id)
+        redis.call('HDEL', KEYS[3], id)
+        redis.call('RPUSH', KEYS[1], id)
+    end
+    local leased = {}
+    for i = 1, tonumber(ARGV[2]) do
+        local id = redis.call('LPOP', KEYS[1])
+        if not id then break end
+        redis.call('ZADD', KEYS[2], ARGV[3], id)
+        redis.call('HSET', KEYS[3], id, ARGV[4])
+        table.insert(leased, id)
+    end
+    return leased
+    """
+
+    def __init__(self, uri, prefix='food_scraper:frontier'):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError(
+                "RedisFrontier requires the 'redis' package: pip install redis")
+
+        self.client = redis.Redis.from_url(uri, decode_responses=True)
+        self.keys = {name: f'{prefix}:{name}'
+                     for name in ('units', 'available', 'leased', 'owners', 'done', 'next_id')}
+        self.lease_script = self.client.register_script(self.LEASE_SCRIPT)
+
+    def reset(self):
+        self.client.delete(*self.keys.values())
+
+    def put(self, units):
+        pipe = self.client.pipeline()
+        first_id = self.client.incrby(self.keys['next_id'], len(units)) - len(units) + 1
+        for unit_id, unit in enumerate(units, start=first_id):
+            pipe.hset(self.keys['units'], unit_id, json.dumps(list(unit)))
+            pipe.rpush(self.keys['available'], unit_id)
+        pipe.execute()
+
+    def lease(self, worker_id, count, timeout):
+        now = time.time()
+        unit_ids = self.lease_script(
+            keys=[self.keys['available'], self.keys['leased'], self.keys['owners']],
+            args=[now, count, now + timeout, worker_id])
+        if not unit_ids:
+            return []
+        units = self.client.hmget(self.keys['units'], unit_ids)
+        return [(int(unit_id), WorkUnit(*json.loads(unit)))
+                for unit_id, unit in zip(unit_ids, units)]
+
+    def _owned(self, worker_id, unit_ids):
+        owners = self.client.hmget(self.keys['owners'], unit_ids) if unit_ids else []
+        return [unit_id for unit_id, owner in zip(unit_ids, owners) if owner == worker_id]
+
+    def heartbeat(self, worker_id, unit_ids, timeout):
+        owned = self._owned(worker_id, unit_ids)
+        if owned:
+            self.client.zadd(self.keys['leased'],
+                             {unit_id: time.time() + timeout for unit_id in owned}, xx=True)
+
+    def complete(self, worker_id, unit_ids):
+        pipe = self.client.pipeline()
+        for unit_id in self._owned(worker_id, unit_ids):
+            pipe.zrem(self.keys['leased'], unit_id)
+            pipe.hdel(self.keys['owners'], unit_id)
+            pipe.sadd(self.keys['done'], unit_id)
+        pipe.execute()
+
+    def counts(self):
+        now = time.time()
+        expired = self.client.zcount(self.keys['leased'], '-inf', now)
+        return {
+            'available': self.client.llen(self.keys['available']) + expired,
+            'leased': self.client.zcard(self.keys['leased']) - expired,
+            'done': self.client.scard(self.keys['done']),
+        }
+
+
+# Output name, worker feed name, dedupe key fields, exporter and exporter options
+MERGED_FEEDS = (
+    ('store_data.json', 'store_data.jsonl', ('store_id',), JsonItemExporter, {'indent': 4}),
+    ('product_data.json', 'product_data.jsonl', ('store_id', 'slug'), JsonItemExporter, {'indent': 4}),
+    ('price_data.jsonl', 'price_data.jsonl', ('store_id', 'slug'), JsonLinesItemExporter, {}),
+)
+
+
+def merge_worker_feeds(output_dir, categories=()):
+    """Merge the per-worker jsonlines feeds under output_dir into single feeds.
+
+    Units re-leased after a worker died may have been partly exported twice,
+    so rows are deduplicated on their natural key, keeping the latest row.
+    A product listed in categories leased to different workers has a row
+    from each; their listed_categories are combined, in the order of the
+    crawl's categories, and the first of them is the row's category, as in
+    a single-process crawl. Returns a dict of merged feed path -> row count.
+    """
+    merged = {}
+    for output_name, worker_name, key_fields, exporter_cls, options in MERGED_FEEDS:
+        rows = {}
+        for path in sorted(glob.glob(os.path.join(output_dir, '*', worker_name))):
+            with open(path, encoding='utf8') as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A worker killed mid-write can leave a truncated last line
+                        continue
+                    key = tuple(row.get(field) for field in key_fields)
+                    previous = rows.get(key)
+                    if previous is not None and (previous.get('listed_categories') or row.get('listed_categories')):
+                        merge_listed_categories(row, previous, categories)
+                    rows[key] = row
+
+        if not rows:
+            continue
+
+        output_path = os.path.join(output_dir, output_name)
+        with open(output_path, 'wb') as f:
+            exporter = exporter_cls(f, encoding='utf8', **options)
+            exporter.start_exporting()
+            for row in rows.values():
+                exporter.export_item(row)
+            exporter.finish_exporting()
+        merged[output_path] = len(rows)
+    return merged
+
+
+def merge_listed_categories(row, previous, categories):
+    """Give a row the listed_categories of both rows of its product, and the first of them as its category."""
+    listed = ordered_categories(
+        (previous.get('listed_categories') or [previous.get('category')])
+        + (row.get('listed_categories') or [row.get('category')]), categories)
+    listed = [category for category in listed if category is not None]
+    row['listed_categories'] = listed
+    if listed:
+        row['category'] = listed[0]
@@ -0,0 +1,156 @@
+import sqlite3
+import time
+from collections import namedtuple
+
+
+Run = namedtuple('Run', ['run_id', 'name', 'mode', 'started_at', 'finished_at',
+                         'observed_count', 'change_count'])
+Observation = namedtuple('Observation', ['store_id', 'slug', 'run_id', 'price', 'is_available', 'rank'])
+
+
+class PriceHistory:
+    """Append-only SQLite history of product prices, availability and rank.
+
+    Every crawl is a numbered run. An observation is stored only when a
+    (store_id, slug)'s price, is_available or rank differs from its latest
+    one, so a run where nothing changed adds nothing but its runs row.
+    Items are diffed in batches: each batch goes into an in-memory temp
+    table and one transaction joins it against the latest values in
+    `products`, so writes to disk scale with churn, not catalog size.
+    """
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA temp_store=MEMORY')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'run_id INTEGER PRIMARY KEY, name TEXT NOT NULL, mode TEXT, '
+            'started_at REAL NOT NULL, finished_at REAL, '
+            'observed_count INTEGER NOT NULL DEFAULT 0, change_count INTEGER NOT NULL DEFAULT 0)')
+        # Latest known values of every (store_id, slug)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS products ('
+            'store_id INTEGER NOT NULL, slug TEXT NOT NULL, name TEXT, brand TEXT, category TEXT, '
+            'price REAL, is_available INTEGER, rank INTEGER, '
+            'first_run_id INTEGER NOT NULL, changed_run_id INTEGER NOT NULL, '
+            'PRIMARY KEY (store_id, slug)) WITHOUT ROWID')
+        # Clustered by slug for price series, indexed by run for per-run deltas
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS observations ('
+            'slug TEXT NOT NULL, store_id INTEGER NOT NULL, run_id INTEGER NOT NULL, '
+            'price REAL, is_available INTEGER, rank INTEGER, '
+            'PRIMARY KEY (slug, store_id, run_id)) WITHOUT ROWID')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS observations_run ON observations (run_id)')
+        self.connection.execute(
+            'CREATE TEMP TABLE batch ('
+            'store_id INTEGER NOT NULL, slug TEXT NOT NULL, name TEXT, brand TEXT, category TEXT, '
+            'price REAL, is_available INTEGER, rank INTEGER, '
+            'PRIMARY KEY (store_id, slug)) WITHOUT ROWID')
+
+        self.run_id = None
+        self.pending = []
+        self.observed_count = 0
+        self.change_count = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('PRICE_HISTORY_PATH'),
+                   settings.getint('PRICE_HISTORY_BATCH_SIZE'))
+
+    def start_run(self, name, mode=None):
+        """Start a new numbered run and return its run_id."""
+        cursor = self.connection.execute(
+            'INSERT INTO runs (name, mode, started_at) VALUES (?, ?, ?)', (name, mode, time.time()))
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def add(self, store_id, slug, price, is_available, rank=None,
+            name=None, brand=None, category=None):
+        """Queue an observation; values left as None keep their latest known value."""
+        self.pending.append((store_id, slug, name, brand, category, price,
+                             is_available, rank))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Diff the queued observations against the latest values in one transaction."""
+        if not self.pending:
+            return
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # The last observation of a (store_id, slug) seen twice in a batch wins
+            connection.executemany(
+                'INSERT OR REPLACE INTO batch VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self.pending)
+            changed = (
+                'FROM temp.batch b LEFT JOIN products p ON p.store_id = b.store_id AND p.slug = b.slug '
+                'WHERE p.slug IS NULL OR b.price IS NOT p.price '
+                'OR b.is_available IS NOT p.is_available '
+                'OR (b.rank IS NOT NULL AND b.rank IS NOT p.rank)')
+            cursor = connection.execute(
+                'INSERT OR REPLACE INTO observations (slug, store_id, run_id, price, is_available, rank) '
+                f'SELECT b.slug, b.store_id, ?, b.price, b.is_available, COALESCE(b.rank, p.rank) {changed}',
+                (self.run_id,))
+            self.change_count += cursor.rowcount
+            # New products, changed observations and renamed products
+            connection.execute(
+                'INSERT INTO products (store_id, slug, name, brand, category, price, is_available, rank, '
+                'first_run_id, changed_run_id) '
+                'SELECT b.store_id, b.slug, b.name, b.brand, b.category, b.price, b.is_available, b.rank, ?, ? '
+                f'{changed} OR b.name IS NOT p.name OR b.brand IS NOT p.brand OR b.category IS NOT p.category '
+                'ON CONFLICT (store_id, slug) DO UPDATE SET '
+                'name = COALESCE(excluded.name, name), brand = COALESCE(excluded.brand, brand), '
+                'category = COALESCE(excluded.category, category), '
+                'changed_run_id = CASE WHEN excluded.price IS NOT price '
+                'OR excluded.is_available IS NOT is_available '
+                'OR (excluded.rank IS NOT NULL AND excluded.rank IS NOT rank) '
+                'THEN excluded.changed_run_id ELSE changed_run_id END, '
+                'price = excluded.price, is_available = excluded.is_available, '
+                'rank = COALESCE(excluded.rank, rank)',
+                (self.run_id, self.run_id))
+            connection.execute('DELETE FROM temp.batch')
+            connection.execute(
+                'UPDATE runs SET observed_count = observed_count + ?, change_count = ? WHERE run_id = ?',
+                (len(self.pending), self.change_count, self.run_id))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self.observed_count += len(self.pending)
+        self.pending = []
+
+    def finish_run(self):
+        self.flush()
+        self.connection.execute(
+            'UPDATE runs SET finished_at = ? WHERE run_id = ?', (time.time(), self.run_id))
+
+    def runs(self):
+        """All runs, oldest first."""
+        return [Run(*row) for row in self.connection.execute(
+            'SELECT run_id, name, mode, started_at, finished_at, observed_count, change_count '
+            'FROM runs ORDER BY run_id')]
+
+    def price_series(self, slug, store_ids=None):
+        """Every recorded observation of a slug, by store and run."""
+        query = ('SELECT store_id, slug, run_id, price, is_available, rank FROM observations '
+                 'WHERE slug = ?')
+        params = [slug]
+        if store_ids:
+            query += f" AND store_id IN ({', '.join('?' * len(store_ids))})"
+            params.extend(store_ids)
+        query += ' ORDER BY store_id, run_id'
+        return [Observation(*row) for row in self.connection.execute(query, params)]
+
+    def changes(self, run_id):
+        """Every observation recorded in a run: products that were new or changed."""
+        return [Observation(*row) for row in self.connection.execute(
+            'SELECT store_id, slug, run_id, price, is_available, rank FROM observations '
+            'WHERE run_id = ? ORDER BY store_id, slug', (run_id,))]
+
+    def close(self):
+        self.connection.close()
@@ -1,5 +1,6 @@
 import scrapy
 from itemloaders.processors import TakeFirst
+from itemloaders.utils import arg_to_iter
 
 
 def process_date_opened(value):
@@ -60,6 +61,20 @@ def process_amazon_product_id(value):
     return value
 
 
+def take_first(value):
+    """First non-null, non-empty value, like a TakeFirst output processor."""
+    for item in arg_to_iter(value):
+        if item is not None and item != '':
+            return item
+    return None
+
+
+def collect(value):
+    """All values as a list, or None if there are none, like an unprocessed multi-value field."""
+    values = list(arg_to_iter(value))
+    return values or None
+
+
 class StoreItem(scrapy.Item):
     store_id = scrapy.Field(output_processor=TakeFirst())
     status = scrapy.Field(output_processor=TakeFirst())
@@ -92,6 +107,8 @@ class ProductItem(scrapy.Item):
     category = scrapy.Field(output_processor=TakeFirst())
     category_2 = scrapy.Field(output_processor=TakeFirst())
     category_3 = scrapy.Field(output_processor=TakeFirst())
+    # multiple values, every listing category of the product in its store
+    listed_categories = scrapy.Field()
     # multiple values, do not take first
     diets = scrapy.Field(input_processor=process_diets)
     # multple values, do not take first
@@ -113,3 +130,71 @@ class ProductItem(scrapy.Item):
     image = scrapy.Field(output_processor=TakeFirst())
     # multple values, do not take first
     related_products = scrapy.Field(input_processor=process_related_products)
+
+
+class PriceItem(scrapy.Item):
+    """Price/availability observation taken straight from a category listing."""
+    store_id = scrapy.Field()
+    slug = scrapy.Field()
+    name = scrapy.Field()
+    price = scrapy.Field()
+    is_available = scrapy.Field()
+    category = scrapy.Field()
+    listed_categories = scrapy.Field()
+    observed_at = scrapy.Field()
+
+
+class PartialProduct:
+    """Listing fields of a product waiting for its detail request.
+
+    Carried in request meta instead of an ItemLoader, which would keep the
+    whole listing response alive until the detail response arrives.
+    rank and is_available are only filled when details are shared across
+    stores and the store-specific fields come from the listing.
+    """
+    __slots__ = ('name', 'price', 'slug', 'brand', 'store_id', 'category',
+                 'rank', 'is_available')
+
+    def __init__(self, name, price, slug, brand, store_id, category, rank=None, is_available=None):
+        self.name = name
+        self.price = price
+        self.slug = slug
+        self.brand = brand
+        self.store_id = store_id
+        self.category = category
+        self.rank = rank
+        self.is_available = is_available
+
+    @classmethod
+    def from_listing(cls, product, store_id, category, store_fields=False):
+        """Create from a category listing result, optionally keeping its store-specific fields."""
+        partial = cls(product.get('name'), product.get('regularPrice'), product.get('slug'),
+                      product.get('brand'), store_id, category)
+        if store_fields:
+            partial.rank = product.get('rank')
+            partial.is_available = product.get('isAvailable')
+        return partial
+
+    @classmethod
+    def from_detail(cls, product, slug, store_id):
+        """Create from product detail data, for a product found through related links, not a listing.
+
+        The category is the slug of the product's top category, as in listing URLs.
+        """
+        category = (product.get('categories') or {}).get('slug')
+        return cls(product.get('name'), product.get('regularPrice'), slug, product.get('brand'),
+                   store_id, category)
+
+    def as_dict(self):
+        """Field values as a dict, the inverse of PartialProduct(**values)."""
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return f'PartialProduct(store_id={self.store_id!r}, slug={self.slug!r})'
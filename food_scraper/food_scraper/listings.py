@@ -0,0 +1,97 @@
+def ordered_categories(categories, crawl_categories=()):
+    """Distinct categories, the crawl's categories first and in crawl order, then the others as given."""
+    order = {category: number for number, category in enumerate(crawl_categories)}
+    return sorted(dict.fromkeys(categories), key=lambda category: order.get(category, len(order)))
+
+
+def set_bit(bits, index):
+    """Set a bit of a growable bytearray bitset, returning whether it was already set."""
+    byte, mask = index >> 3, 1 << (index & 7)
+    if byte >= len(bits):
+        bits.extend(bytes(byte + 1 - len(bits)))
+    present = bits[byte] & mask
+    bits[byte] |= mask
+    return bool(present)
+
+
+def has_bit(bits, index):
+    byte = index >> 3
+    return byte < len(bits) and bool(bits[byte] & (1 << (index & 7)))
+
+
+class ListingMemberships:
+    """The categories every (store_id, slug) pair of a crawl was listed under.
+
+    Slugs and categories are numbered once per crawl, and every store keeps
+    bitsets over the slug numbers: one of the slugs it listed, one per
+    category it listed them under and one of the slugs listed more than
+    once. A listed pair costs a few bits instead of a tuple and its own copy
+    of the slug (about 150 bytes in a set), as long as the stores share most
+    of a catalog: a store's bitsets span every slug numbered before its last
+    listed one.
+    """
+
+    def __init__(self, categories=()):
+        # slug -> number, shared by every store
+        self.slug_ids = {}
+        # Category names by number; the crawl's categories come first, in order
+        self.category_names = []
+        self.category_ids = {}
+        # store_id -> (listed, multi-category, {category number: bitset})
+        self.stores = {}
+        self.pair_count = 0
+        # Pairs listed under more than one category
+        self.multi_category_count = 0
+        for category in categories:
+            self.category_id(category)
+
+    def category_id(self, category):
+        category_id = self.category_ids.get(category)
+        if category_id is None:
+            category_id = self.category_ids[category] = len(self.category_names)
+            self.category_names.append(category)
+        return category_id
+
+    def add(self, store_id, slug, category):
+        """Record that a store listed a slug under a category, returning whether the pair is new."""
+        slug_id = self.slug_ids.setdefault(slug, len(self.slug_ids))
+        store = self.stores.get(store_id)
+        if store is None:
+            store = self.stores[store_id] = (bytearray(), bytearray(), {})
+        listed, multi_category, categories = store
+        category_id = self.category_id(category)
+        category_bits = categories.get(category_id)
+        if category_bits is None:
+            category_bits = categories[category_id] = bytearray()
+
+        if not set_bit(listed, slug_id):
+            set_bit(category_bits, slug_id)
+            self.pair_count += 1
+            return True
+        if not set_bit(category_bits, slug_id) and not set_bit(multi_category, slug_id):
+            self.multi_category_count += 1
+        return False
+
+    def __contains__(self, pair):
+        store_id, slug = pair
+        slug_id = self.slug_ids.get(slug)
+        store = self.stores.get(store_id)
+        return slug_id is not None and store is not None and has_bit(store[0], slug_id)
+
+    def categories(self, store_id, slug):
+        """Categories a store listed a slug under, the crawl's categories first and in order."""
+        if (store_id, slug) not in self:
+            return []
+        slug_id = self.slug_ids[slug]
+        return [self.category_names[category_id]
+                for category_id, bits in sorted(self.stores[store_id][2].items())
+                if has_bit(bits, slug_id)]
+
+    def __len__(self):
+        return self.pair_count
+
+    @property
+    def nbytes(self):
+        """Size of the bitsets, without the slug numbering"""
+        return sum(len(listed) + len(multi_category) + sum(len(bits) for bits in categories.values())
+                   for listed, multi_category, categories in self.stores.values())
@@ -0,0 +1,140 @@
+import resource
+from bisect import bisect_left
+
+# Bucket upper bounds growing by sqrt(2), so quantiles are within ~20%:
+# 0.5ms to ~2min for latencies and waits, 10us to ~1.3s for callback CPU
+LATENCY_BUCKETS = tuple(0.0005 * 2 ** (i / 2) for i in range(37))
+CPU_BUCKETS = tuple(0.00001 * 2 ** (i / 2) for i in range(34))
+
+
+def current_rss_bytes():
+    """Resident set size of this process (the peak where /proc isn't available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Histogram:
+    """Counts of observations per fixed bucket, like a Prometheus histogram."""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile, interpolating linearly inside its bucket (as histogram_quantile() does)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if index == len(self.bounds):
+                    # Past the last bound, the best guess is the last bound
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                **{name: round(self.quantile(q), 6) for name, q in
+                   (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))}}
+
+
+class MetricFamily:
+    """A counter, gauge or histogram metric with one series per label value tuple."""
+
+    def __init__(self, name, kind, help_text, labelnames, bounds=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.bounds = bounds
+        # label values -> value, or Histogram
+        self.series = {}
+
+    def inc(self, labels, amount=1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def set(self, labels, value):
+        self.series[labels] = value
+
+    def observe(self, labels, value):
+        histogram = self.series.get(labels)
+        if histogram is None:
+            histogram = self.series[labels] = Histogram(self.bounds)
+        histogram.observe(value)
+
+    def label_text(self, labels, extra=''):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        """Lines of the Prometheus text exposition format"""
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in sorted(self.series.items()):
+            if self.kind != 'histogram':
+                lines.append(f'{self.name}{self.label_text(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(self.bounds, value.counts):
+                cumulative += count
+                le = f'le="{bound:.6g}"'
+                lines.append(f'{self.name}_bucket{self.label_text(labels, le)} {cumulative}')
+            le = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{self.label_text(labels, le)} {value.count}')
+            lines.append(f'{self.name}_sum{self.label_text(labels)} {value.sum}')
+            lines.append(f'{self.name}_count{self.label_text(labels)} {value.count}')
+        return lines
+
+    def summary(self):
+        """Values (or histogram quantiles) per '/'-joined label values."""
+        return {'/'.join(map(str, labels)) or 'total': value.summary() if self.kind == 'histogram' else value
+                for labels, value in sorted(self.series.items())}
+
+
+class MetricsRegistry:
+    """The metric families of a crawl, rendered for Prometheus or summarized as a dict."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.families = {}
+
+    def add(self, name, kind, help_text, labelnames=(), bounds=None):
+        family = MetricFamily(f'{self.prefix}_{name}', kind, help_text, labelnames, bounds)
+        self.families[name] = family
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.add(name, 'counter', help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.add(name, 'gauge', help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), bounds=LATENCY_BUCKETS):
+        return self.add(name, 'histogram', help_text, labelnames, bounds)
+
+    def render(self):
+        lines = []
+        for family in self.families.values():
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        return {name: family.summary() for name, family in self.families.items() if family.series}
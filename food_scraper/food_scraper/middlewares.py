@@ -8,6 +8,18 @@ from urllib.parse import urlencode
 from scrapy import Request
 import random
 import requests
+import time
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from scrapy.core.downloader import Slot
+from scrapy.downloadermiddlewares.retry import RetryMiddleware, get_retry_request
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+
+from food_scraper.concurrency import AIMDWindow
+from food_scraper.endpoints import endpoint_for_request, endpoint_for_url, is_blocked_response
+from food_scraper.extensions import MetricsExtension
+from food_scraper.retry import RetryBudget, RetryScheduled, backoff_delay
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -164,6 +176,468 @@ class ScrapeOpsProxyMiddleware:
         return new_response
 
 
+def strip_proxy_routing(request, **kwargs):
+    """Return a copy of a request with its TieredProxyMiddleware routing undone, so it is routed afresh"""
+    meta = {key: value for key, value in request.meta.items()
+            if key not in ('proxy_tier', 'proxy_original_url', 'endpoint')}
+    meta.update(kwargs.pop('meta', {}))
+    return request.replace(
+        url=request.meta.get('proxy_original_url', request.url), meta=meta, **kwargs)
+
+
+class TieredProxyMiddleware:
+    """Route each endpoint class through the cheapest proxy tier that isn't blocked.
+
+    Tiers run from direct (no proxy) through the ScrapeOps datacenter and
+    residential proxies to residential with JS rendering. Every endpoint class
+    (see food_scraper.endpoints) starts at its PROXY_ENDPOINT_START_TIERS tier.
+    A blocked response (403/429, captcha HTML from a JSON endpoint or an empty
+    first listing page without facets) is retried one tier up, and after PROXY_ESCALATE_AFTER
+    blocks the whole endpoint class moves up. A class that has seen no blocks
+    for PROXY_DEESCALATE_AFTER seconds moves back down a tier.
+
+    Latency, cost (PROXY_TIER_COSTS) and block counts per tier are recorded in
+    the crawler stats under proxy_tier/.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
+
+    def __init__(self, settings, stats):
+        self.stats = stats
+        self.scrapeops_api_key = settings.get('SCRAPEOPS_API_KEY')
+        self.scrapeops_endpoint = 'https://proxy.scrapeops.io/v1/?'
+        self.scrapeops_proxy_active = settings.getbool(
+            'SCRAPEOPS_PROXY_ENABLED', False)
+
+        self.tiers = settings.getlist('PROXY_TIERS')
+        self.tier_costs = settings.getdict('PROXY_TIER_COSTS')
+        self.escalate_after = settings.getint('PROXY_ESCALATE_AFTER')
+        self.deescalate_after = settings.getfloat('PROXY_DEESCALATE_AFTER')
+
+        start_tiers = settings.getdict('PROXY_ENDPOINT_START_TIERS')
+        # endpoint class -> index of its current tier
+        self.endpoint_tiers = {endpoint: self.tiers.index(tier)
+                               for endpoint, tier in start_tiers.items()}
+        self.endpoint_blocks = {}
+        self.endpoint_last_change = {}
+
+    def _scrapeops_proxy_enabled(self):
+        if not self.scrapeops_api_key or not self.scrapeops_proxy_active:
+            return False
+        return True
+
+    def _max_tier(self):
+        # Without a proxy, direct is the only tier available
+        return len(self.tiers) - 1 if self._scrapeops_proxy_enabled() else 0
+
+    def _get_scrapeops_url(self, request, tier):
+        payload = {'api_key': self.scrapeops_api_key, 'url': request.url}
+        if tier in ('residential', 'render'):
+            payload['residential'] = True
+        if tier == 'render':
+            payload['render_js'] = True
+            if request.meta.get('sops_wait_for') is not None:
+                payload['wait_for'] = request.meta.get('sops_wait_for')
+        if request.meta.get('sops_keep_headers'):
+            payload['keep_headers'] = True
+        if request.meta.get('sops_country') is not None:
+            payload['country'] = request.meta.get('sops_country')
+        return self.scrapeops_endpoint + urlencode(payload)
+
+    def _set_endpoint_tier(self, endpoint, tier, spider, reason):
+        self.endpoint_tiers[endpoint] = tier
+        self.endpoint_blocks[endpoint] = 0
+        self.endpoint_last_change[endpoint] = time.time()
+        self.stats.set_value(f'proxy_tier/endpoint/{endpoint}', self.tiers[tier])
+        spider.logger.info(
+            f"Routing {endpoint} requests through the {self.tiers[tier]} tier ({reason})")
+
+    def process_request(self, request, spider):
+        if 'proxy_tier' in request.meta:
+            # Already routed (a proxied request coming back through the chain)
+            return None
+
+        endpoint = endpoint_for_url(request.url)
+        tier = min(max(self.endpoint_tiers.get(endpoint, 0),
+                       request.meta.get('proxy_min_tier', 0)), self._max_tier())
+        request.meta['proxy_tier'] = tier
+        request.meta['endpoint'] = endpoint
+        request.meta['proxy_original_url'] = request.url
+
+        tier_name = self.tiers[tier]
+        self.stats.inc_value(f'proxy_tier/{tier_name}/request_count')
+        self.stats.inc_value(
+            f'proxy_tier/{tier_name}/cost', self.tier_costs.get(tier_name, 0))
+        if tier_name == 'direct':
+            return None
+
+        return request.replace(
+            cls=Request, url=self._get_scrapeops_url(request, tier_name), meta=request.meta)
+
+    def process_response(self, request, response, spider):
+        if 'proxy_tier' not in request.meta:
+            return response
+
+        tier = request.meta['proxy_tier']
+        tier_name = self.tiers[tier]
+        endpoint = request.meta['endpoint']
+        if tier_name != 'direct':
+            response = ScrapeOpsProxyMiddleware._replace_response_url(response)
+
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.stats.inc_value(
+                f'proxy_tier/{tier_name}/latency_ms_total', int(latency * 1000))
+
+        if not is_blocked_response(request, response, endpoint):
+            self._maybe_deescalate(endpoint, spider)
+            return response
+
+        self.stats.inc_value(f'proxy_tier/{tier_name}/blocked_count')
+        if tier >= self.endpoint_tiers.get(endpoint, 0):
+            self.endpoint_blocks[endpoint] = self.endpoint_blocks.get(endpoint, 0) + 1
+            self.endpoint_last_change[endpoint] = time.time()
+            if (self.endpoint_blocks[endpoint] >= self.escalate_after
+                    and self.endpoint_tiers.get(endpoint, 0) < self._max_tier()):
+                self._set_endpoint_tier(
+                    endpoint, self.endpoint_tiers.get(endpoint, 0) + 1, spider,
+                    f"{self.endpoint_blocks[endpoint]} blocked responses")
+
+        if tier >= self._max_tier():
+            spider.logger.warning(
+                f"Blocked at the highest proxy tier ({response.status}): {request.meta['proxy_original_url']}")
+            return response
+
+        # Retry this request one tier up
+        self.stats.inc_value(f'proxy_tier/{tier_name}/escalated_count')
+        return strip_proxy_routing(
+            request, meta={'proxy_min_tier': tier + 1}, dont_filter=True)
+
+    def _maybe_deescalate(self, endpoint, spider):
+        tier = self.endpoint_tiers.get(endpoint, 0)
+        if tier == 0:
+            return
+        # Last escalation or block seen at the endpoint's current tier
+        last_change = self.endpoint_last_change.setdefault(endpoint, time.time())
+        if time.time() - last_change >= self.deescalate_after:
+            self._set_endpoint_tier(
+                endpoint, tier - 1, spider,
+                f"no blocks for {self.deescalate_after:.0f}s")
+
+
+class AdaptiveConcurrencyMiddleware:
+    """Run each endpoint class at the fastest concurrency it sustains, instead of a fixed delay.
+
+    Store summary, listing and detail requests each get their own downloader
+    slot, sized by an AIMDWindow: it grows by about one request per round
+    trip while latency and error rate stay flat, and is cut by
+    ADAPTIVE_CONCURRENCY_BACKOFF on 429/5xx responses, blocks (see
+    food_scraper.endpoints.is_blocked_response) and download errors.
+
+    Must run after TieredProxyMiddleware on requests (a higher order number),
+    so it sees blocked responses before they are retried one tier up. Window
+    sizes, goodput (good responses/s), latency and cuts are recorded in the
+    crawler stats under adaptive_concurrency/.
+    """
+
+    endpoints = ('store_summary', 'listing', 'detail')
+    slot_prefix = 'wholefoods-'
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed,
+                                signal=signals.spider_closed)
+        return middleware
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        settings = crawler.settings
+        self.windows = {endpoint: AIMDWindow(
+            start=settings.getint('ADAPTIVE_CONCURRENCY_START'),
+            minimum=settings.getint('ADAPTIVE_CONCURRENCY_MIN'),
+            maximum=settings.getint('ADAPTIVE_CONCURRENCY_MAX'),
+            backoff=settings.getfloat('ADAPTIVE_CONCURRENCY_BACKOFF'),
+            latency_tolerance=settings.getfloat('ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE'),
+            error_tolerance=settings.getfloat('ADAPTIVE_CONCURRENCY_ERROR_TOLERANCE'),
+        ) for endpoint in self.endpoints}
+        self.stats_interval = settings.getfloat('ADAPTIVE_CONCURRENCY_STATS_INTERVAL')
+        # endpoint -> good responses since the last stats update
+        self.goodput_counts = dict.fromkeys(self.endpoints, 0)
+        self.stats_task = None
+
+    def spider_opened(self, spider):
+        self.stats_task = LoopingCall(self._export_stats, spider)
+        self.stats_task.start(self.stats_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.stats_task is not None and self.stats_task.running:
+            self.stats_task.stop()
+
+    def _export_stats(self, spider):
+        summary = []
+        for endpoint, window in self.windows.items():
+            goodput = self.goodput_counts[endpoint] / self.stats_interval
+            self.goodput_counts[endpoint] = 0
+            self.stats.set_value(
+                f'adaptive_concurrency/{endpoint}/window', window.concurrency)
+            self.stats.set_value(
+                f'adaptive_concurrency/{endpoint}/goodput', round(goodput, 2))
+            if window.latency is not None:
+                self.stats.set_value(
+                    f'adaptive_concurrency/{endpoint}/latency_ms', int(window.latency * 1000))
+            summary.append(f'{endpoint}={window.concurrency} ({goodput:.1f}/s)')
+        spider.logger.info(f"Concurrency windows: {', '.join(summary)}")
+
+    def _slot(self, endpoint):
+        """Return the endpoint's downloader slot, creating it with the window's size"""
+        slots = self.crawler.engine.downloader.slots
+        key = self.slot_prefix + endpoint
+        if key not in slots:
+            # Idle slots are garbage collected by the downloader, the window lives on here
+            slots[key] = Slot(self.windows[endpoint].concurrency, 0, False)
+        return slots[key]
+
+    def _resize(self, endpoint):
+        window = self.windows[endpoint]
+        self._slot(endpoint).concurrency = window.concurrency
+        self.stats.set_value(
+            f'adaptive_concurrency/{endpoint}/window', window.concurrency)
+        self.stats.max_value(
+            f'adaptive_concurrency/{endpoint}/max_window', window.concurrency)
+
+    def _record_error(self, endpoint, spider, reason):
+        self.stats.inc_value(f'adaptive_concurrency/{endpoint}/error_count')
+        if self.windows[endpoint].record_error(time.time()):
+            self.stats.inc_value(f'adaptive_concurrency/{endpoint}/decrease_count')
+            spider.logger.info(
+                f"Cut {endpoint} concurrency to {self.windows[endpoint].concurrency} ({reason})")
+        self._resize(endpoint)
+
+    def _controlled_endpoint(self, request):
+        endpoint = endpoint_for_request(request)
+        return endpoint if endpoint in self.windows else None
+
+    def process_request(self, request, spider):
+        endpoint = self._controlled_endpoint(request)
+        if endpoint is None:
+            return None
+        request.meta['download_slot'] = self.slot_prefix + endpoint
+        self._slot(endpoint)
+        return None
+
+    def process_response(self, request, response, spider):
+        endpoint = self._controlled_endpoint(request)
+        if endpoint is None:
+            return response
+
+        if response.status == 429 or response.status >= 500:
+            self._record_error(endpoint, spider, f'status {response.status}')
+        elif is_blocked_response(request, response, endpoint):
+            self._record_error(endpoint, spider, 'blocked')
+        else:
+            self.windows[endpoint].record_success(
+                request.meta.get('download_latency'))
+            self.goodput_counts[endpoint] += 1
+            self._resize(endpoint)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        endpoint = self._controlled_endpoint(request)
+        if endpoint is not None:
+            self._record_error(endpoint, spider, type(exception).__name__)
+        return None
+
+
+class RetryPolicyMiddleware(RetryMiddleware):
+    """Scrapy's RetryMiddleware with per-endpoint policies, backoff and a retry budget.
+
+    Failed attempts (RETRY_HTTP_CODES, RETRY_EXCEPTIONS) are retried up to the
+    endpoint's RETRY_POLICIES max_retries, after a jittered exponential
+    backoff instead of straight away. The failed attempt raises RetryScheduled
+    (an IgnoreRequest), and the retry is handed back to the engine when its
+    delay is over; the spider is kept open meanwhile. Every retry is paid
+    from a RetryBudget, so a blocking upstream can't cause a retry storm.
+    Requests out of retries or budget carry on to their errback, which
+    records them as dead letters.
+
+    Replaces 'scrapy.downloadermiddlewares.retry.RetryMiddleware'.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_idle,
+                                signal=signals.spider_idle)
+        return middleware
+
+    def __init__(self, crawler):
+        super().__init__(crawler.settings)
+        self.crawler = crawler
+        self.stats = crawler.stats
+        settings = crawler.settings
+        self.policies = settings.getdict('RETRY_POLICIES')
+        self.budget = RetryBudget(
+            settings.getfloat('RETRY_BUDGET_RATIO'),
+            settings.getfloat('RETRY_BUDGET_MIN'),
+            settings.getfloat('RETRY_BUDGET_MAX'))
+        self.pending_retries = 0
+
+    def policy_for(self, endpoint):
+        return self.policies.get(endpoint) or self.policies['default']
+
+    def spider_idle(self, spider):
+        if self.pending_retries:
+            raise DontCloseSpider
+
+    def process_request(self, request, spider):
+        # Retries and proxy escalations copy the flag, so each request earns once
+        if not request.meta.get('retry_budget_earned'):
+            request.meta['retry_budget_earned'] = True
+            self.budget.deposit()
+        return None
+
+    def _retry(self, request, reason, spider):
+        endpoint = endpoint_for_request(request)
+        policy = self.policy_for(endpoint)
+        retry_times = request.meta.get('retry_times', 0)
+        max_retry_times = request.meta.get('max_retry_times', policy['max_retries'])
+        if retry_times < max_retry_times and not self.budget.withdraw():
+            self.stats.inc_value(f'retry/budget_exhausted/{endpoint}')
+            spider.logger.warning(
+                f"Retry budget exhausted, not retrying {endpoint} request ({reason}): "
+                f"{request.meta.get('proxy_original_url', request.url)}")
+            return None
+
+        retry_request = get_retry_request(
+            request, reason=reason, spider=spider, max_retry_times=max_retry_times,
+            priority_adjust=request.meta.get('priority_adjust', self.priority_adjust))
+        if retry_request is None:
+            return None
+
+        delay = backoff_delay(policy, retry_times)
+        self.stats.inc_value(f'retry/backoff_count/{endpoint}')
+        self.pending_retries += 1
+        reactor.callLater(delay, self._reschedule, strip_proxy_routing(retry_request))
+        raise RetryScheduled(f"Retrying in {delay:.1f}s ({reason})")
+
+    def _reschedule(self, request):
+        self.pending_retries -= 1
+        self.crawler.engine.crawl(request)
+
+
+class CheckpointMiddleware:
+    """Keep a checkpointed crawl's CrawlCheckpoint up to date and save it periodically.
+
+    Every scheduled request is tracked until it leaves the downloader for
+    good: a final response or an exception no middleware retried. Retries,
+    redirects and proxy escalations keep the id of their first attempt. A
+    checkpoint is saved every CHECKPOINT_INTERVAL seconds, at a moment when
+    no response is being processed by the spider, so a resumed crawl never
+    sees a callback's effects half applied. If the spider stays busy for
+    more than CHECKPOINT_MAX_WAIT seconds (a CPU-bound crawl), the engine
+    stops starting downloads until the responses already downloaded have
+    been processed.
+
+    Only enabled for crawls with -a checkpoint=<dir>.
+    """
+
+    # Seconds between save attempts while responses are being processed
+    busy_retry_delay = 0.05
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if getattr(crawler.spider, 'checkpoint_store', None) is None:
+            raise NotConfigured
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_opened,
+                                signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed,
+                                signal=signals.spider_closed)
+        crawler.signals.connect(middleware.request_scheduled,
+                                signal=signals.request_scheduled)
+        crawler.signals.connect(middleware.request_dropped,
+                                signal=signals.request_dropped)
+        return middleware
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.checkpoint = crawler.spider.checkpoint_store
+        self.interval = crawler.settings.getfloat('CHECKPOINT_INTERVAL')
+        self.max_wait = crawler.settings.getfloat('CHECKPOINT_MAX_WAIT')
+        self.save_loop = None
+        # When the pending save was due, None if there is none
+        self.save_due = None
+        self.paused = False
+
+    def spider_opened(self, spider):
+        self.save_loop = LoopingCall(self.save, spider)
+        self.save_loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.save_loop is not None and self.save_loop.running:
+            self.save_loop.stop()
+        self.save_due = None
+        # An interrupted crawl (Ctrl-C, CloseSpider) resumes from here too
+        self.checkpoint.save(spider.checkpoint_state(), finished=reason == 'finished')
+        spider.logger.info(
+            f"Saved checkpoint with {len(self.checkpoint.requests)} outstanding requests "
+            f"to {self.checkpoint.path}")
+
+    def save(self, spider):
+        """Save a checkpoint once no response is in the middle of being processed"""
+        engine = self.crawler.engine
+        if self.save_due is None:
+            self.save_due = time.monotonic()
+        # Responses and failures handed to the spider but not fully processed yet
+        if engine.scraper.slot.active:
+            if not self.paused and time.monotonic() - self.save_due > self.max_wait:
+                engine.pause()
+                self.paused = True
+                self.stats.inc_value('checkpoint/paused_count')
+            reactor.callLater(self.busy_retry_delay, self.retry_save, spider)
+            return
+
+        started = time.perf_counter()
+        self.checkpoint.save(spider.checkpoint_state())
+        self.stats.inc_value('checkpoint/saved_count')
+        self.stats.set_value('checkpoint/outstanding_requests', len(self.checkpoint.requests))
+        self.stats.set_value('checkpoint/last_save_ms',
+                             round((time.perf_counter() - started) * 1000, 1))
+        self.stats.set_value('checkpoint/last_wait_ms',
+                             round((time.monotonic() - self.save_due) * 1000, 1))
+        self.save_due = None
+        if self.paused:
+            self.paused = False
+            engine.unpause()
+
+    def retry_save(self, spider):
+        if self.save_due is not None and self.save_loop.running:
+            self.save(spider)
+
+    def request_scheduled(self, request, spider):
+        self.checkpoint.track(request, spider)
+
+    def request_dropped(self, request, spider):
+        self.checkpoint.complete(request)
+
+    def process_response(self, request, response, spider):
+        self.checkpoint.complete(request)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.checkpoint.complete(request)
+        return None
+
+
 class ScrapeOpsFakeBrowserHeadersMiddleware:
     """Middleware to fetch and use fake browser headers from ScrapeOps API"""
 
@@ -224,3 +698,110 @@ class ScrapeOpsFakeBrowserHeadersMiddleware:
             request.headers[key] = value
 
         return None
+
+
+class FixtureRecorderMiddleware:
+    """Record every response the crawl gets into a FixtureArchive at FIXTURE_RECORD_PATH.
+
+    Sits between TieredProxyMiddleware and RetryPolicyMiddleware, so responses
+    are recorded under the URL the spider asked for, after the Sops-Final-Url
+    rewrite and decompression, and a retried URL keeps its last attempt.
+    Recorded archives are replayed with food_scraper.fixtures.FixtureDownloadHandler,
+    e.g. by `scrapy benchmark`.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('FIXTURE_RECORD_PATH')
+        if not path:
+            raise NotConfigured
+        from food_scraper.fixtures import FixtureArchive
+        middleware = cls(FixtureArchive(path), crawler.stats)
+        crawler.signals.connect(middleware.spider_closed,
+                                signal=signals.spider_closed)
+        return middleware
+
+    def __init__(self, archive, stats):
+        self.archive = archive
+        self.stats = stats
+
+    def process_response(self, request, response, spider):
+        self.archive.add(request.meta.get('proxy_original_url', request.url), response.status,
+                         response.url, response.headers.get('Content-Type', b'').decode('latin-1') or None,
+                         response.body)
+        self.stats.inc_value('fixtures/recorded')
+        return response
+
+    def spider_closed(self, spider):
+        spider.logger.info(f"Recorded fixtures {self.archive.counts()} to {self.archive.path}")
+        self.archive.close()
+
+
+class CallbackProfilerMiddleware:
+    """Measure the CPU time spent in each spider callback.
+
+    Times every step of the callback's output generator with
+    time.process_time(), so time spent waiting in the rest of Scrapy isn't
+    counted, and records callback_cpu/<callback>/seconds and .../calls in
+    the crawler stats. Must be the spider middleware closest to the spider
+    (the highest order number). With the MetricsExtension enabled, every
+    call also goes into its callback CPU histogram. Enabled with
+    CALLBACK_PROFILE_ENABLED or METRICS_ENABLED.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics = crawler.get_extension(MetricsExtension)
+        if metrics is None and not crawler.settings.getbool('CALLBACK_PROFILE_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.stats, metrics)
+
+    def __init__(self, stats, metrics=None):
+        self.stats = stats
+        self.metrics = metrics
+
+    @staticmethod
+    def callback_name(response):
+        callback = response.request.callback if response.request is not None else None
+        return getattr(callback, '__name__', 'parse')
+
+    def record(self, response, seconds):
+        name = self.callback_name(response)
+        self.stats.inc_value(f'callback_cpu/{name}/seconds', seconds)
+        self.stats.inc_value(f'callback_cpu/{name}/calls')
+        if self.metrics is not None and response.request is not None:
+            self.metrics.observe_callback(response.request, name, seconds)
+
+    def process_spider_output(self, response, result, spider):
+        seconds = 0.0
+        iterator = iter(result)
+        try:
+            while True:
+                started = time.process_time()
+                try:
+                    output = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.process_time() - started
+                yield output
+        finally:
+            self.record(response, seconds)
+
+    async def process_spider_output_async(self, response, result, spider):
+        # Awaits inside the callback are counted too, along with whatever else
+        # the reactor ran meanwhile
+        seconds = 0.0
+        iterator = result.__aiter__()
+        try:
+            while True:
+                started = time.process_time()
+                try:
+                    output = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+                finally:
+                    seconds += time.process_time() - started
+                yield output
+        finally:
+            self.record(response, seconds)
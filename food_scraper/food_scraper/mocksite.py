@@ -0,0 +1,342 @@
+"""Local stand-in for the Whole Foods site and the ScrapeOps proxy, for load tests.
+
+Serve it with `scrapy mocksite` and point a crawl at it with MOCK_SITE_URL.
+The catalog is generated on the fly from the URL, so every store id and
+category exists. Latency, 429/5xx rates, blocks, a request rate limit and
+buildId rotation are configurable, see MockSite.
+"""
+import json
+import math
+import random
+import time
+import zlib
+from collections import Counter
+from urllib.parse import parse_qs, urlparse
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.exceptions import NotConfigured
+from twisted.internet.defer import CancelledError
+from twisted.internet.task import deferLater
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from food_scraper.endpoints import endpoint_for_url
+
+NUTRIENTS = (('calories', 'Calories', 'kcal'), ('totalFat', 'Total Fat', 'g'),
+             ('sodium', 'Sodium', 'mg'), ('totalCarbohydrate', 'Total Carbohydrate', 'g'),
+             ('dietaryFiber', 'Dietary Fiber', 'g'), ('totalSugars', 'Total Sugars', 'g'),
+             ('protein', 'Protein', 'g'), ('potassium', 'Potassium', 'mg'))
+DIETS = ('Vegan', 'Vegetarian', 'Gluten-Free', 'Dairy-Free', 'Keto-Friendly', 'Paleo-Friendly')
+BRANDS = ('365 by Whole Foods Market', 'Mock Farms', 'Local Growers', 'Field Day', 'Pacific Harvest')
+CAPTCHA_PAGE = b'<html><body><form action="/errors/validateCaptcha">captcha</form></body></html>'
+
+
+def stable_hash(*parts):
+    """A hash of the parts that is the same in every process (unlike hash())."""
+    return zlib.crc32(':'.join(map(str, parts)).encode('utf-8'))
+
+
+class LatencyModel:
+    """Response latency distribution, parsed from a spec in milliseconds:
+
+    fixed:MS, uniform:MIN,MAX, exponential:MEAN or lognormal:MEDIAN,SIGMA
+    """
+
+    # Distribution -> number of parameters
+    kinds = {'fixed': 1, 'uniform': 2, 'exponential': 1, 'lognormal': 2}
+
+    def __init__(self, kind, *params):
+        if kind not in self.kinds:
+            raise ValueError(f"Unknown latency distribution '{kind}'")
+        if len(params) != self.kinds[kind]:
+            raise ValueError(f"The {kind} latency distribution takes {self.kinds[kind]} parameters")
+        self.kind = kind
+        self.params = [param / 1000 for param in params]
+        if kind == 'lognormal':
+            # Sigma isn't a time
+            self.params[1] = params[1]
+
+    @classmethod
+    def parse(cls, spec):
+        kind, _, params = spec.partition(':')
+        return cls(kind, *(float(param) for param in params.split(',') if param))
+
+    def sample(self, rng):
+        """One latency in seconds"""
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return rng.uniform(*self.params)
+        if self.kind == 'exponential':
+            return rng.expovariate(1 / self.params[0]) if self.params[0] else 0
+        median, sigma = self.params
+        return rng.lognormvariate(math.log(median), sigma) if median else 0
+
+
+class MockCatalog:
+    """Products of every (store, category), derived from hashes of the names.
+
+    A category of a store lists the first 75-100% of the category's products
+    (products_per_category at most), ranked the same in every store, with
+    prices and availability varying slightly by store. Products are slugged
+    '<category>-<n>'.
+    """
+
+    def __init__(self, products_per_category=400):
+        self.products_per_category = products_per_category
+
+    def category_size(self, store_id, category):
+        share = 0.75 + 0.25 * (stable_hash(store_id, category) % 1000) / 999
+        return int(self.products_per_category * share)
+
+    def product_number(self, slug):
+        """Number of a product slug, or None if it isn't one of the catalog's."""
+        category, _, number = slug.rpartition('-')
+        if not category or not number.isdigit() or int(number) >= self.products_per_category:
+            return None
+        return int(number)
+
+    def listing_product(self, store_id, category, rank):
+        slug = f'{category}-{rank}'
+        product_hash = stable_hash(slug)
+        store_hash = stable_hash(store_id, slug)
+        return {
+            'name': f'{category.replace("-", " ").title()} Product {rank}',
+            'slug': slug,
+            'brand': BRANDS[product_hash % len(BRANDS)],
+            'regularPrice': round((1 + product_hash % 2000 / 100) * (0.95 + store_hash % 11 / 100), 2),
+            'isAvailable': store_hash % 20 != 0,
+            'rank': rank,
+            'store': store_id,
+        }
+
+    def listing(self, store_id, category, offset, limit):
+        size = self.category_size(store_id, category)
+        return {
+            'results': [self.listing_product(store_id, category, rank)
+                        for rank in range(offset, min(size, offset + limit))],
+            'facets': [{'slug': 'category', 'refinements': [{'slug': category, 'count': size}]}],
+        }
+
+    def product_detail(self, slug):
+        category, _, number = slug.rpartition('-')
+        product_hash = stable_hash(slug)
+        rng = random.Random(product_hash)
+        number = int(number)
+        asin = f'B0{product_hash % 10 ** 8:08d}'
+        return {'pageProps': {'data': {
+            'name': f'{category.replace("-", " ").title()} Product {number}', 'slug': slug,
+            'brand': BRANDS[product_hash % len(BRANDS)], 'asin': asin, 'id': f'[{asin}]',
+            'rank': number, 'isAvailable': True,
+            'categories': {'name': category.replace('-', ' ').title(), 'slug': category,
+                           'childCategory': {'name': f'{category.title()} {number % 5}'}},
+            'diets': [{'name': diet, 'slug': diet.lower()} for diet in rng.sample(DIETS, rng.randint(0, 3))],
+            'ingredients': [f'Ingredient {rng.randint(1, 500)}' for _ in range(rng.randint(1, 8))],
+            'allergens': rng.sample(['Milk', 'Soy', 'Wheat', 'Tree Nuts', 'Eggs'], rng.randint(0, 2)),
+            'certifications': rng.sample(['USDA Organic', 'Non-GMO Project Verified', 'Kosher'],
+                                         rng.randint(0, 2)),
+            'nutritionGroup': 'default', 'nutritionLabelFormat': 'standard',
+            'nutritionElements': [
+                {'key': key, 'name': label, 'uom': unit, 'perServing': round(rng.uniform(0.5, 300), 1),
+                 'fullDvp': rng.randint(0, 40)} for key, label, unit in NUTRIENTS],
+            'servingInfo': {'servingSize': rng.choice((1, 28, 100, 240)), 'servingSizeUom': 'g'},
+            'isAlcoholic': False, 'uom': 'each',
+            'images': [{'image': f'https://m.media-amazon.com/images/mock/{slug}.jpg'}],
+            'related': [{'slug': f'{category}-{(number + step) % self.products_per_category}'}
+                        for step in range(1, 6)],
+        }}}
+
+    def store_summary(self, store_id):
+        store_hash = stable_hash(store_id)
+        return {
+            'status': 'OPEN', 'openedAt': f'{2000 + store_hash % 24}-05-01T00:00:00Z',
+            'primaryLocation': {
+                'latitude': round(25 + store_hash % 2300 / 100, 4),
+                'longitude': round(-124 + store_hash % 5700 / 100, 4),
+                'address': {'STREET_ADDRESS_LINE1': f'{store_id} Market St', 'CITY': 'Mocktown',
+                            'STATE': 'CA', 'ZIP_CODE': f'{90000 + store_id % 10000:05d}',
+                            'POSTAL_CODE': f'{90000 + store_id % 10000:05d}'}},
+        }
+
+
+class MockSite(Resource):
+    """twisted.web resource serving the site's endpoints and the ScrapeOps proxy API.
+
+    - `/` is the homepage with the current buildId in __NEXT_DATA__
+    - `/stores/{id}/summary`, `/api/products/category/{cat}?store=&offset=&limit=`
+      (at most page_size_cap results per page) and
+      `/_next/data/{buildId}/product/{slug}.json` are the spider's JSON endpoints.
+      `_next/data` URLs of any other buildId 404, like after a deploy.
+    - `/v1/?api_key=&url=...` is the proxy: it serves `url` after
+      proxy_latency more, with a Sops-Final-Url header.
+
+    Direct (unproxied) requests are blocked at block_rate with a captcha page,
+    and get a 429 once more than rate_limit requests per second come in.
+    Any request fails with a 429 at error_429_rate and a 5xx at error_5xx_rate.
+    With build_id_rotation, the buildId changes every that many seconds.
+    """
+    isLeaf = True
+
+    def __init__(self, catalog, latency, proxy_latency=None, error_429_rate=0.0, error_5xx_rate=0.0,
+                 block_rate=0.0, rate_limit=0, build_id_rotation=0, page_size_cap=60, seed=0):
+        super().__init__()
+        self.catalog = catalog
+        self.latency = latency
+        self.proxy_latency = proxy_latency
+        self.error_429_rate = error_429_rate
+        self.error_5xx_rate = error_5xx_rate
+        self.block_rate = block_rate
+        self.rate_limit = rate_limit
+        self.build_id_rotation = build_id_rotation
+        self.page_size_cap = page_size_cap
+        self.rng = random.Random(seed)
+        self.started = time.monotonic()
+        # Token bucket of the rate limit
+        self.tokens = rate_limit
+        self.tokens_updated = self.started
+        # (endpoint, status) -> responses
+        self.counts = Counter()
+
+    @property
+    def build_id(self):
+        if not self.build_id_rotation:
+            return 'mock-build-0'
+        return f'mock-build-{int((time.monotonic() - self.started) // self.build_id_rotation)}'
+
+    def take_token(self):
+        """Whether a direct request is within the rate limit."""
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.tokens_updated) * self.rate_limit)
+        self.tokens_updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def render_GET(self, request):
+        url = request.uri.decode('utf-8')
+        parsed = urlparse(url)
+        proxied = parsed.path == '/v1/'
+        if proxied:
+            query = parse_qs(parsed.query)
+            if not query.get('api_key') or not query.get('url'):
+                return self.respond(request, 'proxy', 401, b'{"error": "api_key and url are required"}')
+            target = query['url'][0]
+            request.setHeader(b'Sops-Final-Url', target.encode('utf-8'))
+            parsed = urlparse(target)
+        endpoint = endpoint_for_url(parsed.geturl())
+
+        status, body = self.route(parsed, proxied)
+        delay = self.latency.sample(self.rng)
+        if proxied and self.proxy_latency is not None:
+            delay += self.proxy_latency.sample(self.rng)
+        if delay <= 0:
+            return self.respond(request, endpoint, status, body)
+
+        from twisted.internet import reactor
+
+        delayed = deferLater(reactor, delay, self.respond, request, endpoint, status, body)
+        delayed.addCallback(self.send, request)
+        delayed.addErrback(lambda failure: failure.trap(CancelledError))
+        # The client gave up (e.g. a download timeout) before the response was sent
+        request.notifyFinish().addErrback(lambda _: delayed.cancel())
+        return NOT_DONE_YET
+
+    @staticmethod
+    def send(body, request):
+        request.write(body)
+        request.finish()
+
+    def route(self, parsed, proxied):
+        """Status and body of the response to a site URL"""
+        if not proxied and not self.take_token():
+            return 429, b'Too Many Requests'
+        draw = self.rng.random()
+        if draw < self.error_429_rate:
+            return 429, b'Too Many Requests'
+        if draw < self.error_429_rate + self.error_5xx_rate:
+            return self.rng.choice((500, 502, 503)), b'Server Error'
+        if not proxied and self.rng.random() < self.block_rate:
+            return 200, CAPTCHA_PAGE
+
+        path, query = parsed.path, parse_qs(parsed.query)
+        if path in ('', '/'):
+            return 200, (f'<html><head></head><body><script id="__NEXT_DATA__" type="application/json">'
+                         f'{{"props": {{}}, "page": "/", "buildId": "{self.build_id}"}}'
+                         f'</script></body></html>').encode('utf-8')
+        parts = path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'stores' and parts[2] == 'summary' and parts[1].isdigit():
+            return 200, json.dumps(self.catalog.store_summary(int(parts[1]))).encode('utf-8')
+        if path.startswith('/api/products/category/'):
+            try:
+                store_id = int(query['store'][0])
+                offset = int(query.get('offset', ['0'])[0])
+                limit = min(int(query.get('limit', ['60'])[0]), self.page_size_cap)
+            except (KeyError, ValueError):
+                return 400, b'{"error": "store, offset and limit must be numbers"}'
+            return 200, json.dumps(self.catalog.listing(store_id, parts[-1], offset, limit)).encode('utf-8')
+        if len(parts) >= 4 and parts[:2] == ['_next', 'data']:
+            if parts[2] != self.build_id:
+                return 404, b'{"notFound": true}'
+            if parts[3:] == ['index.json']:
+                return 200, b'{"pageProps": {}}'
+            if len(parts) == 5 and parts[3] == 'product' and parts[4].endswith('.json'):
+                slug = parts[4][:-len('.json')]
+                if self.catalog.product_number(slug) is not None:
+                    return 200, json.dumps(self.catalog.product_detail(slug)).encode('utf-8')
+        return 404, b'Not Found'
+
+    def respond(self, request, endpoint, status, body):
+        self.counts[endpoint, status] += 1
+        request.setResponseCode(status)
+        request.setHeader(b'Content-Length', str(len(body)).encode('ascii'))
+        if body.startswith(b'<'):
+            request.setHeader(b'Content-Type', b'text/html; charset=utf-8')
+        elif body.startswith(b'{'):
+            request.setHeader(b'Content-Type', b'application/json')
+        else:
+            request.setHeader(b'Content-Type', b'text/plain')
+        return body
+
+    def summary(self):
+        """One line of response counts per endpoint and status since the last summary."""
+        counts, self.counts = self.counts, Counter()
+        by_endpoint = {}
+        for (endpoint, status), count in sorted(counts.items()):
+            by_endpoint.setdefault(endpoint, []).append(f'{status}={count}')
+        return sum(counts.values()), ', '.join(
+            f"{endpoint} {' '.join(statuses)}" for endpoint, statuses in by_endpoint.items())
+
+
+class MockSiteDownloadHandler(HTTP11DownloadHandler):
+    """HTTP(S) download handler sending every request to the mock site at MOCK_SITE_URL.
+
+    Site and proxy URLs keep their path and query and only change host, so
+    the spider, the proxy middlewares and the downloader slots see the real
+    URLs. Installed by the wholefoods spider when MOCK_SITE_URL is set.
+    """
+
+    def __init__(self, settings, crawler):
+        if not settings.get('MOCK_SITE_URL'):
+            raise NotConfigured('MOCK_SITE_URL is not set')
+        super().__init__(settings, crawler)
+        self.base_url = settings.get('MOCK_SITE_URL').rstrip('/')
+        # Every request goes to the one mock host
+        self._pool.maxPersistentPerHost = settings.getint('CONCURRENT_REQUESTS')
+
+    def download_request(self, request, spider):
+        parsed = urlparse(request.url)
+        target = f"{self.base_url}{parsed.path or '/'}{'?' + parsed.query if parsed.query else ''}"
+        rewritten = request.replace(url=target)
+        downloading = super().download_request(rewritten, spider)
+        downloading.addCallback(self.restore_url, request, rewritten)
+        return downloading
+
+    @staticmethod
+    def restore_url(response, request, rewritten):
+        # The latency was measured on the rewritten copy of the request
+        if 'download_latency' in rewritten.meta:
+            request.meta['download_latency'] = rewritten.meta['download_latency']
+        return response.replace(url=request.url)
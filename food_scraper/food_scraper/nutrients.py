@@ -0,0 +1,402 @@
+"""Products x nutrients matrix of a run's ProductItems, for vectorized analytics.
+
+Requires the optional ``numpy`` package (and ``pyarrow`` to load a columnar
+export). Nutrients don't depend on the store, so the matrix has one row per
+product slug, holding each nutrient's amount per serving in a canonical
+unit (grams, kcal, or IU for vitamins without a known conversion). Every
+(store, product) row of the run points at its product's matrix row and
+carries its own price and category, so millions of product-store rows
+cost a few arrays, not millions of matrix rows.
+
+Three bases are derived from the amounts per serving:
+
+- 'serving': as labelled
+- '100g': per 100 g of product, for products whose serving size is a
+  weight, or a volume (taken at 1 g/ml)
+- 'price': per what `price` buys. That's a pound (or other weight unit)
+  for products priced by weight, otherwise the whole container, going by
+  servingsPerContainer or totalSize in serving_info
+
+A value is NaN where it can't be worked out (missing nutrient, unknown
+serving size, unconvertible unit).
+"""
+import json
+import re
+
+import numpy as np
+
+# Grams per unit of the amounts of nutrients
+MASS_UNITS = {'g': 1.0, 'gram': 1.0, 'grams': 1.0, 'mg': 1e-3, 'mcg': 1e-6, 'µg': 1e-6, 'ug': 1e-6,
+              'kg': 1e3}
+# kcal per unit, food labels' 'cal' and 'calories' are kcal
+ENERGY_UNITS = {'kcal': 1.0, 'cal': 1.0, 'calories': 1.0, 'kj': 1 / 4.184}
+# Grams per IU of the vitamins labelled in IU (vitamin A as retinol,
+# vitamin E as natural alpha-tocopherol), by normalized nutrient key
+IU_GRAMS = {'vitamina': 0.3e-6, 'vitamind': 0.025e-6, 'vitamine': 0.67e-3}
+# Grams per unit of serving sizes and priced units; volumes at the density of water
+SERVING_UNITS = {**MASS_UNITS, 'oz': 28.349523125, 'lb': 453.59237, 'lbs': 453.59237,
+                 'ml': 1.0, 'l': 1000.0, 'fl oz': 29.5735295625}
+
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]')
+NUMBER = re.compile(r'\d+(?:\.\d+)?')
+
+
+def normalize_key(key):
+    """Nutrient key as compared across spellings ('vitaminD', 'vitamin_d' -> 'vitamind')"""
+    return NON_ALPHANUMERIC.sub('', str(key).lower())
+
+
+def unit_conversion(key, unit):
+    """(canonical unit, factor to it) of a nutrient amount given in `unit`."""
+    unit = (unit or '').strip().lower()
+    if unit in MASS_UNITS:
+        return 'g', MASS_UNITS[unit]
+    if unit in ENERGY_UNITS:
+        return 'kcal', ENERGY_UNITS[unit]
+    if unit == 'iu':
+        grams = IU_GRAMS.get(normalize_key(key))
+        return ('g', grams) if grams is not None else ('IU', 1.0)
+    return unit or None, 1.0
+
+
+def to_float(value):
+    """Numeric value as a float, None if it isn't a number (as in the columnar export)."""
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_number(value):
+    """A number from serving info and nutrient amounts ('about 8' -> 8.0), None if there's none."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMBER.search(str(value))
+    return float(match.group()) if match else None
+
+
+def feed_items(paths):
+    """Rows of product feeds: JSON arrays (product_data.json) or JSON lines."""
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            if path.endswith('.json'):
+                yield from json.load(f)
+            else:
+                yield from (json.loads(line) for line in f if line.strip())
+
+
+def serving_grams(serving_info):
+    """Grams in one serving, None unless its size is a weight or volume."""
+    if isinstance(serving_info, str):
+        serving_info = json.loads(serving_info)
+    if not isinstance(serving_info, dict):
+        return None
+    size = to_number(serving_info.get('servingSize'))
+    grams = SERVING_UNITS.get((serving_info.get('servingSizeUom') or '').strip().lower())
+    if not size or grams is None:
+        return None
+    return size * grams
+
+
+def servings_per_price(serving_info, unit_of_measure):
+    """Servings in what the price buys: one priced weight unit, else the container."""
+    if isinstance(serving_info, str):
+        serving_info = json.loads(serving_info)
+    if not isinstance(serving_info, dict):
+        return None
+    grams = serving_grams(serving_info)
+    priced_grams = SERVING_UNITS.get((unit_of_measure or '').strip().lower())
+    if priced_grams is not None and grams:
+        # Sold by weight, the price is per unit_of_measure
+        return priced_grams / grams
+    servings = to_number(serving_info.get('servingsPerContainer'))
+    if servings:
+        return servings
+    total = to_number(serving_info.get('totalSize'))
+    total_grams = SERVING_UNITS.get((serving_info.get('totalSizeUom') or '').strip().lower())
+    if total and total_grams is not None and grams:
+        return total * total_grams / grams
+    return None
+
+
+class NutrientMatrix:
+    """Nutrient amounts of a run's products, with vectorized per-row queries.
+
+    Built with from_items() (ProductItems or feed rows as dicts), from_feeds()
+    or from_columnar(). Row arrays (one entry per store's product):
+    store_ids, product_index, prices, category_codes. Product arrays (one
+    entry per slug): slugs, names, serving_grams, servings_per_price and the
+    amounts matrix, whose columns are `nutrients` in `units`.
+    """
+
+    def __init__(self, store_ids, product_index, prices, category_codes, categories,
+                 slugs, names, serving_grams, servings_per_price, amounts, nutrients, units,
+                 unconverted_count=0):
+        self.store_ids = store_ids
+        self.product_index = product_index
+        self.prices = prices
+        self.category_codes = category_codes
+        self.categories = categories
+        self.slugs = slugs
+        self.names = names
+        self.serving_grams = serving_grams
+        self.servings_per_price = servings_per_price
+        self.amounts = amounts
+        self.nutrients = nutrients
+        self.units = units
+        # Nutrient amounts dropped because their unit doesn't convert to the column's
+        self.unconverted_count = unconverted_count
+        self.columns = {key: column for column, key in enumerate(nutrients)}
+
+    def __len__(self):
+        return len(self.product_index)
+
+    @classmethod
+    def from_items(cls, items):
+        """Build the matrix from ProductItems or product feed rows, in one pass."""
+        store_ids, product_index, prices, categories = [], [], [], []
+        product_rows = {}
+        product_values = []
+        category_codes = {}
+        for item in items:
+            slug = item.get('slug')
+            row = product_rows.get(slug)
+            if row is None:
+                row = product_rows[slug] = len(product_values)
+                serving_info = item.get('serving_info')
+                product_values.append((
+                    slug, item.get('name'), serving_grams(serving_info),
+                    servings_per_price(serving_info, item.get('unit_of_measure')),
+                    item.get('nutrition_elements') or ()))
+            store_ids.append(item.get('store_id') if item.get('store_id') is not None else -1)
+            product_index.append(row)
+            price = to_float(item.get('price'))
+            prices.append(price if price is not None else np.nan)
+            category = item.get('category')
+            code = category_codes.get(category)
+            if code is None:
+                code = category_codes[category] = len(category_codes)
+            categories.append(code)
+
+        elements = [(row, element.get('key'), element.get('unit_of_measure'),
+                     to_float(element.get('amount_per_serving')))
+                    for row, values in enumerate(product_values) for element in values[4]]
+        rows, keys, units, amounts = zip(*elements) if elements else ((), (), (), ())
+        return cls.build(
+            np.array(store_ids, dtype=np.int64), np.array(product_index, dtype=np.int32),
+            np.array(prices, dtype=np.float64), np.array(categories, dtype=np.int32),
+            list(category_codes), [values[0] for values in product_values],
+            [values[1] for values in product_values],
+            np.array([values[2] for values in product_values], dtype=np.float64),
+            np.array([values[3] for values in product_values], dtype=np.float64),
+            np.array(rows, dtype=np.int64), list(keys), list(units),
+            np.array([amount if amount is not None else np.nan for amount in amounts], dtype=np.float64))
+
+    @classmethod
+    def from_feeds(cls, paths):
+        """Build the matrix from product feeds: JSON arrays (product_data.json) or JSON lines."""
+        return cls.from_items(feed_items(paths))
+
+    @classmethod
+    def from_columnar(cls, directory, filter=None):
+        """Build the matrix from a columnar export, vectorized end to end.
+
+        `filter` is a pyarrow.dataset expression on the partition columns,
+        e.g. ds.field('run_date') == '2026-10-17', applied to both tables.
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        from food_scraper.columnar import read_nutrition, read_products
+
+        products = read_products(directory, ['slug', 'name', 'price', 'serving_info', 'unit_of_measure',
+                                             'store_id', 'category'], filter)
+        slug_codes = products.column('slug').combine_chunks().dictionary_encode()
+        slugs = slug_codes.dictionary
+        product_index = slug_codes.indices.to_numpy(zero_copy_only=False).astype(np.int32)
+        # The product values come from each slug's first row
+        _, first_rows = np.unique(product_index, return_index=True)
+        take = pa.array(first_rows)
+        names = products.column('name').take(take).to_pylist()
+        serving_infos = products.column('serving_info').take(take).to_pylist()
+        units_of_measure = products.column('unit_of_measure').take(take).to_pylist()
+        category = products.column('category').combine_chunks()
+        if not isinstance(category.type, pa.DictionaryType):
+            category = category.dictionary_encode()
+
+        nutrition = read_nutrition(directory, ['slug', 'key', 'unit_of_measure', 'amount_per_serving'],
+                                   filter)
+        rows = pc.index_in(nutrition.column('slug'), value_set=slugs)
+        # Elements of products the filter left out of the products table
+        known = rows.is_valid()
+        nutrition = nutrition.filter(known)
+        return cls.build(
+            products.column('store_id').fill_null(-1).to_numpy().astype(np.int64),
+            product_index,
+            products.column('price').to_numpy().astype(np.float64),
+            category.indices.fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int32),
+            category.dictionary.to_pylist(), slugs.to_pylist(), names,
+            np.array([serving_grams(info) for info in serving_infos], dtype=np.float64),
+            np.array([servings_per_price(info, unit) for info, unit in zip(serving_infos, units_of_measure)],
+                     dtype=np.float64),
+            rows.filter(known).to_numpy().astype(np.int64),
+            nutrition.column('key').combine_chunks(),
+            nutrition.column('unit_of_measure').combine_chunks(),
+            nutrition.column('amount_per_serving').to_numpy().astype(np.float64))
+
+    @classmethod
+    def build(cls, store_ids, product_index, prices, category_codes, categories, slugs, names,
+              serving_grams, servings_per_price, element_rows, element_keys, element_units,
+              element_amounts):
+        """Assemble the matrix from row and product arrays and the long-format nutrient elements.
+
+        Keys and units (lists, or pyarrow arrays) are converted once per
+        distinct (key, unit) pair. Each key's column takes the canonical unit
+        most of its amounts convert to; amounts in other units are dropped.
+        """
+        keys, key_codes = _encode(element_keys)
+        units, unit_codes = _encode(element_units)
+        width = max(len(units), 1)
+        pairs, pair_index, pair_counts = np.unique(
+            key_codes.astype(np.int64) * width + unit_codes, return_inverse=True, return_counts=True)
+        pair_keys = [keys[code // width] for code in pairs]
+        conversions = [unit_conversion(key, units[code % width]) for key, code in zip(pair_keys, pairs)]
+
+        # Canonical unit of every key: the one with the most amounts
+        unit_counts = {}
+        for key, (unit, _), count in zip(pair_keys, conversions, pair_counts):
+            counts = unit_counts.setdefault(key, {})
+            counts[unit] = counts.get(unit, 0) + int(count)
+        nutrients = sorted(key for key in unit_counts if key is not None)
+        canonical = {key: max(unit_counts[key].items(), key=lambda pair: (pair[1], str(pair[0])))[0]
+                     for key in nutrients}
+        columns = {key: column for column, key in enumerate(nutrients)}
+        pair_columns = np.array([columns[key] if key is not None and canonical[key] == unit else -1
+                                 for key, (unit, _) in zip(pair_keys, conversions)], dtype=np.int64)
+        pair_factors = np.array([factor for _, factor in conversions], dtype=np.float64)
+
+        amounts = np.full((len(slugs), len(nutrients)), np.nan)
+        if len(element_rows):
+            element_columns = pair_columns[pair_index]
+            converted = element_columns >= 0
+            amounts[element_rows[converted], element_columns[converted]] = \
+                element_amounts[converted] * pair_factors[pair_index][converted]
+            unconverted_count = int(np.count_nonzero(~converted & ~np.isnan(element_amounts)))
+        else:
+            unconverted_count = 0
+        return cls(store_ids, product_index, prices, category_codes, categories,
+                   np.array(slugs, dtype=object), np.array(names, dtype=object),
+                   serving_grams, servings_per_price, amounts, nutrients,
+                   [canonical[key] for key in nutrients], unconverted_count)
+
+    def column(self, nutrient):
+        try:
+            return self.columns[nutrient]
+        except KeyError:
+            raise KeyError(f"No nutrient '{nutrient}', the products have {', '.join(self.nutrients)}")
+
+    def product_values(self, nutrient, basis='serving'):
+        """Amount of a nutrient per product, per serving, per 100g or per price."""
+        amounts = self.amounts[:, self.column(nutrient)]
+        if basis == 'serving':
+            return amounts
+        if basis == '100g':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return amounts * (100 / self.serving_grams)
+        if basis == 'price':
+            return amounts * self.servings_per_price
+        raise ValueError(f"Unknown basis '{basis}', expected 'serving', '100g' or 'price'")
+
+    def values(self, nutrient, basis='serving'):
+        """Amount of a nutrient for every row, per serving, per 100g or per what its price buys."""
+        return self.product_values(nutrient, basis)[self.product_index]
+
+    def cost_per(self, nutrient):
+        """Price per canonical unit of a nutrient (e.g. dollars per gram of protein) for every row."""
+        amounts = self.values(nutrient, 'price')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cost = self.prices / amounts
+        cost[~(amounts > 0)] = np.nan
+        return cost
+
+    def per_dollar(self, nutrient):
+        """Amount of a nutrient a dollar buys, for every row."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            density = self.values(nutrient, 'price') / self.prices
+        density[~(self.prices > 0)] = np.nan
+        return density
+
+    def mask(self, store_ids=None, categories=None):
+        """Rows of some stores and categories (all rows for None)."""
+        selected = np.ones(len(self), dtype=bool)
+        if store_ids is not None:
+            selected &= np.isin(self.store_ids, list(store_ids))
+        if categories is not None:
+            codes = [code for code, category in enumerate(self.categories) if category in set(categories)]
+            selected &= np.isin(self.category_codes, codes)
+        return selected
+
+    def top(self, values, n=10, selected=None):
+        """The n rows with the highest values (NaN last), as dicts, highest first."""
+        values = np.where(np.isnan(values), -np.inf, values)
+        rows = np.flatnonzero(selected) if selected is not None else np.arange(len(values))
+        candidates = values[rows]
+        if len(rows) > n:
+            best = np.argpartition(-candidates, n - 1)[:n]
+            rows, candidates = rows[best], candidates[best]
+        order = np.lexsort((rows, -candidates))
+        return [self.row(row, value=float(values[row])) for row in rows[order]
+                if values[row] != -np.inf]
+
+    def top_per_dollar(self, nutrient, n=10, store_ids=None, categories=None):
+        """The n rows whose price buys the most of a nutrient."""
+        return self.top(self.per_dollar(nutrient), n, self.mask(store_ids, categories))
+
+    def row(self, row, **values):
+        product = self.product_index[row]
+        code = self.category_codes[row]
+        return {'store_id': int(self.store_ids[row]), 'slug': self.slugs[product],
+                'name': self.names[product], 'category': self.categories[code] if code >= 0 else None,
+                'price': float(self.prices[row]), **values}
+
+    def distribution(self, values, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9), selected=None):
+        """Count, mean and quantiles of the non-NaN values of every category."""
+        keep = ~np.isnan(values)
+        if selected is not None:
+            keep &= selected
+        codes, values = self.category_codes[keep], values[keep]
+        order = np.lexsort((values, codes))
+        codes, values = codes[order], values[order]
+        boundaries = np.flatnonzero(np.diff(codes)) + 1
+        distributions = {}
+        for group in np.split(np.arange(len(codes)), boundaries):
+            if not len(group):
+                continue
+            code = codes[group[0]]
+            group_values = values[group]
+            distributions[self.categories[code] if code >= 0 else None] = {
+                'count': len(group_values), 'mean': float(group_values.mean()),
+                **{f'p{round(q * 100)}': float(np.quantile(group_values, q)) for q in quantiles}}
+        return distributions
+
+    def category_distribution(self, nutrient, basis='100g', quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+        """Distribution of a nutrient's amounts per category, on a basis of values()."""
+        return self.distribution(self.values(nutrient, basis), quantiles)
+
+
+def _encode(values):
+    """(distinct values, int32 code of every value) of a list or pyarrow array."""
+    if hasattr(values, 'dictionary_encode'):
+        encoded = values.dictionary_encode()
+        codes = encoded.indices.fill_null(len(encoded.dictionary)).to_numpy(zero_copy_only=False)
+        return encoded.dictionary.to_pylist() + [None], codes.astype(np.int32)
+    distinct = {}
+    codes = np.fromiter((distinct.setdefault(value, len(distinct)) for value in values),
+                        dtype=np.int32, count=len(values))
+    return list(distinct), codes
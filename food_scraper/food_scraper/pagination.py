@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+
+def plan_pages(start, end, page_size):
+    """Split the listing range [start, end) into (offset, limit) pages of at most page_size."""
+    return [(offset, min(page_size, end - offset))
+            for offset in range(start, end, page_size)]
+
+
+def category_total(data, category):
+    """Product count of a category from a listing's facet refinements, or None if it isn't there."""
+    facets = data.get('facets') or [{}]
+    for refinement in facets[0].get('refinements', []):
+        if refinement.get('slug') == category:
+            return refinement.get('count', 0)
+    return None
+
+
+class CategorySizeCache:
+    """Listing totals per (store, category) from earlier runs, plus the largest page size the API served.
+
+    Knowing a category's size up front lets every page be requested at once
+    instead of waiting for the first page's count.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        record = self.read()
+        self.totals = record['totals']
+        self.page_size = record['page_size']
+        self.updated = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('CATEGORY_SIZE_CACHE_PATH'))
+
+    @staticmethod
+    def key(store_id, category):
+        return f'{store_id}:{category}'
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            record = {}
+        return {'totals': record.get('totals') or {}, 'page_size': record.get('page_size')}
+
+    def get(self, store_id, category):
+        """Return the last observed total for a store's category, or None."""
+        return self.totals.get(self.key(store_id, category))
+
+    def set(self, store_id, category, total):
+        key = self.key(store_id, category)
+        self.totals[key] = total
+        self.updated[key] = total
+
+    def save(self):
+        """Merge this run's totals into the file; other workers may have saved theirs meanwhile."""
+        record = self.read()
+        record['totals'].update(self.updated)
+        if self.page_size is not None:
+            record['page_size'] = self.page_size
+        record['saved_at'] = time.time()
+        # Write atomically, several workers may share the file
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self.path)
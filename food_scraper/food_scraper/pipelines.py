@@ -4,10 +4,325 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
 
+import json
+
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured
+
+from food_scraper.changes import ChangeIndex
+from food_scraper.history import PriceHistory
+from food_scraper.items import PriceItem, ProductItem, StoreItem
+from food_scraper.stores import StoreIndex
+
+try:
+    from food_scraper.columnar import ParquetProductWriter
+except ImportError:
+    # pyarrow is optional, it's only needed for the columnar export
+    ParquetProductWriter = None
+
+try:
+    from food_scraper.search import SearchIndexBuilder
+except ImportError:
+    # numpy is optional, it's only needed for the search index
+    SearchIndexBuilder = None
 
 
 class FoodScraperPipeline:
     def process_item(self, item, spider):
         return item
+
+
+class CheckpointDuplicatesPipeline:
+    """Drop items a resumed crawl already wrote to its feeds before it was interrupted.
+
+    Only enabled for crawls with -a checkpoint=<dir>.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        checkpoint = getattr(crawler.spider, 'checkpoint_store', None)
+        if checkpoint is None:
+            raise NotConfigured
+        return cls(checkpoint)
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+
+    def process_item(self, item, spider):
+        if not self.checkpoint.accepts(item):
+            raise DropItem("Already written before the crawl was resumed")
+        self.checkpoint.item_written(item)
+        return item
+
+
+class ColumnarExportPipeline:
+    """Write ProductItems to a partitioned Parquet dataset (see food_scraper/columnar.py).
+
+    Enabled by COLUMNAR_EXPORT_ENABLED. Items are passed on unchanged, so the
+    JSON feeds are still written unless they are removed from FEEDS.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('COLUMNAR_EXPORT_ENABLED'):
+            raise NotConfigured
+        if ParquetProductWriter is None:
+            crawler.spider.logger.warning(
+                "COLUMNAR_EXPORT_ENABLED is set but pyarrow is not installed, skipping the columnar export")
+            raise NotConfigured
+        return cls(crawler)
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.writer = None
+
+    def process_item(self, item, spider):
+        if isinstance(item, ProductItem):
+            if self.writer is None:
+                # Partitioned by the date the crawl started, which a resumed crawl keeps
+                self.writer = ParquetProductWriter.from_settings(
+                    self.crawler.settings, spider.run_id, spider.start_datetime[:10])
+            self.writer.add(ItemAdapter(item).asdict())
+        return item
+
+    def close_spider(self, spider):
+        if self.writer is None:
+            return
+        self.writer.close()
+        stats = self.crawler.stats
+        stats.set_value('columnar/files', self.writer.files_written)
+        stats.set_value('columnar/product_rows', self.writer.product_rows_written)
+        stats.set_value('columnar/nutrition_rows', self.writer.nutrition_rows_written)
+        spider.logger.info(
+            f"Wrote {self.writer.product_rows_written} products and "
+            f"{self.writer.nutrition_rows_written} nutrition elements to {self.writer.directory}")
+
+
+class PriceHistoryPipeline:
+    """Record price, availability and rank changes in the price history store.
+
+    Enabled by PRICE_HISTORY_ENABLED. Takes ProductItems and the PriceItems
+    of -a mode=prices runs; every crawl is one run of the history.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PRICE_HISTORY_ENABLED'):
+            raise NotConfigured
+        return cls(crawler, PriceHistory.from_settings(crawler.settings))
+
+    def __init__(self, crawler, history):
+        self.crawler = crawler
+        self.history = history
+
+    def open_spider(self, spider):
+        self.history.start_run(spider.run_id, spider.mode)
+
+    def process_item(self, item, spider):
+        if isinstance(item, ProductItem):
+            self.history.add(item.get('store_id'), item.get('slug'), item.get('price'),
+                             item.get('is_available'), item.get('rank'),
+                             item.get('name'), item.get('brand'), item.get('category'))
+        elif isinstance(item, PriceItem):
+            # Listing categories are slugs, not the detail names ProductItems carry
+            self.history.add(item.get('store_id'), item.get('slug'), item.get('price'),
+                             item.get('is_available'), name=item.get('name'))
+        return item
+
+    def close_spider(self, spider):
+        self.history.finish_run()
+        stats = self.crawler.stats
+        stats.set_value('price_history/run_id', self.history.run_id)
+        stats.set_value('price_history/observed', self.history.observed_count)
+        stats.set_value('price_history/changes', self.history.change_count)
+        spider.logger.info(
+            f"Price history run {self.history.run_id}: {self.history.change_count} of "
+            f"{self.history.observed_count} products new or changed")
+        self.history.close()
+
+
+class ChangeDetectionPipeline:
+    """Write a diff feed of the products that were added, changed or removed since the last run.
+
+    Enabled by CHANGE_DETECTION_ENABLED. Every ProductItem is hashed and
+    diffed against the previous run's ChangeIndex; added and changed products
+    are written to CHANGE_FEED_PATH as they come, removed ones once the
+    crawl is over. Removals are only reported for full crawls that finished
+    without dead letters, and only in the (store, category) listings the
+    crawl requested, so a partial or failed crawl never reports products as
+    gone. Removals are written in close_spider, so the spider's summary at
+    spider_closed counts them. The close reason isn't known yet there: a
+    crawl counts as finished if the engine went idle with nothing scheduled
+    since and the crawler wasn't stopped.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CHANGE_DETECTION_ENABLED'):
+            raise NotConfigured
+        spider = crawler.spider
+        if spider.frontier:
+            # Workers would overwrite each other's run in the shared index
+            spider.logger.warning("Change detection doesn't support distributed crawls, skipping it")
+            raise NotConfigured
+        pipeline = cls(crawler, ChangeIndex.from_settings(crawler.settings),
+                       crawler.settings.get('CHANGE_FEED_PATH'))
+        crawler.signals.connect(pipeline.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(pipeline.request_scheduled, signal=signals.request_scheduled)
+        return pipeline
+
+    def __init__(self, crawler, index, feed_path):
+        self.crawler = crawler
+        self.index = index
+        self.feed_path = feed_path
+        self.feed = None
+        self.resumed = False
+        # Set when the engine goes idle, cleared by any request scheduled after that
+        self.idle = False
+
+    def open_spider(self, spider):
+        # A resumed crawl continues the diff of the run it resumes
+        self.resumed = spider.checkpoint_store is not None and spider.checkpoint_store.resumed
+        self.index.start(resume=self.resumed)
+        self.feed = open(self.feed_path, 'a' if self.resumed else 'w', encoding='utf-8')
+
+    def process_item(self, item, spider):
+        if isinstance(item, ProductItem):
+            self.write_changes(self.index.add(ItemAdapter(item).asdict()))
+        return item
+
+    def write_changes(self, changes):
+        stats = self.crawler.stats
+        for change, item, fields in changes:
+            record = {'change': change, 'store_id': item.get('store_id'), 'slug': item.get('slug')}
+            if fields is not None:
+                record['fields'] = fields
+            record['item'] = item
+            self.feed.write(json.dumps(record, ensure_ascii=False) + '\n')
+            stats.inc_value(f'changes/{change}')
+
+    def spider_idle(self, spider):
+        self.idle = True
+
+    def request_scheduled(self, request, spider):
+        self.idle = False
+
+    def close_spider(self, spider):
+        self.write_changes(self.index.flush())
+
+        skip_reason = None
+        if not self.idle or not self.crawler.crawling:
+            skip_reason = "the crawl didn't finish"
+        elif spider.dead_letters.count:
+            skip_reason = f"{spider.dead_letters.count} requests failed"
+        elif spider.replay:
+            skip_reason = "it only replayed dead letters"
+        elif spider.mode != 'full':
+            skip_reason = f"{spider.mode} runs don't crawl products"
+        elif self.resumed:
+            skip_reason = "it was resumed from a checkpoint"
+
+        if skip_reason is None:
+            self.index.add_scope(spider.listing_planned_ends)
+            for store_id, slug, category in self.index.removed():
+                record = {'change': 'removed', 'store_id': store_id, 'slug': slug, 'category': category}
+                self.feed.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self.crawler.stats.inc_value('changes/removed')
+        else:
+            spider.logger.warning(f"Not detecting removed products because {skip_reason}")
+        self.index.finish(drop_removed=skip_reason is None)
+        self.index.close()
+        self.feed.close()
+
+        stats = self.crawler.stats
+        spider.logger.info(
+            f"Wrote {stats.get_value('changes/added', 0)} added, {stats.get_value('changes/changed', 0)} "
+            f"changed and {stats.get_value('changes/removed', 0)} removed products to {self.feed_path}")
+
+
+class StoreIndexPipeline:
+    """Keep every StoreItem in the StoreIndex at STORE_INDEX_PATH.
+
+    Enabled by STORE_INDEX_ENABLED, which store discovery runs (-a mode=stores)
+    always set. Any crawl refreshes the stores it visits; discovery runs also
+    mark the known stores whose summary 404'd as not found, so selectors stop
+    picking them.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('STORE_INDEX_ENABLED'):
+            raise NotConfigured
+        return cls(crawler, StoreIndex.from_settings(crawler.settings))
+
+    def __init__(self, crawler, index):
+        self.crawler = crawler
+        self.index = index
+
+    def process_item(self, item, spider):
+        if isinstance(item, StoreItem) and item.get('store_id') is not None:
+            self.index.add(ItemAdapter(item).asdict())
+            self.index.commit()
+            self.crawler.stats.inc_value('store_index/updated')
+        return item
+
+    def close_spider(self, spider):
+        marked = self.index.mark_not_found(spider.stores_not_found)
+        if marked:
+            self.crawler.stats.set_value('store_index/not_found', len(marked))
+            spider.logger.warning(f"{len(marked)} known stores weren't found: {marked}")
+        spider.logger.info(f"Store index {self.index.path} has {len(self.index.stores)} stores")
+        self.index.close()
+
+
+class SearchIndexPipeline:
+    """Build the inverted search index of the crawl's products (see food_scraper/search.py).
+
+    Enabled by SEARCH_INDEX_ENABLED. Rows and postings are collected as
+    ProductItems come and the index is written to SEARCH_INDEX_PATH once the
+    crawl is over, replacing the previous one.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SEARCH_INDEX_ENABLED'):
+            raise NotConfigured
+        spider = crawler.spider
+        if SearchIndexBuilder is None:
+            spider.logger.warning(
+                "SEARCH_INDEX_ENABLED is set but numpy is not installed, skipping the search index")
+            raise NotConfigured
+        if spider.frontier:
+            # Every worker would replace the index with its own share of the products
+            spider.logger.warning("The search index doesn't support distributed crawls, skipping it")
+            raise NotConfigured
+        return cls(crawler, crawler.settings.get('SEARCH_INDEX_PATH'))
+
+    def __init__(self, crawler, path):
+        self.crawler = crawler
+        self.path = path
+        self.builder = SearchIndexBuilder()
+
+    def process_item(self, item, spider):
+        if isinstance(item, ProductItem):
+            self.builder.add(item)
+        return item
+
+    def close_spider(self, spider):
+        if not len(self.builder):
+            return
+        if spider.checkpoint_store is not None and spider.checkpoint_store.resumed:
+            spider.logger.warning(
+                "The search index only has the products crawled since the crawl was resumed, "
+                "rebuild it from the feeds with `scrapy search --build`")
+        size = self.builder.write(self.path, run_id=spider.run_id)
+        stats = self.crawler.stats
+        stats.set_value('search_index/rows', len(self.builder))
+        stats.set_value('search_index/products', len(self.builder.product_ids))
+        stats.set_value('search_index/terms', self.builder.term_count)
+        stats.set_value('search_index/bytes', size)
+        spider.logger.info(
+            f"Wrote the search index of {len(self.builder.product_ids)} products in {len(self.builder)} "
+            f"store rows, {self.builder.term_count} terms, to {self.path} ({size / 2 ** 20:.1f} MiB)")
@@ -0,0 +1,41 @@
+import random
+
+from scrapy.exceptions import IgnoreRequest
+
+
+class RetryScheduled(IgnoreRequest):
+    """Raised for a failed attempt whose retry was scheduled after a backoff delay.
+
+    Errbacks receive it like any IgnoreRequest and should ignore it: the
+    request isn't lost, it comes back once the delay is over.
+    """
+
+
+def backoff_delay(policy, retry_times):
+    """Seconds to wait before retry number retry_times + 1, with full jitter."""
+    ceiling = min(policy['max_delay'], policy['base_delay'] * 2 ** retry_times)
+    return random.uniform(0, ceiling)
+
+
+class RetryBudget:
+    """Token bucket that caps retries at a share of all requests.
+
+    Every first attempt earns `ratio` of a retry and every retry spends one,
+    so when an upstream starts failing everything, retries stop once the
+    balance (at most `maximum`) runs out instead of multiplying the load.
+    """
+
+    def __init__(self, ratio, minimum, maximum):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.balance = float(minimum)
+
+    def deposit(self):
+        self.balance = min(self.maximum, self.balance + self.ratio)
+
+    def withdraw(self):
+        """Spend one retry. Returns False if the budget is exhausted."""
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
@@ -0,0 +1,126 @@
+import heapq
+from itertools import count
+
+from scrapy.pqueues import ScrapyPriorityQueue, _path_safe
+
+from food_scraper.context import CrawlContext
+
+
+class StoreRoundRobinPriorityQueue:
+    """Scheduler priority queue that interleaves stores fairly.
+
+    Requests are split into one priority queue per store (taken from the
+    request's CrawlContext; requests without one, like the homepage, share a
+    global queue). Request priority is still honoured across stores, but
+    among stores whose next request has the same priority, stores take turns,
+    so a store with thousands of pending detail requests can't starve the
+    others.
+
+    Stores wait in a heap keyed by (next request priority, turn), where a
+    store takes a new turn whenever it is served or its next priority
+    changes, so picking the next store costs O(log stores). Entries whose
+    store has moved on are skipped when they reach the top.
+
+    Enable with SCHEDULER_PRIORITY_QUEUE = 'food_scraper.scheduler.StoreRoundRobinPriorityQueue'.
+    """
+
+    global_slot = '_global'
+
+    @classmethod
+    def from_crawler(cls, crawler, downstream_queue_cls, key, startprios=None, *, start_queue_cls=None):
+        return cls(crawler, downstream_queue_cls, key, startprios,
+                   start_queue_cls=start_queue_cls)
+
+    def __init__(self, crawler, downstream_queue_cls, key, slot_startprios=None, *, start_queue_cls=None):
+        if slot_startprios and not isinstance(slot_startprios, dict):
+            raise ValueError(
+                "StoreRoundRobinPriorityQueue can only resume a crawl that was "
+                "started with the same priority queue class")
+
+        self.crawler = crawler
+        self.downstream_queue_cls = downstream_queue_cls
+        self.start_queue_cls = start_queue_cls
+        self.key = key
+
+        self.pqueues = {}  # store slot -> priority queue
+        self.heap = []  # (priority, turn, slot) of every store, and stale entries
+        self.entries = {}  # store slot -> its current (priority, turn)
+        self.turns = count()
+        for slot, startprios in (slot_startprios or {}).items():
+            self.pqueues[slot] = self.pqfactory(slot, startprios)
+            self.schedule(slot)
+
+    def pqfactory(self, slot, startprios=()):
+        return ScrapyPriorityQueue(
+            self.crawler,
+            self.downstream_queue_cls,
+            self.key + '/' + _path_safe(slot),
+            startprios,
+            start_queue_cls=self.start_queue_cls,
+        )
+
+    def slot_for(self, request):
+        context = CrawlContext.from_request(request)
+        if context is None:
+            return self.global_slot
+        return str(context.store_id)
+
+    def schedule(self, slot):
+        """Give a store a heap entry for its next request, at the back of its priority."""
+        priority = self.pqueues[slot].curprio
+        entry = (priority, next(self.turns))
+        self.entries[slot] = entry
+        heapq.heappush(self.heap, (*entry, slot))
+
+    def _next_slot(self):
+        """Return the first store in turn order whose next request has the best priority."""
+        heap = self.heap
+        while heap:
+            priority, turn, slot = heap[0]
+            if self.entries.get(slot) == (priority, turn):
+                return slot
+            heapq.heappop(heap)
+        return None
+
+    def push(self, request):
+        slot = self.slot_for(request)
+        queue = self.pqueues.get(slot)
+        if queue is None:
+            queue = self.pqueues[slot] = self.pqfactory(slot)
+        queue.push(request)
+        entry = self.entries.get(slot)
+        if entry is None or queue.curprio != entry[0]:
+            self.schedule(slot)
+
+    def pop(self):
+        slot = self._next_slot()
+        if slot is None:
+            return None
+
+        heapq.heappop(self.heap)
+        queue = self.pqueues[slot]
+        request = queue.pop()
+        if len(queue) == 0:
+            del self.pqueues[slot]
+            del self.entries[slot]
+            queue.close()
+        else:
+            # Move this store to the back of the line
+            self.schedule(slot)
+        return request
+
+    def peek(self):
+        slot = self._next_slot()
+        if slot is None:
+            return None
+        return self.pqueues[slot].peek()
+
+    def close(self):
+        active = {slot: queue.close() for slot, queue in self.pqueues.items()}
+        self.pqueues.clear()
+        self.heap.clear()
+        self.entries.clear()
+        return active
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.pqueues.values()) if self.pqueues else 0
@@ -0,0 +1,400 @@
+"""Inverted index over the list fields of a run's products, for filtered lookups.
+
+Requires the optional ``numpy`` package. Ingredients, allergens, diets,
+additives and certifications don't depend on the store, so postings are
+per product: a sorted uint32 array of the product ids holding a term.
+Ingredient text is split into normalized word tokens ('Organic Rolled
+Oats' -> organic, rolled, oat), the other fields are whole labels
+('Gluten-Free' -> gluten-free).
+
+Product-store rows are sorted by store, then price, so a store is a
+contiguous range of rows and a price bound a binary search within it. A
+query intersects the postings of its terms (smallest first, by binary
+search into the larger ones), removes the products of excluded terms, and
+keeps the rows of the remaining products in the selected price ranges.
+
+The index is a single file, written once at the end of a crawl and
+memory-mapped for queries:
+
+    MAGIC, header length (uint64), JSON header, 8-byte aligned arrays
+
+The header holds the product slugs, names and brands, the (offset, count)
+of every term's postings and the (offset, dtype, length) of every array.
+"""
+import json
+import os
+import re
+import shlex
+import struct
+import time
+import unicodedata
+from array import array
+
+import numpy as np
+
+from food_scraper.nutrients import feed_items, to_float
+
+MAGIC = b'WFSEARCH1\n'
+FIELDS = ('ingredients', 'allergens', 'diets', 'additives', 'certifications')
+# Query field names, singular or plural
+FIELD_NAMES = {**{field: field for field in FIELDS}, **{field[:-1]: field for field in FIELDS}}
+# Ingredient words that don't tell products apart
+STOPWORDS = frozenset(('a', 'and', 'as', 'added', 'by', 'contains', 'for', 'from', 'in', 'less',
+                       'made', 'of', 'or', 'than', 'the', 'to', 'with'))
+PRICE_BOUND = re.compile(r'^price(<=|>=|<|>)(\d+(?:\.\d+)?)$')
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+
+def fold(text):
+    """Lowercase text without accents."""
+    return unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii').lower()
+
+
+def normalize_label(value):
+    """Term of a label field value ('Gluten Free', 'gluten-free' -> 'gluten-free')."""
+    return NON_ALPHANUMERIC.sub('-', fold(value)).strip('-')
+
+
+def stem(word):
+    """Singular of an ingredient word, roughly ('berries' -> 'berry', 'oats' -> 'oat')."""
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith(('oes', 'ches', 'shes', 'sses', 'xes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def ingredient_tokens(text):
+    """Normalized word tokens of ingredient text, in order, with repeats."""
+    return [stem(word) for word in NON_ALPHANUMERIC.split(fold(text))
+            if word and word not in STOPWORDS]
+
+
+def field_terms(field, value):
+    """Terms of one value of a field: tokens for ingredients, the normalized label otherwise."""
+    if field == 'ingredients':
+        return ingredient_tokens(value)
+    label = normalize_label(value)
+    return [label] if label else []
+
+
+def values_of(value):
+    """Values of a list field, which may be a list, a single string or missing."""
+    if value is None:
+        return ()
+    if isinstance(value, (list, tuple)):
+        return [entry for entry in value if entry is not None]
+    return (value,)
+
+
+def parse_query(text):
+    """Keyword arguments of SearchIndex.search() for a query string.
+
+    Whitespace-separated, with shell quoting for multi-word values:
+    'field:value' requires a term (fields: ingredient, allergen, diet,
+    additive, certification), '-field:value' excludes it, 'store:10509,10510'
+    picks stores and 'price<5', 'price<=5', 'price>2', 'price>=2' bound the
+    price. An ingredient value of several words requires all of them.
+    """
+    include, exclude, store_ids = [], [], None
+    min_price = max_price = None
+    for part in shlex.split(text):
+        bound = PRICE_BOUND.match(part)
+        if bound:
+            operator, price = bound.group(1), float(bound.group(2))
+            if operator.startswith('<'):
+                max_price = price if operator == '<=' else float(np.nextafter(price, -np.inf))
+            else:
+                min_price = price if operator == '>=' else float(np.nextafter(price, np.inf))
+            continue
+        name, separator, value = part.partition(':')
+        negated = name.startswith('-')
+        name = name.lstrip('-')
+        if not separator or not value:
+            raise ValueError(f"Invalid query term '{part}', expected field:value, store:IDS or price<N")
+        if name == 'store' and not negated:
+            try:
+                store_ids = [int(store_id) for store_id in value.split(',') if store_id]
+            except ValueError:
+                raise ValueError(f"Invalid store ids in '{part}'")
+            continue
+        if name not in FIELD_NAMES:
+            raise ValueError(f"Unknown query field '{name}', expected one of "
+                             f"{', '.join(field[:-1] for field in FIELDS)}, store or price")
+        (exclude if negated else include).append((FIELD_NAMES[name], value))
+    return {'include': include, 'exclude': exclude, 'store_ids': store_ids,
+            'min_price': min_price, 'max_price': max_price}
+
+
+def columnar_items(directory, filter=None):
+    """Rows of a columnar export as dicts of the fields the index needs, a batch at a time."""
+    from food_scraper.columnar import read_products
+
+    products = read_products(directory, ['slug', 'name', 'brand', 'price', 'store_id', *FIELDS], filter)
+    for batch in products.to_batches():
+        yield from batch.to_pylist()
+
+
+def intersect_sorted(a, b):
+    """Values in both sorted, unique arrays, by binary search of the smaller one into the larger."""
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return a
+    found = np.searchsorted(b, a)
+    found[found == len(b)] = 0
+    return a[b[found] == a]
+
+
+class SearchIndexBuilder:
+    """Collect product-store rows and the postings of their products, then write the index file.
+
+    Postings are appended as products are first seen, so they are sorted
+    as they are built; a product's list fields are taken from its first row.
+    """
+
+    def __init__(self):
+        self.product_ids = {}
+        self.names = []
+        self.brands = []
+        self.postings = {field: {} for field in FIELDS}
+        self.row_stores = array('q')
+        self.row_products = array('I')
+        self.row_prices = array('d')
+
+    @classmethod
+    def from_items(cls, items):
+        builder = cls()
+        for item in items:
+            builder.add(item)
+        return builder
+
+    @classmethod
+    def from_feeds(cls, paths):
+        """Collect the rows of product feeds: JSON arrays (product_data.json) or JSON lines."""
+        return cls.from_items(feed_items(paths))
+
+    @classmethod
+    def from_columnar(cls, directory, filter=None):
+        """Collect the rows of a columnar export (needs pyarrow)."""
+        return cls.from_items(columnar_items(directory, filter))
+
+    def __len__(self):
+        return len(self.row_products)
+
+    def add(self, item):
+        """Add a ProductItem, or a product feed row as a dict."""
+        slug = item.get('slug')
+        product = self.product_ids.get(slug)
+        if product is None:
+            product = self.product_ids[slug] = len(self.names)
+            self.names.append(item.get('name'))
+            self.brands.append(item.get('brand'))
+            for field in FIELDS:
+                postings = self.postings[field]
+                terms = {term for value in values_of(item.get(field)) for term in field_terms(field, value)}
+                for term in terms:
+                    posting = postings.get(term)
+                    if posting is None:
+                        posting = postings[term] = array('I')
+                    posting.append(product)
+        store_id = item.get('store_id')
+        self.row_stores.append(int(store_id) if store_id is not None else -1)
+        self.row_products.append(product)
+        price = to_float(item.get('price'))
+        self.row_prices.append(price if price is not None else np.nan)
+
+    @property
+    def term_count(self):
+        return sum(len(postings) for postings in self.postings.values())
+
+    def rows(self):
+        """(store ids, product ids, prices) of the rows sorted by store and price.
+
+        A product seen more than once in a store keeps its last row.
+        """
+        stores = np.frombuffer(self.row_stores, dtype=np.int64)
+        products = np.frombuffer(self.row_products, dtype=np.uint32)
+        prices = np.frombuffer(self.row_prices, dtype=np.float64)
+        if len(stores):
+            order = np.lexsort((np.arange(len(stores)), products, stores))
+            last = np.ones(len(order), dtype=bool)
+            last[:-1] = (stores[order][1:] != stores[order][:-1]) | (products[order][1:] != products[order][:-1])
+            order = order[last]
+            stores, products, prices = stores[order], products[order], prices[order]
+        # NaN prices sort last
+        order = np.lexsort((products, prices, stores))
+        return stores[order], products[order], prices[order]
+
+    def write(self, path, **metadata):
+        """Write the index file atomically, returning its size in bytes."""
+        stores, products, prices = self.rows()
+        store_ids, store_starts = np.unique(stores, return_index=True)
+        store_offsets = np.append(store_starts, len(stores)).astype(np.int64)
+
+        terms = {}
+        chunks = []
+        offset = 0
+        for field in FIELDS:
+            terms[field] = {}
+            for term, posting in sorted(self.postings[field].items()):
+                terms[field][term] = [offset, len(posting)]
+                chunks.append(posting)
+                offset += len(posting)
+        postings = np.concatenate([np.frombuffer(chunk, dtype=np.uint32) for chunk in chunks]) \
+            if chunks else np.zeros(0, dtype=np.uint32)
+
+        arrays = {'postings': postings, 'row_products': products, 'row_prices': prices,
+                  'store_ids': store_ids.astype(np.int64), 'store_offsets': store_offsets}
+        layout = {}
+        offset = 0
+        for name, values in arrays.items():
+            layout[name] = [offset, values.dtype.str, len(values)]
+            offset += -(-values.nbytes // 8) * 8
+        header = json.dumps({
+            'created_at': time.time(), **metadata,
+            'slugs': list(self.product_ids), 'names': self.names, 'brands': self.brands,
+            'terms': terms, 'arrays': layout,
+        }, ensure_ascii=False).encode('utf-8')
+        header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, f'.{os.path.basename(path)}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for values in arrays.values():
+                f.write(values.tobytes())
+                f.write(b'\0' * (-values.nbytes % 8))
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+
+class SearchIndex:
+    """A search index file, memory-mapped, with term and price/store queries."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} isn't a search index")
+            header_length, = struct.unpack('<Q', f.read(8))
+            self.header = json.loads(f.read(header_length))
+        data_offset = len(MAGIC) + 8 + header_length
+        self.data = np.memmap(path, dtype=np.uint8, mode='r', offset=data_offset) \
+            if os.path.getsize(path) > data_offset else np.zeros(0, dtype=np.uint8)
+        for name, (offset, dtype, length) in self.header['arrays'].items():
+            setattr(self, name, np.frombuffer(self.data, dtype=dtype, count=length, offset=offset)
+                    if length else np.zeros(0, dtype=dtype))
+        self.slugs = self.header['slugs']
+        self.names = self.header['names']
+        self.brands = self.header['brands']
+        self.terms = self.header['terms']
+
+    def __len__(self):
+        return len(self.row_products)
+
+    @property
+    def product_count(self):
+        return len(self.slugs)
+
+    def posting(self, field, term):
+        """Sorted product ids of a term, empty if no product has it."""
+        offset, count = self.terms[field].get(term, (0, 0))
+        return self.postings[offset:offset + count]
+
+    def matching(self, field, value):
+        """Product ids having every term of a field value."""
+        terms = field_terms(field, value)
+        if not terms:
+            raise ValueError(f"No {field} terms in '{value}'")
+        postings = sorted((self.posting(field, term) for term in set(terms)), key=len)
+        products = postings[0]
+        for posting in postings[1:]:
+            products = intersect_sorted(products, posting)
+        return products
+
+    def product_mask(self, include=(), exclude=()):
+        """Boolean array, per product id, of the products having every included value and no excluded one."""
+        if include:
+            products = sorted((self.matching(field, value) for field, value in include), key=len)
+            selected = products[0]
+            for other in products[1:]:
+                selected = intersect_sorted(selected, other)
+            mask = np.zeros(self.product_count, dtype=bool)
+            mask[selected] = True
+        else:
+            mask = np.ones(self.product_count, dtype=bool)
+        for field, value in exclude:
+            mask[self.matching(field, value)] = False
+        return mask
+
+    def row_ranges(self, store_ids, min_price, max_price):
+        """(start, end) ranges of the rows of some stores within a price range."""
+        if store_ids is None:
+            return [(0, len(self))]
+        ranges = []
+        for store_id in sorted(set(store_ids)):
+            position = np.searchsorted(self.store_ids, store_id)
+            if position == len(self.store_ids) or self.store_ids[position] != store_id:
+                continue
+            start, end = int(self.store_offsets[position]), int(self.store_offsets[position + 1])
+            prices = self.row_prices[start:end]
+            if min_price is not None:
+                start += int(np.searchsorted(prices, min_price, 'left'))
+            if max_price is not None:
+                end -= len(prices) - int(np.searchsorted(prices, max_price, 'right'))
+            if start < end:
+                ranges.append((start, end))
+        return ranges
+
+    def rows(self, include=(), exclude=(), store_ids=None, min_price=None, max_price=None):
+        """Row numbers of the matching product-store rows, by store and price."""
+        mask = self.product_mask(include, exclude)
+        found = []
+        for start, end in self.row_ranges(store_ids, min_price, max_price):
+            keep = mask[self.row_products[start:end]]
+            if store_ids is None and (min_price is not None or max_price is not None):
+                # Rows of all stores aren't sorted by price
+                prices = self.row_prices[start:end]
+                with np.errstate(invalid='ignore'):
+                    if min_price is not None:
+                        keep &= prices >= min_price
+                    if max_price is not None:
+                        keep &= prices <= max_price
+            found.append(np.flatnonzero(keep) + start)
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def row(self, row):
+        product = int(self.row_products[row])
+        store = np.searchsorted(self.store_offsets, row, 'right') - 1
+        price = float(self.row_prices[row])
+        return {'store_id': int(self.store_ids[store]), 'slug': self.slugs[product],
+                'name': self.names[product], 'brand': self.brands[product],
+                'price': price if price == price else None}
+
+    def search(self, include=(), exclude=(), store_ids=None, min_price=None, max_price=None, limit=None):
+        """Matching rows as dicts, cheapest first within each store.
+
+        include and exclude are (field, value) pairs, see parse_query() for
+        the same as a query string.
+        """
+        rows = self.rows(include, exclude, store_ids, min_price, max_price)
+        if limit is not None:
+            rows = rows[:limit]
+        return [self.row(row) for row in rows]
+
+    def query(self, text, limit=None):
+        """Matching rows of a query string, e.g. 'diet:gluten-free ingredient:oats store:10509 price<5'."""
+        return self.search(**parse_query(text), limit=limit)
+
+    def close(self):
+        # Drop the references to the mapped file
+        for name in self.header['arrays']:
+            setattr(self, name, None)
+        self.data = None
@@ -13,6 +13,7 @@ BOT_NAME = "food_scraper"
 
 SPIDER_MODULES = ["food_scraper.spiders"]
 NEWSPIDER_MODULE = "food_scraper.spiders"
+COMMANDS_MODULE = "food_scraper.commands"
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -22,18 +23,25 @@ NEWSPIDER_MODULE = "food_scraper.spiders"
 ROBOTSTXT_OBEY = False
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 25
+# Store summary, listing and detail requests are further limited by the
+# AdaptiveConcurrencyMiddleware windows below
+CONCURRENT_REQUESTS = 100
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
 # See also autothrottle settings and docs
-DOWNLOAD_DELAY = 1.1
+# No fixed delay: AdaptiveConcurrencyMiddleware paces the JSON endpoints.
+# Set DOWNLOAD_DELAY = 1.1 if ADAPTIVE_CONCURRENCY_ENABLED is turned off
+DOWNLOAD_DELAY = 0
 # AUTOTHROTTLE_ENABLED = True
 # AUTOTHROTTLE_TARGET_CONCURRENCY = 25
 # The download delay setting will honor only one of:
 CONCURRENT_REQUESTS_PER_DOMAIN = 25
 CONCURRENT_REQUESTS_PER_IP = 25
 
+# Interleave stores fairly so one large store can't starve the others
+SCHEDULER_PRIORITY_QUEUE = "food_scraper.scheduler.StoreRoundRobinPriorityQueue"
+
 # Disable cookies (enabled by default)
 # COOKIES_ENABLED = False
 
@@ -48,29 +56,41 @@ CONCURRENT_REQUESTS_PER_IP = 25
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-# SPIDER_MIDDLEWARES = {
-#    "food_scraper.middlewares.FoodScraperSpiderMiddleware": 543,
-# }
+SPIDER_MIDDLEWARES = {
+    #    "food_scraper.middlewares.FoodScraperSpiderMiddleware": 543,
+    'food_scraper.middlewares.CallbackProfilerMiddleware': 950,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
     #    "food_scraper.middlewares.FoodScraperDownloaderMiddleware": 543,
+    'food_scraper.middlewares.CheckpointMiddleware': 50,
+    'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+    'food_scraper.middlewares.RetryPolicyMiddleware': 550,
+    'food_scraper.middlewares.FixtureRecorderMiddleware': 580,
     'food_scraper.middlewares.ScrapeOpsFakeBrowserHeadersMiddleware': 700,
-    'food_scraper.middlewares.ScrapeOpsProxyMiddleware': 725,
+    'food_scraper.middlewares.TieredProxyMiddleware': 725,
+    'food_scraper.middlewares.AdaptiveConcurrencyMiddleware': 760,
 }
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-# }
+EXTENSIONS = {
+    'food_scraper.extensions.MetricsExtension': 500,
+}
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-# ITEM_PIPELINES = {
-#    "food_scraper.pipelines.FoodScraperPipeline": 300,
-# }
+ITEM_PIPELINES = {
+    #    "food_scraper.pipelines.FoodScraperPipeline": 300,
+    'food_scraper.pipelines.CheckpointDuplicatesPipeline': 900,
+    'food_scraper.pipelines.ColumnarExportPipeline': 950,
+    'food_scraper.pipelines.PriceHistoryPipeline': 960,
+    'food_scraper.pipelines.ChangeDetectionPipeline': 970,
+    'food_scraper.pipelines.StoreIndexPipeline': 980,
+    'food_scraper.pipelines.SearchIndexPipeline': 990,
+}
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -103,6 +123,180 @@ SCRAPEOPS_PROXY_SETTINGS = {'country': 'us'}
 SCRAPEOPS_FAKE_HEADERS_ENABLED = True
 SCRAPEOPS_NUM_RESULTS = 30  # Number of different browser headers to fetch
 
+# Proxy tiers used by TieredProxyMiddleware, cheapest first
+PROXY_TIERS = ['direct', 'datacenter', 'residential', 'render']
+# ScrapeOps credits per request at each tier, recorded in the proxy_tier/ stats
+PROXY_TIER_COSTS = {'direct': 0, 'datacenter': 1,
+                    'residential': 10, 'render': 25}
+# Starting tier per endpoint class (homepage, store_summary, listing, detail);
+# unlisted classes start direct
+PROXY_ENDPOINT_START_TIERS = {}
+# Blocked responses before a whole endpoint class moves up a tier
+PROXY_ESCALATE_AFTER = 5
+# Seconds without blocks before an endpoint class moves back down a tier
+PROXY_DEESCALATE_AFTER = 600
+
+# AIMD concurrency windows per endpoint class (store_summary, listing, detail),
+# see AdaptiveConcurrencyMiddleware. A window grows by about one request per
+# round trip while latency and error rate stay flat, and is multiplied by
+# ADAPTIVE_CONCURRENCY_BACKOFF on 429/5xx responses, blocks or download errors
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_CONCURRENCY_START = 4
+ADAPTIVE_CONCURRENCY_MIN = 1
+ADAPTIVE_CONCURRENCY_MAX = 32
+ADAPTIVE_CONCURRENCY_BACKOFF = 0.5
+# Windows stop growing while the average latency is above this multiple of the lowest seen...
+ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE = 2.0
+# ...or while more than this share of recent responses were errors
+ADAPTIVE_CONCURRENCY_ERROR_TOLERANCE = 0.05
+# Seconds between goodput updates in the adaptive_concurrency/ stats
+ADAPTIVE_CONCURRENCY_STATS_INTERVAL = 10
+
+# Retry policies per endpoint class (homepage, store_summary, listing, detail),
+# see RetryPolicyMiddleware. Retry n waits a random 0 to
+# min(max_delay, base_delay * 2**n) seconds; unlisted classes use 'default'
+RETRY_POLICIES = {
+    'default': {'max_retries': 2, 'base_delay': 1, 'max_delay': 30},
+    'homepage': {'max_retries': 5, 'base_delay': 2, 'max_delay': 60},
+    'store_summary': {'max_retries': 4, 'base_delay': 1, 'max_delay': 30},
+    'listing': {'max_retries': 4, 'base_delay': 1, 'max_delay': 30},
+    'detail': {'max_retries': 2, 'base_delay': 1, 'max_delay': 15},
+}
+# Global retry budget: every first attempt earns RETRY_BUDGET_RATIO of a
+# retry, so retries stay under ~10% of requests once the starting
+# RETRY_BUDGET_MIN is spent. Unspent retries are capped at RETRY_BUDGET_MAX
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MIN = 10
+RETRY_BUDGET_MAX = 100
+
+# Requests that fail for good are appended to <DEAD_LETTER_DIR>/<run_id>.jsonl
+# with their crawl context, and re-run with `scrapy replay`. The first
+# DEAD_LETTER_BODY_SAMPLE_BYTES of each failing body are kept under
+# <DEAD_LETTER_DIR>/bodies/, named by their SHA-1
+DEAD_LETTER_DIR = 'dead_letters'
+DEAD_LETTER_BODY_SAMPLE_BYTES = 64 * 1024
+
+# Last known Next.js buildId, checked with one _next/data request at startup
+# instead of fetching the homepage every run
+BUILD_ID_CACHE_PATH = 'build_id.json'
+
+# Last observed listing total per (store, category), used to request every
+# page of a category at once instead of waiting for the first page's count
+CATEGORY_SIZE_CACHE_PATH = 'category_sizes.json'
+# Largest listing page size to try; the size the API actually serves is
+# learned and remembered with the category sizes
+LISTING_MAX_PAGE_SIZE = 200
+
+# Persistent product detail cache for incremental crawls: listings whose
+# name/price/slug/brand are unchanged reuse cached details instead of
+# requesting them again
+DETAIL_CACHE_ENABLED = False
+DETAIL_CACHE_PATH = 'product_detail_cache.sqlite3'
+DETAIL_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+
+# Related product discovery (-a related_depth=N): after the listings, the
+# related products of every crawled product that no listing had are
+# requested, N links deep, at most RELATED_DISCOVERY_BUDGET detail requests
+# in all (0 for no limit). The (store, slug) pairs seen are kept in SQLite at
+# RELATED_SEEN_PATH behind a Bloom filter sized for RELATED_SEEN_CAPACITY
+# pairs at RELATED_SEEN_ERROR_RATE false positives (about 1.2 MB per million)
+RELATED_DISCOVERY_BUDGET = 10000
+RELATED_SEEN_PATH = 'related_seen.sqlite3'
+RELATED_SEEN_CAPACITY = 5000000
+RELATED_SEEN_ERROR_RATE = 0.01
+
+# Items of products listed in several categories get every category
+# (listed_categories). An item is held while its store still has listing
+# pages pending in categories it wasn't listed in yet; past
+# LISTING_HOLD_MAX_ITEMS held items (0 for no limit), a store's held items
+# are released with the categories listed so far
+LISTING_HOLD_MAX_ITEMS = 100000
+
+# Decode listing and product detail JSON straight into typed records with
+# msgspec (in requirements.txt). Falls back to the stdlib json module when
+# msgspec is missing or a response doesn't match the schema
+FAST_DECODE_ENABLED = True
+
+# Also write ProductItems to a Parquet dataset (pip install pyarrow),
+# partitioned by run date, store and category, with nutrition elements in a
+# separate long-format table. A partition's rows are written once
+# COLUMNAR_BATCH_ROWS are buffered, and the largest partitions early when
+# more than COLUMNAR_MAX_BUFFERED_ROWS products are buffered in total
+COLUMNAR_EXPORT_ENABLED = False
+COLUMNAR_EXPORT_DIR = 'columnar'
+COLUMNAR_BATCH_ROWS = 5000
+COLUMNAR_MAX_BUFFERED_ROWS = 50000
+COLUMNAR_COMPRESSION = 'zstd'
+
+# Append-only price history (see `scrapy history`): every crawl is a run, and
+# price/is_available/rank observations are only stored when they differ from
+# the previous one for that store and slug. Items are diffed and written
+# PRICE_HISTORY_BATCH_SIZE at a time, one transaction per batch
+PRICE_HISTORY_ENABLED = False
+PRICE_HISTORY_PATH = 'price_history.sqlite3'
+PRICE_HISTORY_BATCH_SIZE = 1000
+
+# StoreItems are kept in this SQLite store index (see `scrapy stores`),
+# always by -a mode=stores crawls and by every crawl if STORE_INDEX_ENABLED
+# is set, with a grid of STORE_INDEX_CELL_DEGREES cells over the store
+# coordinates for radius queries. -a mode=stores crawls discover stores by
+# requesting the summary of every id from STORE_DISCOVERY_FIRST_ID to
+# STORE_DISCOVERY_LAST_ID, and -a select_stores picks the store_ids of a
+# crawl from the index
+STORE_INDEX_ENABLED = False
+STORE_INDEX_PATH = 'store_index.sqlite3'
+STORE_INDEX_CELL_DEGREES = 1.0
+STORE_DISCOVERY_FIRST_ID = 10000
+STORE_DISCOVERY_LAST_ID = 10999
+
+# Diff feed of added / changed / removed products (jsonlines). Every
+# ProductItem is hashed and compared with the previous run's hash index, which
+# is kept in CHANGE_INDEX_PATH and looked up CHANGE_INDEX_BATCH_SIZE items at a
+# time
+CHANGE_DETECTION_ENABLED = False
+CHANGE_FEED_PATH = 'product_changes.jsonl'
+CHANGE_INDEX_PATH = 'change_index.sqlite3'
+CHANGE_INDEX_BATCH_SIZE = 1000
+
+# Inverted index of the crawl's products (pip install numpy, see `scrapy
+# search`): postings of ingredient tokens, allergens, diets, additives and
+# certifications, and product-store rows sorted by store and price. Written
+# to SEARCH_INDEX_PATH at the end of the crawl
+SEARCH_INDEX_ENABLED = False
+SEARCH_INDEX_PATH = 'search_index.bin'
+
+# Record every response of a crawl into this fixture archive (SQLite), for
+# offline replays with food_scraper.fixtures.FixtureDownloadHandler and
+# `scrapy benchmark`
+FIXTURE_RECORD_PATH = None
+# Archive the FixtureDownloadHandler answers from. With both synthetic
+# settings, unrecorded stores are served too and the recorded products are
+# repeated to make FIXTURE_SYNTHETIC_PRODUCTS in total across that many stores
+FIXTURE_REPLAY_PATH = None
+FIXTURE_SYNTHETIC_STORES = 0
+FIXTURE_SYNTHETIC_PRODUCTS = 0
+# CPU time per spider callback, in the callback_cpu/ stats
+CALLBACK_PROFILE_ENABLED = False
+
+# Queue wait and download latency histograms, bytes, responses and items per
+# endpoint class and proxy tier, callback CPU histograms, and pending requests
+# and RSS sampled every METRICS_SAMPLE_INTERVAL seconds (the last
+# METRICS_MAX_SAMPLES samples, thinned out on long crawls). Written to the
+# spider stats file under 'metrics'. With METRICS_PORT set (e.g. 9410, 0 for
+# any free port), served live in the Prometheus text format at
+# http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = True
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+METRICS_SAMPLE_INTERVAL = 5
+METRICS_MAX_SAMPLES = 720
+
+# Send every request (site and proxy URLs alike) to a local mock of the site
+# and the ScrapeOps proxy started with `scrapy mocksite`, for load tests, e.g.
+# 'http://127.0.0.1:8800'. Set SCRAPEOPS_API_KEY to any value to test the
+# proxy tiers too
+MOCK_SITE_URL = None
+
 FEEDS = {
     'store_data.json': {
         'format': 'json',
@@ -119,3 +313,116 @@ FEEDS = {
         'item_classes': ['food_scraper.items.ProductItem'],
     },
 }
+
+# Feeds used instead of FEEDS for listing-only price runs (-a mode=prices)
+PRICE_FEEDS = {
+    'price_data.jsonl': {
+        'format': 'jsonlines',
+        'overwrite': True,
+        'encoding': 'utf8',
+        'item_classes': ['food_scraper.items.PriceItem'],
+    },
+}
+
+# Feeds used instead of FEEDS for store discovery runs (-a mode=stores)
+STORE_FEEDS = {
+    'store_data.json': {
+        'format': 'json',
+        'overwrite': True,
+        'encoding': 'utf8',
+        'indent': 4,
+        'item_classes': ['food_scraper.items.StoreItem'],
+    },
+}
+
+# Feeds used instead of FEEDS (or PRICE_FEEDS, STORE_FEEDS) when replaying dead letters
+REPLAY_FEEDS = {
+    'replay_store_data.jsonl': {
+        'format': 'jsonlines',
+        'overwrite': True,
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.StoreItem'],
+    },
+    'replay_product_data.jsonl': {
+        'format': 'jsonlines',
+        'overwrite': True,
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.ProductItem'],
+    },
+    'replay_price_data.jsonl': {
+        'format': 'jsonlines',
+        'overwrite': True,
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.PriceItem'],
+    },
+}
+
+# Crash-safe checkpoints (-a checkpoint=<dir>): outstanding requests, spider
+# state and feed lengths are saved to <dir>/checkpoint.pickle every
+# CHECKPOINT_INTERVAL seconds, and a crawl started again with the same
+# directory resumes from there
+CHECKPOINT_INTERVAL = 30  # seconds
+# Longest wait for the spider to finish processing responses before a
+# checkpoint; past it, downloads are paused until the spider catches up
+CHECKPOINT_MAX_WAIT = 1  # seconds
+FEED_STORAGES = {'checkpoint': 'food_scraper.checkpoint.CheckpointFeedStorage'}
+
+# Feeds used instead of FEEDS by checkpointed crawls; %(checkpoint)s is the
+# checkpoint directory
+CHECKPOINT_FEEDS = {
+    'checkpoint:%(checkpoint)s/store_data.jsonl': {
+        'format': 'jsonlines',
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.StoreItem'],
+    },
+    'checkpoint:%(checkpoint)s/product_data.jsonl': {
+        'format': 'jsonlines',
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.ProductItem'],
+    },
+    'checkpoint:%(checkpoint)s/price_data.jsonl': {
+        'format': 'jsonlines',
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.PriceItem'],
+    },
+}
+
+# Distributed crawl frontier (see `scrapy coordinate`). Workers lease
+# (store, category) units, keep them alive with heartbeats and complete them
+# once their feeds are stored; units of a worker that dies are re-leased
+# after FRONTIER_LEASE_TIMEOUT
+FRONTIER_URI = 'sqlite:///frontier.sqlite3'
+FRONTIER_LEASE_BATCH = 4
+FRONTIER_LEASE_TIMEOUT = 120  # seconds
+FRONTIER_HEARTBEAT_INTERVAL = 30  # seconds
+# Workers exit after this many units, bounding the work redone if one dies
+FRONTIER_UNITS_PER_WORKER = 40
+
+# Feeds used instead of FEEDS by frontier workers; %(output_dir)s and
+# %(worker_id)s are spider attributes
+FRONTIER_WORKER_FEEDS = {
+    '%(output_dir)s/%(worker_id)s/store_data.jsonl': {
+        'format': 'jsonlines',
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.StoreItem'],
+    },
+    '%(output_dir)s/%(worker_id)s/product_data.jsonl': {
+        'format': 'jsonlines',
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.ProductItem'],
+    },
+    '%(output_dir)s/%(worker_id)s/price_data.jsonl': {
+        'format': 'jsonlines',
+        'encoding': 'utf8',
+        'store_empty': False,
+        'item_classes': ['food_scraper.items.PriceItem'],
+    },
+}
@@ -1,10 +1,36 @@
 import scrapy
 import json
+import os
+import socket
 import time
+from dataclasses import asdict
 from datetime import datetime
 from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet.task import LoopingCall
 from scrapy.loader import ItemLoader
-from food_scraper.items import StoreItem, ProductItem
+from scrapy.utils.request import request_from_dict
+from itemloaders.utils import arg_to_iter
+from food_scraper.buildid import BuildIdCache, extract_build_id
+from food_scraper.cache import ProductDetailCache
+from food_scraper.checkpoint import CrawlCheckpoint
+from food_scraper.context import CrawlContext
+from food_scraper.deadletter import DeadLetterStore
+from food_scraper.discovery import SeenProducts
+from food_scraper.endpoints import endpoint_for_request
+from food_scraper.extensions import MetricsExtension
+from food_scraper.frontier import open_frontier
+from food_scraper.pagination import CategorySizeCache, category_total, plan_pages
+from food_scraper.items import StoreItem, ProductItem, PriceItem, PartialProduct, take_first
+from food_scraper.listings import ListingMemberships
+from food_scraper.retry import RetryScheduled
+from food_scraper.stores import StoreIndex
+
+try:
+    from food_scraper import decoding
+except ImportError:
+    # msgspec is optional, without it every response is decoded with the stdlib json module
+    decoding = None
 
 
 class WholeFoodsSpider(scrapy.Spider):
@@ -28,33 +54,276 @@ class WholeFoodsSpider(scrapy.Spider):
         'seafood',
         'beverages'
     ]
+    # Default listing page size; larger pages up to LISTING_MAX_PAGE_SIZE are
+    # tried and the size the API actually serves is remembered
     limit = 60
 
-    # Track current store and category being processed
-    current_store_id = None
-    current_category = None
+    # 'full' crawls product details, 'prices' only yields PriceItems from the
+    # category listings (select with -a mode=prices), 'stores' discovers
+    # stores by requesting the summary of every id from
+    # STORE_DISCOVERY_FIRST_ID to STORE_DISCOVERY_LAST_ID and of every store
+    # already in the store index (-a mode=stores)
+    mode = 'full'
+    modes = ('full', 'prices', 'stores')
+
+    # Pick store_ids from the store index instead, e.g.
+    # -a select_stores='near:42.36,-71.06,50' or 'per:zip3' (see StoreIndex.select)
+    select_stores = None
 
     # For request queuing system
     build_id = None
     build_id_available = False
-    product_detail_queue = []
+
+    # Fetch store-independent product details once per slug and share them
+    # across stores (enable with -a share_details=true)
+    share_details = False
+    # Fields that differ between stores and must come from the listing data
+    # when details are shared
+    store_specific_fields = ('rank', 'is_available')
+
+    # Work as one of many crawl workers leasing (store, category) units from a
+    # shared frontier instead of crawling store_ids x categories directly
+    # (see `scrapy coordinate`; enable with -a frontier=sqlite:///frontier.sqlite3)
+    frontier = None
+    worker_id = None
+    output_dir = '.'
+
+    # Re-issue only the requests recorded in these dead letter files instead
+    # of crawling (see `scrapy replay`; -a replay=dead_letters/<run_id>.jsonl)
+    replay = None
+
+    # Save crash-safe checkpoints to this directory and resume from the last
+    # one when started again with the same directory (-a checkpoint=crawl_state)
+    checkpoint = None
+
+    # Follow the related products of crawled products up to this many links
+    # away, requesting the details of the ones the category listings missed
+    # (-a related_depth=2, see RELATED_DISCOVERY_BUDGET)
+    related_depth = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Spider arguments (-a) arrive as strings
+        if isinstance(self.store_ids, str):
+            self.store_ids = [int(store_id)
+                              for store_id in self.store_ids.split(',') if store_id.strip()]
+        if isinstance(self.categories, str):
+            self.categories = [category.strip()
+                               for category in self.categories.split(',') if category.strip()]
+        if self.mode not in self.modes:
+            raise ValueError(
+                f"Unknown mode '{self.mode}', expected one of {self.modes}")
+        if isinstance(self.share_details, str):
+            self.share_details = self.share_details.lower() in ('1', 'true', 'yes')
+        if isinstance(self.replay, str):
+            self.replay = [path.strip() for path in self.replay.split(',') if path.strip()]
+        if self.replay and self.frontier:
+            raise ValueError("replay can't be combined with a frontier")
+        if self.checkpoint and self.frontier:
+            raise ValueError(
+                "checkpoint can't be combined with a frontier, workers resume from the frontier itself")
+        if self.mode == 'stores' and self.frontier:
+            raise ValueError("store discovery can't be combined with a frontier")
+        if self.select_stores and 'store_ids' in kwargs:
+            raise ValueError("Use either store_ids or select_stores")
+        # Whether the store_ids are the class default, which discovery replaces
+        self.default_store_ids = 'store_ids' not in kwargs
+        if isinstance(self.related_depth, str):
+            self.related_depth = int(self.related_depth)
+        if self.related_depth and (self.mode != 'full' or self.frontier or self.replay):
+            raise ValueError("related_depth only applies to full crawls, without a frontier or replay")
+        # Depth of the related products being crawled, 0 while the listings are
+        self.related_level = 0
+        self.related_requested = 0
+        # (store_id, slug) pairs seen through related products, opened by from_crawler
+        self.seen_products = None
+
+        # slug -> store-independent detail values (None if the product was skipped)
+        self.shared_details = {}
+        # slug -> (PartialProduct, listing fingerprint) waiting for the shared detail request
+        self.shared_detail_waiters = {}
+        # Categories every (store_id, slug) pair was listed under this run; a pair
+        # gets one detail request however many listings it appears in
+        self.listed_products = ListingMemberships(self.categories)
+        # store_id -> {category: listing pages requested and not answered yet}
+        self.listing_pages_pending = {}
+        # store_id -> items waiting for the rest of their store's listings
+        self.held_items = {}
+        self.held_item_count = 0
+        # Most items held at once, None for no limit (LISTING_HOLD_MAX_ITEMS)
+        self.listing_hold_max_items = None
+
+        # Detail requests waiting for the buildId
+        self.product_detail_queue = []
+        # Detail requests that 404'd under a buildId that may have rotated mid-crawl
+        self.build_id_retry_queue = []
+        self.build_id_refreshing = False
+        self.build_id_probe_saved = False
+
+        # (store_id, category) -> listing offset up to which pages have been requested
+        self.listing_planned_ends = {}
+
+        # Store ids whose summary 404'd during store discovery
+        self.stores_not_found = set()
+
+        # Frontier units leased by this worker; completed only once the feeds are stored
+        self.leased_units = []
+        if self.frontier and not self.worker_id:
+            self.worker_id = f'{socket.gethostname()}-{os.getpid()}'
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super(WholeFoodsSpider, cls).from_crawler(
             crawler, *args, **kwargs)
+        if spider.mode == 'prices':
+            # Price runs write their own compact feed instead of product_data.json
+            crawler.settings.set('FEEDS', crawler.settings.getdict(
+                'PRICE_FEEDS'), priority='spider')
+
+        if spider.mode == 'stores':
+            # Discovery only yields StoreItems, product_data.json is left alone
+            crawler.settings.set('FEEDS', crawler.settings.getdict(
+                'STORE_FEEDS'), priority='spider')
+            # ... and keeps them in the store index
+            crawler.settings.set('STORE_INDEX_ENABLED', True, priority='spider')
+
+        # Frontier workers get their stores from the frontier, selected by the coordinator
+        if not spider.frontier and (
+                spider.select_stores or (spider.mode == 'stores' and spider.default_store_ids)):
+            spider.store_ids = spider.pick_store_ids(crawler.settings)
+
+        if spider.replay:
+            # Replays write their own feeds so the full run's output is kept
+            crawler.settings.set('FEEDS', crawler.settings.getdict(
+                'REPLAY_FEEDS'), priority='spider')
+
+        if crawler.settings.get('MOCK_SITE_URL'):
+            # Load test against `scrapy mocksite` instead of the real site
+            handler = 'food_scraper.mocksite.MockSiteDownloadHandler'
+            crawler.settings.set('DOWNLOAD_HANDLERS', {'http': handler, 'https': handler},
+                                 priority='spider')
+
+        spider.checkpoint_store = None
+        if spider.checkpoint:
+            spider.checkpoint_store = CrawlCheckpoint(spider.checkpoint)
+            # Feeds that can be cut back to the last checkpoint and appended to on resume
+            crawler.settings.set('FEEDS', crawler.settings.getdict(
+                'CHECKPOINT_FEEDS'), priority='spider')
+
+        # Requests that fail for good are kept for `scrapy replay`
+        spider.run_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{spider.worker_id or os.getpid()}"
+        spider.dead_letters = DeadLetterStore.from_settings(crawler.settings, spider.run_id)
+
+        spider.build_id_cache = BuildIdCache.from_settings(crawler.settings)
+
+        spider.category_sizes = CategorySizeCache.from_settings(crawler.settings)
+        spider.page_size = spider.category_sizes.page_size or max(
+            spider.limit, crawler.settings.getint('LISTING_MAX_PAGE_SIZE'))
+
+        spider.listing_hold_max_items = crawler.settings.getint('LISTING_HOLD_MAX_ITEMS') or None
+
+        spider.fast_decode = crawler.settings.getbool('FAST_DECODE_ENABLED')
+        if spider.fast_decode and decoding is None:
+            spider.logger.warning(
+                "FAST_DECODE_ENABLED is set but msgspec is not installed, using the stdlib json decoder")
+            spider.fast_decode = False
+
+        spider.detail_cache = None
+        if crawler.settings.getbool('DETAIL_CACHE_ENABLED'):
+            spider.detail_cache = ProductDetailCache.from_settings(
+                crawler.settings)
+
+        if spider.related_depth:
+            # A resumed crawl keeps the pairs it already saw and queued
+            spider.seen_products = SeenProducts.from_settings(
+                crawler.settings, resume=spider.checkpoint_store is not None and spider.checkpoint_store.resumed)
+            spider.related_budget = crawler.settings.getint('RELATED_DISCOVERY_BUDGET')
+            crawler.signals.connect(spider.crawl_related_products,
+                                    signal=signals.spider_idle)
+
+        spider.frontier_backend = None
+        if spider.frontier:
+            spider.frontier_backend = open_frontier(spider.frontier)
+            spider.frontier_lease_batch = crawler.settings.getint(
+                'FRONTIER_LEASE_BATCH')
+            spider.frontier_lease_timeout = crawler.settings.getfloat(
+                'FRONTIER_LEASE_TIMEOUT')
+            spider.frontier_units_per_worker = crawler.settings.getint(
+                'FRONTIER_UNITS_PER_WORKER')
+            # Each worker writes its own jsonlines feeds, merged by the coordinator
+            crawler.settings.set('FEEDS', crawler.settings.getdict(
+                'FRONTIER_WORKER_FEEDS'), priority='spider')
+            crawler.signals.connect(spider.spider_idle,
+                                    signal=signals.spider_idle)
+            crawler.signals.connect(spider.feed_exporter_closed,
+                                    signal=signals.feed_exporter_closed)
         crawler.signals.connect(spider.spider_opened,
                                 signal=signals.spider_opened)
         crawler.signals.connect(spider.spider_closed,
                                 signal=signals.spider_closed)
         return spider
 
+    def pick_store_ids(self, settings):
+        """Store ids from the store index: the select_stores ones, or every id discovery probes"""
+        index = StoreIndex.from_settings(settings)
+        try:
+            if not self.select_stores:
+                return sorted(set(range(settings.getint('STORE_DISCOVERY_FIRST_ID'),
+                                        settings.getint('STORE_DISCOVERY_LAST_ID') + 1)) | set(index.stores))
+            store_ids = index.select(self.select_stores)
+        finally:
+            index.close()
+        if not store_ids:
+            raise ValueError(
+                f"No stores in {index.path} match '{self.select_stores}', "
+                f"discover them first with -a mode=stores")
+        self.logger.info(f"Selected {len(store_ids)} stores with '{self.select_stores}'")
+        return store_ids
+
     def spider_opened(self, spider):
         self.start_time = time.time()
         self.start_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.logger.info(f"Spider opened at {self.start_datetime}")
 
+        if self.checkpoint_store is not None and self.checkpoint_store.resumed:
+            self.restore_checkpoint_state(self.checkpoint_store.spider_state)
+            self.logger.info(
+                f"Resuming the crawl started at {self.start_datetime} from {self.checkpoint_store.path}")
+
+        if self.frontier_backend is not None:
+            self.frontier_heartbeat = LoopingCall(self.heartbeat_work_units)
+            self.frontier_heartbeat.start(
+                self.crawler.settings.getfloat('FRONTIER_HEARTBEAT_INTERVAL'), now=False)
+
     def spider_closed(self, spider):
+        if self.detail_cache is not None:
+            self.detail_cache.close()
+        if self.seen_products is not None:
+            found = self.crawler.stats.get_value('wholefoods/related/found', 0)
+            self.crawler.stats.set_value('wholefoods/related/seen', self.seen_products.count())
+            self.crawler.stats.set_value(
+                'wholefoods/related/bloom_false_positives', self.seen_products.false_positive_count)
+            self.seen_products.close()
+            # The final checkpoint is saved after this
+            self.seen_products = None
+            self.logger.info(
+                f"Found {found} products the category listings missed through related products, "
+                f"{self.related_requested} requested up to depth {self.related_level}")
+        self.crawler.stats.set_value('wholefoods/listings/listed_products', len(self.listed_products))
+        self.crawler.stats.set_value(
+            'wholefoods/listings/multi_category_products', self.listed_products.multi_category_count)
+        self.crawler.stats.set_value('wholefoods/listings/membership_bytes', self.listed_products.nbytes)
+        if self.held_item_count:
+            # Their stores' listing pages were never all answered
+            self.logger.error(f"{self.held_item_count} items were still waiting for listings of "
+                              f"stores {sorted(self.held_items)}")
+        self.category_sizes.save()
+        self.dead_letters.close()
+        if self.dead_letters.count:
+            self.logger.warning(
+                f"{self.dead_letters.count} requests failed for good, replay them with "
+                f"`scrapy replay {self.dead_letters.path}`")
+
         self.end_time = time.time()
         self.end_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         runtime_seconds = self.end_time - self.start_time
@@ -62,6 +331,7 @@ class WholeFoodsSpider(scrapy.Spider):
 
         # Get stats from the crawler
         stats = spider.crawler.stats.get_stats()
+        metrics = spider.crawler.get_extension(MetricsExtension)
 
         # Create a dictionary with the information we want to save
         spider_stats = {
@@ -72,12 +342,66 @@ class WholeFoodsSpider(scrapy.Spider):
             'runtime_minutes': round(runtime_minutes, 2),
             'store_ids': self.store_ids,
             'categories': self.categories,
+            'mode': self.mode,
+            'worker_id': self.worker_id,
+            'frontier_unit_count': len(self.leased_units),
+            'share_details': self.share_details,
+            'listed_product_count': stats.get('wholefoods/listings/listed_products', 0),
+            'repeated_listing_count': stats.get('wholefoods/listings/repeated_products', 0),
+            'multi_category_product_count': stats.get('wholefoods/listings/multi_category_products', 0),
+            'shared_detail_request_count': stats.get('wholefoods/shared_details/requested', 0),
+            'shared_detail_reuse_count': stats.get('wholefoods/shared_details/reused', 0),
+            'shared_detail_reassigned_count': stats.get('wholefoods/shared_details/reassigned', 0),
+            'detail_cache_hit_count': stats.get('wholefoods/detail_cache/hit', 0),
+            'detail_cache_negative_hit_count': stats.get('wholefoods/detail_cache/negative_hit', 0),
+            'detail_cache_miss_count': stats.get('wholefoods/detail_cache/miss', 0),
+            'fast_decode': self.fast_decode,
+            'fast_decode_fallback_count': stats.get('wholefoods/fast_decode/fallback', 0),
+            'columnar_product_rows': stats.get('columnar/product_rows', 0),
+            'price_history_run_id': stats.get('price_history/run_id'),
+            'price_history_change_count': stats.get('price_history/changes', 0),
+            'changes_added': stats.get('changes/added', 0),
+            'changes_changed': stats.get('changes/changed', 0),
+            'changes_removed': stats.get('changes/removed', 0),
             'item_scraped_count': stats.get('item_scraped_count', 0),
             'response_received_count': stats.get('response_received_count', 0),
             'request_count': stats.get('downloader/request_count', 0),
             'status_200_count': stats.get('downloader/response_status_count/200', 0),
             'status_404_count': stats.get('downloader/response_status_count/404', 0),
             'status_500_count': stats.get('downloader/response_status_count/500', 0),
+            'retry_count': stats.get('retry/count', 0),
+            'retry_budget_exhausted': {key[len('retry/budget_exhausted/'):]: value for key, value in stats.items()
+                                       if key.startswith('retry/budget_exhausted/')},
+            'dead_letter_count': self.dead_letters.count,
+            'dead_letter_path': self.dead_letters.path if self.dead_letters.count else None,
+            'replay': self.replay,
+            'checkpoint': self.checkpoint,
+            'resumed': self.checkpoint_store is not None and self.checkpoint_store.resumed,
+            'checkpoint_saved_count': stats.get('checkpoint/saved_count', 0),
+            'checkpoint_last_save_ms': stats.get('checkpoint/last_save_ms'),
+            'store_not_found_count': len(self.stores_not_found),
+            'store_index_updated_count': stats.get('store_index/updated', 0),
+            'related_depth': self.related_depth,
+            'related_requested_count': self.related_requested,
+            'related_found_count': stats.get('wholefoods/related/found', 0),
+            'related_not_found_count': stats.get('wholefoods/related/not_found', 0),
+            'related_found_categories': {
+                key[len('wholefoods/related/found_category/'):]: value for key, value in stats.items()
+                if key.startswith('wholefoods/related/found_category/')},
+            'search_index_rows': stats.get('search_index/rows', 0),
+            'listing_page_size': self.page_size,
+            'speculative_listing_page_count': stats.get('wholefoods/listings/speculative_pages', 0),
+            'empty_listing_page_count': stats.get('wholefoods/listings/empty_pages', 0),
+            'build_id': self.build_id,
+            'build_id_refresh_count': stats.get('wholefoods/build_id/refreshed', 0),
+            'build_id_retried_request_count': stats.get('wholefoods/build_id/retried_requests', 0),
+            'proxy_tiers': {key[len('proxy_tier/'):]: value for key, value in stats.items()
+                            if key.startswith('proxy_tier/')},
+            'adaptive_concurrency': {key[len('adaptive_concurrency/'):]: value for key, value in stats.items()
+                                     if key.startswith('adaptive_concurrency/')},
+            'callback_cpu': {key[len('callback_cpu/'):]: value for key, value in stats.items()
+                             if key.startswith('callback_cpu/')},
+            'metrics': metrics.summary() if metrics is not None else None,
         }
 
         # Save stats to a JSON file
@@ -93,105 +417,383 @@ class WholeFoodsSpider(scrapy.Spider):
     def start_requests(self):
         """Start by requesting the main page to get buildId (called only once)."""
         self.logger.info(
-            f"Starting spider with store_ids={self.store_ids}, categories={self.categories}")
+            f"Starting spider with store_ids={self.store_ids}, categories={self.categories}, mode={self.mode}")
+
+        if self.checkpoint_store is not None and self.checkpoint_store.resumed:
+            # Pick up exactly the requests that were outstanding
+            self.logger.info(
+                f"Re-issuing {len(self.checkpoint_store.requests)} requests from the checkpoint")
+            yield from self.checkpoint_store.pending_requests(self)
+            return
+
+        if self.mode == 'stores':
+            # Store summaries don't need the buildId
+            if self.replay:
+                yield from self.replay_dead_letters()
+                return
+            for store_id in self.store_ids:
+                yield self.make_store_summary_request(store_id)
+            return
+
+        if self.mode == 'prices':
+            # Prices come straight from the listings, so neither the buildId nor
+            # the store summaries are needed
+            if self.replay:
+                yield from self.replay_dead_letters()
+                return
+            if self.frontier_backend is not None:
+                yield from self.lease_work_units()
+                return
+            for store_id in self.store_ids:
+                for category in self.categories:
+                    yield from self.start_category_listings(store_id, category)
+            return
+
+        cached = self.build_id_cache.load()
+        if cached is not None:
+            # Check the last known buildId with one cheap _next/data request
+            # instead of fetching the homepage
+            yield self.make_build_id_probe_request(cached)
+        else:
+            yield self.make_homepage_request()
+
+    def checkpoint_state(self):
+        """Spider state a resumed crawl needs, saved with every checkpoint"""
+        if self.seen_products is not None:
+            # The related products seen so far have to be on disk with the checkpoint
+            self.seen_products.commit()
+        return {
+            'start_datetime': self.start_datetime,
+            'build_id': self.build_id,
+            'build_id_available': self.build_id_available,
+            'build_id_refreshing': self.build_id_refreshing,
+            'build_id_probe_saved': self.build_id_probe_saved,
+            'product_detail_queue': self.product_detail_queue,
+            # Parked 404'd detail requests, their own requests are already completed
+            'build_id_retry_queue': [request.to_dict(spider=self)
+                                     for request in self.build_id_retry_queue],
+            'shared_details': self.shared_details,
+            'shared_detail_waiters': self.shared_detail_waiters,
+            'listed_products': self.listed_products,
+            'listing_pages_pending': self.listing_pages_pending,
+            'held_items': self.held_items,
+            'listing_planned_ends': self.listing_planned_ends,
+            'page_size': self.page_size,
+            'category_sizes': self.category_sizes.updated,
+            'related_level': self.related_level,
+            'related_requested': self.related_requested,
+        }
+
+    def restore_checkpoint_state(self, state):
+        """Restore the spider state saved by checkpoint_state()"""
+        for attribute in ('start_datetime', 'build_id', 'build_id_available', 'build_id_refreshing',
+                          'build_id_probe_saved', 'product_detail_queue', 'shared_details',
+                          'shared_detail_waiters', 'listed_products', 'listing_pages_pending',
+                          'held_items', 'listing_planned_ends', 'page_size', 'related_level',
+                          'related_requested'):
+            setattr(self, attribute, state[attribute])
+        self.held_item_count = sum(len(items) for items in self.held_items.values())
+        self.build_id_retry_queue = [request_from_dict(record, spider=self)
+                                     for record in state['build_id_retry_queue']]
+        self.category_sizes.page_size = self.page_size
+        self.category_sizes.totals.update(state['category_sizes'])
+        self.category_sizes.updated.update(state['category_sizes'])
+
+    def make_homepage_request(self):
+        """Create the homepage request the buildId is extracted from"""
         url = 'https://www.wholefoodsmarket.com/'
-        yield scrapy.Request(
+        return scrapy.Request(
             url=url,
             callback=self.parse,
-            # Enable JavaScript rendering for NEXT_DATA with more options
+            # TieredProxyMiddleware only escalates to residential IPs and JS
+            # rendering when cheaper tiers are blocked
             meta={
-                'sops_render_js': True,
-                'sops_wait_for': 10,  # Wait 10 seconds for JS to load
+                'sops_wait_for': 10,  # Wait 10 seconds for JS to load when rendering
                 'sops_keep_headers': True,  # Keep browser headers
-                'sops_residential': True,  # Use residential IP
                 'sops_country': 'us',  # Use US IP address
             },
-            priority=100  # Highest priority as this is needed first
+            priority=100,  # Highest priority as this is needed first
+            dont_filter=True,
+            errback=self.handle_homepage_error
         )
 
+    def handle_homepage_error(self, failure):
+        if failure.check(RetryScheduled):
+            return
+        yield from self.handle_error(failure)
+        if self.build_id_refreshing:
+            # Couldn't refresh the buildId, give up on the requests waiting for it
+            yield from self.retry_build_id_requests(self.build_id)
+
+    def make_build_id_probe_request(self, cached):
+        """Create a request checking that a cached buildId is still served"""
+        build_id = cached['build_id']
+        if cached.get('probe_slug'):
+            url = (
+                f'https://www.wholefoodsmarket.com/_next/data/{build_id}'
+                f'/product/{cached["probe_slug"]}.json?store={cached["probe_store_id"]}'
+            )
+        else:
+            url = f'https://www.wholefoodsmarket.com/_next/data/{build_id}/index.json'
+        self.logger.info(f"Checking cached buildId {build_id}")
+        return scrapy.Request(
+            url=url,
+            callback=self.parse_build_id_probe,
+            meta={'build_id': build_id,
+                  'handle_httpstatus_list': [404],
+                  'sops_country': 'us'},
+            priority=100,
+            dont_filter=True,
+            errback=self.handle_build_id_probe_error
+        )
+
+    def parse_build_id_probe(self, response):
+        """Use the cached buildId if it is still live, otherwise fetch the homepage"""
+        if response.status == 404:
+            self.logger.info(
+                f"Cached buildId {response.meta['build_id']} is stale, fetching the homepage")
+            yield self.make_homepage_request()
+            return
+
+        self.logger.info(f"Cached buildId {response.meta['build_id']} is live")
+        # The probe slug is known to work, no need to save a new one
+        self.build_id_probe_saved = True
+        yield from self.set_build_id(response.meta['build_id'])
+
+    def handle_build_id_probe_error(self, failure):
+        if failure.check(RetryScheduled):
+            return
+        self.logger.warning(
+            f"buildId probe failed ({failure.value}), fetching the homepage")
+        yield self.make_homepage_request()
+
+    def set_build_id(self, build_id):
+        """Record the buildId and start (or resume) everything that was waiting for it"""
+        previous_build_id = self.build_id
+        self.build_id = build_id
+        self.build_id_available = True
+
+        # Process any queued requests now that buildId is available
+        yield from self.process_product_detail_queue()
+
+        if previous_build_id is not None:
+            # Mid-crawl refresh: only the requests that 404'd need re-issuing
+            yield from self.retry_build_id_requests(previous_build_id)
+            return
+
+        if self.replay:
+            yield from self.replay_dead_letters()
+            return
+
+        if self.frontier_backend is not None:
+            yield from self.lease_work_units()
+            return
+
+        # Begin processing for the first store_id and category
+        # Process all combinations of store_ids and categories
+        for store_id in self.store_ids:
+            yield self.make_store_summary_request(store_id)
+
     def parse(self, response):
-        """Extract buildId from __NEXT_DATA__ script tag using CSS selector."""
+        """Extract buildId from the raw homepage bytes."""
         self.logger.info(f"Response status: {response.status}")
-        next_data_text = response.css('script#__NEXT_DATA__::text').get()
-
-        # Look for __NEXT_DATA__ with alternate selectors
-        if not next_data_text:
-            scripts = response.css('script').getall()
-            # Try alternate selectors
-            self.logger.info("Trying alternate selectors for __NEXT_DATA__")
-            next_data_text = response.xpath(
-                '//script[@id="__NEXT_DATA__"]/text()').get()
-
-            # If still not found, try looking for any script containing buildId
-            if not next_data_text:
-                self.logger.warning(
-                    "Could not find __NEXT_DATA__ with standard selectors")
-                for script in scripts:
-                    if "buildId" in script:
-                        self.logger.info("Found script with buildId")
-                        # Extract JSON from the script
-                        try:
-                            import re
-                            json_text = re.search(r'({.*})', script).group(1)
-                            next_data_text = json_text
-                            break
-                        except:
-                            self.logger.error(
-                                "Failed to extract JSON from script with buildId")
-
-        if next_data_text:
-            try:
-                next_data = json.loads(next_data_text)
-                self.build_id = next_data.get('buildId')
-                self.build_id_available = True
-                self.logger.info(f"Extracted buildId: {self.build_id}")
-
-                # Process any queued requests now that buildId is available
-                self.process_product_detail_queue()
-
-                # Begin processing for the first store_id and category
-                # Process all combinations of store_ids and categories
-                for store_id in self.store_ids:
-                    self.current_store_id = store_id
-                    store_summary_url = f'https://www.wholefoodsmarket.com/stores/{store_id}/summary'
-                    self.logger.info(
-                        f"Requesting store summary from: {store_summary_url}")
-                    yield scrapy.Request(
-                        url=store_summary_url,
-                        callback=self.parse_store_summary,
-                        meta={
-                            'dont_filter': True,  # Skip URL filtering
-                            'sops_skip_headers': True,  # Skip headers modification by middleware
-                            'sops_country': 'us',  # Use US IP address
-                        },
-                        headers={
-                            'Accept': 'application/json',
-                            'X-Requested-With': 'XMLHttpRequest',
-                            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
-                            'Referer': 'https://www.wholefoodsmarket.com/stores/store-locator'
-                        },
-                        errback=self.handle_error
-                    )
-            except json.JSONDecodeError as e:
-                self.logger.error(
-                    f"Failed to parse __NEXT_DATA__ as JSON: {str(e)}")
+        build_id = extract_build_id(response.body)
+
+        if build_id:
+            self.logger.info(f"Extracted buildId: {build_id}")
+            self.build_id_cache.save(build_id)
+            self.build_id_probe_saved = False
+            yield from self.set_build_id(build_id)
         else:
-            self.logger.error('__NEXT_DATA__ script tag not found')
-            # Write response to file for debugging
-            with open('wholefoods_response.html', 'wb') as f:
-                f.write(response.body)
-            self.logger.info(
-                "Saved response to wholefoods_response.html for debugging")
+            self.logger.error('buildId not found in homepage')
+            self.dead_letter_request(
+                response.request, 'buildId not found in homepage', response)
+
+            if self.build_id_refreshing:
+                # Couldn't refresh the buildId, give up on the requests waiting for it
+                yield from self.retry_build_id_requests(self.build_id)
+
+    def make_store_summary_request(self, store_id, categories=None):
+        """Create a store summary request for one store, followed by its categories' listings"""
+        store_summary_url = f'https://www.wholefoodsmarket.com/stores/{store_id}/summary'
+        self.logger.info(
+            f"Requesting store summary from: {store_summary_url}")
+        if categories is None:
+            # Frontier workers get categories as separate units instead, and
+            # store discovery doesn't list products
+            categories = [] if self.frontier_backend is not None or self.mode == 'stores' else self.categories
+        meta = {
+            'crawl_context': CrawlContext(store_id=store_id),
+            'categories': categories,
+            'dont_filter': True,  # Skip URL filtering
+            'sops_skip_headers': True,  # Skip headers modification by middleware
+            'sops_country': 'us',  # Use US IP address
+        }
+        if self.mode == 'stores':
+            # Most probed ids aren't stores
+            meta['handle_httpstatus_list'] = [404]
+        return scrapy.Request(
+            url=store_summary_url,
+            callback=self.parse_store_summary,
+            meta=meta,
+            headers={
+                'Accept': 'application/json',
+                'X-Requested-With': 'XMLHttpRequest',
+                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
+                'Referer': 'https://www.wholefoodsmarket.com/stores/store-locator'
+            },
+            errback=self.handle_error
+        )
+
+    def lease_work_units(self):
+        """Lease the next batch of units from the frontier and yield their first requests"""
+        remaining = self.frontier_units_per_worker - len(self.leased_units)
+        if remaining <= 0:
+            return
+
+        units = self.frontier_backend.lease(
+            self.worker_id, min(self.frontier_lease_batch, remaining), self.frontier_lease_timeout)
+        for unit_id, unit in units:
+            self.logger.info(f"Leased frontier unit {unit_id}: {unit}")
+            self.leased_units.append(unit_id)
+            if unit.category is None:
+                yield self.make_store_summary_request(unit.store_id)
+            else:
+                yield from self.start_category_listings(unit.store_id, unit.category)
+
+    def heartbeat_work_units(self):
+        """Keep the leases on this worker's units alive until its feeds are stored"""
+        self.frontier_backend.heartbeat(
+            self.worker_id, self.leased_units, self.frontier_lease_timeout)
+
+    def spider_idle(self, spider):
+        """Lease more frontier units once everything already leased has been crawled"""
+        if self.mode == 'full' and not self.build_id_available:
+            return
+
+        requests = list(self.lease_work_units())
+        if not requests:
+            return
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        raise DontCloseSpider
+
+    def feed_exporter_closed(self):
+        """Mark leased units done now that their items are safely in the worker feeds"""
+        self.frontier_heartbeat.stop()
+        self.frontier_backend.complete(self.worker_id, self.leased_units)
+        self.frontier_backend.close()
+        self.logger.info(
+            f"Completed {len(self.leased_units)} frontier units")
 
     def handle_error(self, failure):
-        """Handle request errors"""
-        self.logger.error(f"Request failed: {failure.value}")
-        self.logger.error(f"URL that failed: {failure.request.url}")
+        """Record requests that failed for good (out of retries or budget) as dead letters"""
+        if failure.check(RetryScheduled):
+            # Not failed yet, RetryPolicyMiddleware re-issues it after a backoff
+            return
+        # HttpError carries the failing response
+        response = getattr(failure.value, 'response', None)
+        self.dead_letter_request(failure.request, failure.value, response)
+        if endpoint_for_request(failure.request) == 'listing':
+            context = failure.request.meta['crawl_context']
+            if self.listing_page_done(context):
+                yield from self.release_held_items(context.store_id)
+
+    def dead_letter_request(self, request, reason, response=None):
+        """Record a failed request, once per store listing waiting on it for shared details"""
+        if request.meta.get('shared'):
+            # Listings waiting on a failed shared detail request can't be completed
+            slug = request.meta['crawl_context'].slug
+            waiters = self.shared_detail_waiters.pop(slug, [])
+            self.logger.error(
+                f"Dropping {len(waiters)} store listings waiting on shared details for {slug}")
+            for partial, fingerprint in waiters:
+                self.record_dead_letter(request, reason, response, partial, fingerprint)
+            return
+        self.record_dead_letter(request, reason, response)
+
+    def record_dead_letter(self, request, reason, response=None, partial=None, fingerprint=None):
+        """Append a failed request to this run's dead letters with what is needed to replay it"""
+        kind = endpoint_for_request(request)
+        url = request.meta.get('proxy_original_url', request.url)
+        context = request.meta.get('crawl_context')
+        partial = partial or request.meta.get('partial_product')
+        record = {
+            'kind': kind,
+            'url': url,
+            'reason': str(reason),
+            'status': response.status if response is not None else None,
+            'retry_times': request.meta.get('retry_times', 0),
+            'mode': self.mode,
+            'crawl_context': asdict(context) if context is not None else None,
+            'partial_product': partial.as_dict() if partial is not None else None,
+            'fingerprint': fingerprint or request.meta.get('fingerprint'),
+            'categories': request.meta.get('categories'),
+        }
+        if kind == 'listing' and context is not None:
+            # How far the category was planned, so a replayed page doesn't re-plan the rest
+            record['listing_total'] = self.category_sizes.get(context.store_id, context.category)
+        body_sample = self.dead_letters.add(
+            record, response.body if response is not None else None)
+        self.crawler.stats.inc_value(f'wholefoods/dead_letters/{kind}')
+        self.logger.error(
+            f"Request failed ({reason}), dead-lettered {kind} request: {url}"
+            + (f" (body sample {body_sample})" if body_sample else ""))
+
+    def replay_dead_letters(self):
+        """Re-issue the requests recorded in the replay dead letter files, once each"""
+        seen = set()
+        for record in DeadLetterStore.load(self.replay):
+            if record['mode'] != self.mode:
+                continue
+            partial = record.get('partial_product') or {}
+            key = (record['kind'], record['url'], partial.get('store_id'))
+            if key in seen:
+                continue
+            seen.add(key)
+            self.crawler.stats.inc_value(f"wholefoods/replay/{record['kind']}")
+            yield from self.make_replay_requests(record)
+        self.logger.info(f"Replaying {len(seen)} dead letters from {', '.join(self.replay)}")
+
+    def make_replay_requests(self, record):
+        """Rebuild the request behind a dead letter from its crawl context"""
+        kind = record['kind']
+        context = record.get('crawl_context')
+        context = CrawlContext(**context) if context else None
+        if kind == 'store_summary':
+            yield self.make_store_summary_request(context.store_id, record.get('categories'))
+        elif kind == 'listing':
+            key = (context.store_id, context.category)
+            self.listing_planned_ends[key] = max(
+                self.listing_planned_ends.get(key, 0), record.get('listing_total') or 0,
+                context.offset + context.limit)
+            yield self.make_product_listings_request(
+                context.store_id, context.category, context.offset, context.limit)
+        elif kind == 'detail' and record.get('partial_product'):
+            partial = PartialProduct(**record['partial_product'])
+            if not self.listed_products.add(partial.store_id, partial.slug, partial.category):
+                # Also in a replayed listing page
+                return
+            if self.share_details:
+                yield from self.share_product_details(partial, record.get('fingerprint'))
+            else:
+                yield self.make_product_detail_request(
+                    partial.slug, partial.store_id, partial, partial.category, record.get('fingerprint'))
+        elif kind != 'homepage':
+            # The homepage is fetched again anyway when a full run needs the buildId
+            self.logger.warning(f"Can't replay {kind} dead letter: {record['url']}")
 
     def parse_store_summary(self, response):
         """Parse store summary JSON and yield StoreItem, then request product listings."""
         self.logger.info(f"Received store summary response: {response.status}")
-        store_id = self.current_store_id
+        context = response.meta['crawl_context']
+        store_id = context.store_id
+
+        if response.status == 404:
+            # Store discovery probing an id that isn't a store
+            self.stores_not_found.add(store_id)
+            self.crawler.stats.inc_value('wholefoods/store_discovery/not_found')
+            return
 
         try:
             data = response.json()
@@ -229,110 +831,255 @@ class WholeFoodsSpider(scrapy.Spider):
             yield store_item
 
             # Request product listings for each category for this store
-            for category in self.categories:
-                self.current_category = category
-                leaf_category_url = f"https://www.wholefoodsmarket.com/api/products/category/{category}?leafCategory={category}&store={store_id}&limit={self.limit}&offset=0"
-                self.logger.info(
-                    f"Requesting product listings from: {leaf_category_url}")
-                yield scrapy.Request(
-                    url=leaf_category_url,
-                    callback=self.parse_product_listings,
-                    meta={'offset': 0, 'store_id': store_id,
-                          'category': category,
-                          'sops_country': 'us'},
-                    priority=50,  # High priority for category listings
-                    errback=self.handle_error
-                )
+            for category in response.meta['categories']:
+                yield from self.start_category_listings(store_id, category)
         except json.JSONDecodeError as e:
             self.logger.error(f"Failed to parse store summary JSON: {str(e)}")
             self.logger.error(
                 f"Response text (first 200 chars): {response.text[:200]}")
-            with open('store_summary_error.html', 'wb') as f:
-                f.write(response.body)
-            self.logger.info(
-                "Saved failed response to store_summary_error.html")
+            self.dead_letter_request(
+                response.request, f"Invalid store summary JSON: {e}", response)
 
     def parse_product_listings(self, response):
         """Parse product listings JSON, request details for each product, and handle pagination."""
         self.logger.info(
             f"Received product listings response: {response.status}")
+        context = response.meta['crawl_context']
+        category_done = self.listing_page_done(context)
+        if response.status in (400, 422):
+            yield from self.handle_rejected_page_size(response)
+            return
 
         try:
-            data = response.json()
+            data = self.decode_json(response, 'decode_listing_page')
             products = data.get('results', [])
-            offset = response.meta['offset']
-            store_id = response.meta['store_id']
-            category = response.meta['category']
+            offset = context.offset
+            store_id = context.store_id
+            category = context.category
 
             self.logger.info(
                 f"Found {len(products)} products at offset {offset} for store {store_id}, category {category}")
 
-            # When offset=0, yield all pagination requests based on total
-            if offset == 0:
-                category_refinements = data.get('facets', [{}])[
-                    0].get('refinements', [])
-                total_products = [cr for cr in category_refinements if cr.get(
-                    'slug') == category]
-
-                if total_products:
-                    total_count = total_products[0].get('count', 0)
+            # Reconcile the pages requested so far against the fresh count
+            total_count = category_total(data, category)
+            if total_count is not None:
+                if offset == 0:
                     self.logger.info(
                         f"Total products in category '{category}' for store {store_id}: {total_count}")
-                    num_pages = (total_count + self.limit - 1) // self.limit
-
-                    for page in range(1, num_pages):
-                        next_offset = page * self.limit
-                        next_url = f"https://www.wholefoodsmarket.com/api/products/category/{category}?leafCategory={category}&store={store_id}&limit={self.limit}&offset={next_offset}"
-                        yield scrapy.Request(
-                            url=next_url,
-                            callback=self.parse_product_listings,
-                            meta={'offset': next_offset,
-                                  'store_id': store_id,
-                                  'category': category,
-                                  'sops_country': 'us'},
-                            priority=40,  # Medium priority for pagination
-                            errback=self.handle_error
-                        )
-                else:
-                    self.logger.warning(
-                        f"Could not find category refinement for '{category}'")
+                    self.category_sizes.set(store_id, category, total_count)
+                yield from self.reconcile_listing_pages(context, len(products), total_count)
+            elif offset == 0:
+                self.logger.warning(
+                    f"Could not find category refinement for '{category}'")
+
+            if not products:
+                # Past the end of a category that shrank since its size was remembered
+                self.crawler.stats.inc_value('wholefoods/listings/empty_pages')
+                if category_done:
+                    yield from self.release_held_items(store_id)
+                return
 
             # Process current products
             for i, product in enumerate(products):
-                product_loader = ItemLoader(
-                    item=ProductItem(), response=response)
-                product_loader.add_value('name', product.get('name'))
-                product_loader.add_value('price', product.get('regularPrice'))
-                product_loader.add_value('slug', product.get('slug'))
-                product_loader.add_value('brand', product.get('brand'))
-                product_loader.add_value('store_id', store_id)
-                # Add the current category from the URL - will be overridden if more
-                # specific category info is found in product details
-                product_loader.add_value('category', category)
-
-                if not self.build_id_available:
+                # A product listed in several categories only needs one detail row per store,
+                # its item gets every category once the store's listings are in
+                if not self.listed_products.add(store_id, product.get('slug'), category):
+                    self.crawler.stats.inc_value('wholefoods/listings/repeated_products')
+                    continue
+
+                if self.mode == 'prices':
+                    yield from self.emit_listed_item(self.make_price_item(product, store_id, category))
+                    continue
+
+                # Only the listing fields are kept until the details arrive; store-specific
+                # fields come from the listing when details are shared
+                partial = PartialProduct.from_listing(
+                    product, store_id, category, store_fields=self.share_details)
+
+                fingerprint = None
+                if self.detail_cache is not None:
+                    fingerprint = self.detail_cache.fingerprint(product)
+                    # Shared-details runs take rank and availability from the listing
+                    cached = self.detail_cache.get(
+                        store_id, product.get('slug'), fingerprint,
+                        need_store_fields=not self.share_details)
+                    if cached is not None:
+                        if cached.details is None:
+                            # Product was dropped last time and its listing hasn't changed
+                            self.crawler.stats.inc_value(
+                                'wholefoods/detail_cache/negative_hit')
+                        else:
+                            self.crawler.stats.inc_value(
+                                'wholefoods/detail_cache/hit')
+                            yield from self.emit_product_item(
+                                partial, {**cached.details, **cached.store_fields})
+                        continue
+                    self.crawler.stats.inc_value('wholefoods/detail_cache/miss')
+
+                if self.share_details:
+                    yield from self.share_product_details(partial, fingerprint)
+                elif not self.build_id_available:
                     # Queue this request for later when buildId is available
                     self.logger.info(
                         f"Queuing product detail request for {product.get('name')}, buildId not yet available")
                     self.product_detail_queue.append({
                         'url_slug': product.get('slug'),
                         'store_id': store_id,
-                        'product_loader': product_loader,
-                        'category': category  # Store category in queue
+                        'partial_product': partial,
+                        'category': category,  # Store category in queue
+                        'fingerprint': fingerprint
                     })
                 else:
                     # buildId is available, make the request now
-                    yield self.make_product_detail_request(product.get('slug'), store_id, product_loader, category)
+                    yield self.make_product_detail_request(
+                        product.get('slug'), store_id, partial, category, fingerprint)
         except json.JSONDecodeError as e:
             self.logger.error(
                 f"Failed to parse product listings JSON: {str(e)}")
-            with open('product_listings_error.html', 'wb') as f:
-                f.write(response.body)
-            self.logger.info(
-                "Saved failed response to product_listings_error.html")
+            self.dead_letter_request(
+                response.request, f"Invalid product listings JSON: {e}", response)
+        if category_done:
+            yield from self.release_held_items(context.store_id)
+
+    def decode_json(self, response, fast_decoder):
+        """Decode a JSON response, into typed records when the fast path is enabled.
+
+        Bodies that don't match the typed schema are decoded again with the
+        stdlib json module, so both paths produce the same items.
+        """
+        if self.fast_decode:
+            try:
+                return getattr(decoding, fast_decoder)(response.body)
+            except decoding.DecodeError:
+                self.crawler.stats.inc_value('wholefoods/fast_decode/fallback')
+        return response.json()
+
+    def start_category_listings(self, store_id, category):
+        """Request every page of a category at once if its size is remembered, otherwise its first page"""
+        total_count = self.category_sizes.get(store_id, category)
+        if total_count:
+            pages = plan_pages(0, total_count, self.page_size)
+            self.crawler.stats.inc_value(
+                'wholefoods/listings/speculative_pages', len(pages) - 1)
+        else:
+            pages = [(0, self.page_size)]
+        yield from self.make_product_listings_requests(store_id, category, pages)
+
+    def make_product_listings_requests(self, store_id, category, pages):
+        """Create listing requests for (offset, limit) pages and record how far the category is covered"""
+        key = (store_id, category)
+        for offset, limit in pages:
+            self.listing_planned_ends[key] = max(
+                self.listing_planned_ends.get(key, 0), offset + limit)
+            yield self.make_product_listings_request(store_id, category, offset, limit)
+
+    def reconcile_listing_pages(self, context, served, total_count):
+        """Request listing pages that are missing given a page's size and the category's fresh count"""
+        store_id, category, offset = context.store_id, context.category, context.offset
+        end = min(offset + context.limit, total_count)
+        if 0 < served and offset + served < end:
+            # A short page before the end of the category: the API caps the page size
+            if context.limit > self.limit and served < self.page_size:
+                self.logger.info(f"Listing page size capped at {served}")
+                self.page_size = self.category_sizes.page_size = served
+            yield from self.make_product_listings_requests(
+                store_id, category, plan_pages(offset + served, end, served))
+
+        planned_end = self.listing_planned_ends.get((store_id, category), 0)
+        if total_count > planned_end:
+            # The category grew, or this is its first page
+            yield from self.make_product_listings_requests(
+                store_id, category, plan_pages(planned_end, total_count, self.page_size))
+
+    def handle_rejected_page_size(self, response):
+        """Fall back to the default page size after the API rejected a larger one"""
+        context = response.meta['crawl_context']
+        self.logger.warning(
+            f"Listing page size {context.limit} rejected ({response.status}), using {self.limit}")
+        self.page_size = self.category_sizes.page_size = self.limit
+        yield from self.make_product_listings_requests(
+            context.store_id, context.category,
+            plan_pages(context.offset, context.offset + context.limit, self.limit))
+
+    def make_product_listings_request(self, store_id, category, offset=0, limit=None):
+        """Create a category listing request for one page of products"""
+        limit = limit or self.page_size
+        url = (
+            f'https://www.wholefoodsmarket.com/api/products/category/{category}'
+            f'?leafCategory={category}&store={store_id}&limit={limit}&offset={offset}'
+        )
+        self.logger.info(f"Requesting product listings from: {url}")
+        meta = {'crawl_context': CrawlContext(store_id=store_id, category=category,
+                                              offset=offset, limit=limit),
+                'sops_country': 'us'}
+        if limit > self.limit:
+            # The API may not allow pages larger than the default
+            meta['handle_httpstatus_list'] = [400, 422]
+        pending = self.listing_pages_pending.setdefault(store_id, {})
+        pending[category] = pending.get(category, 0) + 1
+        return scrapy.Request(
+            url=url,
+            callback=self.parse_product_listings,
+            meta=meta,
+            # High priority for the first page of a category, medium for pagination
+            priority=50 if offset == 0 else 40,
+            # Pages are planned without overlap, and every one has to be answered
+            # for its store's items to be released
+            dont_filter=True,
+            errback=self.handle_error
+        )
+
+    def make_price_item(self, product, store_id, category):
+        """Create a lightweight PriceItem straight from a listing row"""
+        return PriceItem(
+            store_id=store_id,
+            slug=product.get('slug'),
+            name=product.get('name'),
+            price=product.get('regularPrice'),
+            is_available=product.get('isAvailable'),
+            category=category,
+            observed_at=self.start_datetime,
+        )
+
+    def share_product_details(self, partial, fingerprint=None):
+        """Join a listing with the shared details for its slug, requesting them only once per run."""
+        slug = partial.slug
+        store_id = partial.store_id
+        if slug in self.shared_details:
+            self.crawler.stats.inc_value('wholefoods/shared_details/reused')
+            details = self.shared_details[slug]
+            self.cache_product_details(store_id, slug, fingerprint, details)
+            if details is not None:
+                yield from self.emit_product_item(partial, details)
+            return
 
-    def make_product_detail_request(self, slug, store_id, product_loader, category=None):
-        """Create a product detail request with the given parameters"""
+        waiters = self.shared_detail_waiters.get(slug)
+        if waiters is not None:
+            # A detail request for this slug is already in flight
+            self.crawler.stats.inc_value('wholefoods/shared_details/reused')
+            waiters.append((partial, fingerprint))
+            return
+
+        self.shared_detail_waiters[slug] = [(partial, fingerprint)]
+        self.crawler.stats.inc_value('wholefoods/shared_details/requested')
+        if not self.build_id_available:
+            self.product_detail_queue.append({
+                'url_slug': slug,
+                'store_id': store_id,
+                'partial_product': None,
+                'category': partial.category
+            })
+        else:
+            yield self.make_product_detail_request(slug, store_id, None, partial.category)
+
+    def make_product_detail_request(self, slug, store_id, partial, category=None, fingerprint=None,
+                                    related_depth=None):
+        """Create a product detail request with the given parameters.
+
+        A request without a PartialProduct fetches shared details for every
+        store waiting on the slug, unless it is for a product found through
+        related products at related_depth.
+        """
         product_detail_url = (
             f'https://www.wholefoodsmarket.com/_next/data/{self.build_id}'
             f'/product/{slug}.json?store={store_id}'
@@ -340,14 +1087,24 @@ class WholeFoodsSpider(scrapy.Spider):
         return scrapy.Request(
             url=product_detail_url,
             callback=self.parse_product_details,
-            meta={'product_loader': product_loader,
-                  'sops_country': 'us', 'category': category},
+            meta={'crawl_context': CrawlContext(store_id=store_id, category=category, slug=slug),
+                  'build_id': self.build_id,
+                  # A 404 may mean the buildId rotated mid-crawl
+                  'handle_httpstatus_list': [404],
+                  'partial_product': partial,
+                  'shared': partial is None and related_depth is None,
+                  'fingerprint': fingerprint,
+                  'related_depth': related_depth,
+                  'sops_country': 'us'},
             priority=30,  # Lower priority for individual product details
+            # Listings and related products are deduplicated by (store_id, slug) and
+            # shared details by slug, so the dupefilter needn't remember detail URLs
+            dont_filter=True,
             errback=self.handle_error
         )
 
     def process_product_detail_queue(self):
-        """Process any queued product detail requests now that buildId is available"""
+        """Yield any queued product detail requests now that buildId is available"""
         if not self.build_id_available:
             self.logger.warning(
                 "Attempted to process queue but buildId not available")
@@ -358,13 +1115,13 @@ class WholeFoodsSpider(scrapy.Spider):
             f"Processing {queue_count} queued product detail requests")
 
         for item in self.product_detail_queue:
-            request = self.make_product_detail_request(
+            yield self.make_product_detail_request(
                 item['url_slug'],
                 item['store_id'],
-                item['product_loader'],
-                item.get('category')  # Pass category from queue
+                item['partial_product'],
+                item.get('category'),  # Pass category from queue
+                item.get('fingerprint')
             )
-            self.crawler.engine.crawl(request, self)
 
         # Clear the queue after processing
         self.product_detail_queue = []
@@ -373,100 +1130,392 @@ class WholeFoodsSpider(scrapy.Spider):
 
     def parse_product_details(self, response):
         """Parse product details JSON and combine with listing data using ItemLoader."""
+        if response.status == 404:
+            yield from self.handle_build_id_not_found(response)
+            return
+
         try:
-            product_loader = response.meta['product_loader']
-            product_data = response.json()
-            # Get category from meta if available
-            url_category = response.meta.get('category')
+            product_data = self.decode_json(response, 'decode_product_page')
+            context = response.meta['crawl_context']
+
+            if not self.build_id_probe_saved:
+                # Remember a product that exists under this buildId to probe it next run
+                self.build_id_cache.save(
+                    response.meta['build_id'], context.slug, context.store_id)
+                self.build_id_probe_saved = True
+            # Get category from the listing the product came from
+            url_category = context.category
 
             if 'pageProps' not in product_data:
                 self.logger.warning(f"Missing 'pageProps' in product details")
-                return
+                details = None
+            else:
+                product_detail_data = product_data.get(
+                    'pageProps', {}).get('data', {})
+                details = self.extract_product_details(
+                    product_detail_data, url_category)
+
+            if response.meta.get('shared'):
+                yield from self.complete_shared_details(context.slug, details)
+            elif response.meta.get('related_depth'):
+                if details is not None:
+                    yield self.load_related_product(context, product_detail_data, details)
+            else:
+                self.cache_product_details(
+                    context.store_id, context.slug,
+                    response.meta['fingerprint'], details)
+                if details is not None:
+                    yield from self.emit_product_item(response.meta['partial_product'], details)
+        except json.JSONDecodeError as e:
+            self.logger.error(
+                f"Failed to parse product details JSON: {str(e)}")
+            self.dead_letter_request(
+                response.request, f"Invalid product details JSON: {e}", response)
+        except Exception as e:
+            self.logger.error(f"Error processing product details: {str(e)}")
 
-            product_detail_data = product_data.get(
-                'pageProps', {}).get('data', {})
+    def handle_build_id_not_found(self, response):
+        """Re-issue a 404'd detail request under a fresh buildId if it rotated mid-crawl"""
+        if response.meta.get('build_id_retried'):
+            self.logger.warning(f"Product details not found: {response.url}")
+            yield from self.drop_product_detail_request(response.request)
+            return
 
-            # Get nutrition elements before anything else
-            nutrition_elements = product_detail_data.get('nutritionElements')
+        if response.meta['build_id'] != self.build_id:
+            # The buildId was already refreshed after this request was made
+            yield self.remake_product_detail_request(response.request)
+            return
 
-            # Skip this product if it has no nutrition elements or if they'll all be filtered out
-            if not nutrition_elements:
-                self.logger.info(
-                    f"Skipping product with no nutrition elements: {product_detail_data.get('name')}")
-                return
+        if response.meta.get('related_depth') and not self.build_id_refreshing:
+            # Not every related product is sold in every store, so these 404s
+            # don't trigger a buildId check; they wait for one already running
+            self.crawler.stats.inc_value('wholefoods/related/not_found')
+            return
 
-            # Check if any nutrition elements have valid amount_per_serving values
-            has_valid_nutrition = False
-            for elem in nutrition_elements:
-                amount = elem.get('perServing')
-                if amount is not None and amount != 0 and amount != '' and amount != '0':
-                    has_valid_nutrition = True
-                    break
+        self.build_id_retry_queue.append(response.request)
+        if not self.build_id_refreshing:
+            self.logger.info(
+                f"Detail request 404'd under buildId {self.build_id}, checking for a new buildId")
+            self.build_id_refreshing = True
+            yield self.make_homepage_request()
+
+    def retry_build_id_requests(self, previous_build_id):
+        """Re-issue detail requests parked while the buildId was being refreshed"""
+        self.build_id_refreshing = False
+        retry_queue, self.build_id_retry_queue = self.build_id_retry_queue, []
+
+        if self.build_id == previous_build_id:
+            # Same buildId, so those products really are gone
+            self.logger.info(
+                f"buildId unchanged, dropping {len(retry_queue)} products that returned 404")
+            for request in retry_queue:
+                yield from self.drop_product_detail_request(request)
+            return
+
+        self.crawler.stats.inc_value('wholefoods/build_id/refreshed')
+        self.logger.info(
+            f"buildId rotated from {previous_build_id} to {self.build_id}, "
+            f"re-issuing {len(retry_queue)} detail requests")
+        for request in retry_queue:
+            yield self.remake_product_detail_request(request)
 
-            if not has_valid_nutrition:
+    def remake_product_detail_request(self, request):
+        """Re-create a detail request under the current buildId"""
+        self.crawler.stats.inc_value('wholefoods/build_id/retried_requests')
+        context = request.meta['crawl_context']
+        new_request = self.make_product_detail_request(
+            context.slug, context.store_id, request.meta['partial_product'],
+            context.category, request.meta['fingerprint'], request.meta.get('related_depth'))
+        new_request.meta['build_id_retried'] = True
+        return new_request
+
+    def drop_product_detail_request(self, request):
+        """Give up on a detail request, passing shared details on to the next store waiting on them"""
+        if request.meta.get('shared'):
+            yield from self.reassign_shared_details(request)
+
+    def reassign_shared_details(self, request):
+        """Drop the requested store's listing of a 404'd shared detail request and
+        request the slug again for the next store waiting on it.
+
+        A 404 only means the product isn't sold in the store it was requested
+        for, so nothing is stored in shared_details and only that store is
+        negative-cached.
+        """
+        context = request.meta['crawl_context']
+        waiters = []
+        for partial, fingerprint in self.shared_detail_waiters.pop(context.slug, []):
+            if partial.store_id == context.store_id:
+                self.cache_product_details(
+                    partial.store_id, context.slug, fingerprint, None)
+            else:
+                waiters.append((partial, fingerprint))
+        if not waiters:
+            return
+
+        self.shared_detail_waiters[context.slug] = waiters
+        self.crawler.stats.inc_value('wholefoods/shared_details/reassigned')
+        partial = waiters[0][0]
+        new_request = self.make_product_detail_request(
+            context.slug, partial.store_id, None, partial.category)
+        # The buildId was checked before this 404 was given up on, no need to check it again
+        new_request.meta['build_id_retried'] = True
+        yield new_request
+
+    def complete_shared_details(self, slug, details):
+        """Remember shared details for a slug and emit an item for every store waiting on it."""
+        if details is not None:
+            details = {field: value for field, value in details.items()
+                       if field not in self.store_specific_fields}
+        self.shared_details[slug] = details
+
+        for partial, fingerprint in self.shared_detail_waiters.pop(slug, []):
+            self.cache_product_details(
+                partial.store_id, slug, fingerprint, details)
+            if details is not None:
+                yield from self.emit_product_item(partial, details)
+
+    def cache_product_details(self, store_id, slug, fingerprint, details):
+        """Write details (or a negative result) to the persistent detail cache, if enabled."""
+        if self.detail_cache is None or fingerprint is None:
+            return
+
+        if details is None:
+            self.detail_cache.set(store_id, slug, fingerprint, None)
+            return
+
+        shared = {field: value for field, value in details.items()
+                  if field not in self.store_specific_fields}
+        store_fields = None
+        if not self.share_details:
+            # Shared details have none, the store's fields come from its listing
+            store_fields = {field: value for field, value in details.items()
+                            if field in self.store_specific_fields}
+        self.detail_cache.set(store_id, slug, fingerprint,
+                              shared, store_fields)
+
+    def extract_product_details(self, product_detail_data, url_category=None):
+        """Extract ProductItem values from product detail data.
+
+        Values are final item values, already run through the ProductItem
+        processors. Returns None when the product has no valid nutrition
+        elements and should be skipped.
+        """
+        if not isinstance(product_detail_data, dict):
+            # Typed record from the fast path, nutrition elements were filtered while decoding
+            details = decoding.product_detail_values(
+                product_detail_data, url_category)
+            if details is None:
                 self.logger.info(
                     f"Skipping product with no valid nutrition elements: {product_detail_data.get('name')}")
-                return
+            return details
 
-            product_loader.add_value('asin', product_detail_data.get('asin'))
-            product_loader.add_value(
-                'amazon_product_id', product_detail_data.get('id'))
-            product_loader.add_value('rank', product_detail_data.get('rank'))
-            product_loader.add_value(
-                'is_available', product_detail_data.get('isAvailable'))
-
-            categories = product_detail_data.get('categories', {})
-
-            # Only set category from product details if it exists, otherwise keep the one from URL
-            product_category = categories.get('name')
-            if product_category:
-                product_loader.add_value('category', product_category)
-            elif url_category:
-                # Use URL category if no category in product details
-                product_loader.add_value('category', url_category)
-
-            # Extract child categories as before
-            product_loader.add_value('category_2', categories.get(
-                'childCategory', {}).get('name'))
-
-            # Try to extract category_3 if it exists (from child of childCategory)
-            child_category = categories.get('childCategory', {})
-            if child_category and isinstance(child_category, dict) and 'childCategory' in child_category:
-                product_loader.add_value('category_3', child_category.get(
-                    'childCategory', {}).get('name'))
-
-            product_loader.add_value('diets', product_detail_data.get('diets'))
-            product_loader.add_value(
-                'ingredients', product_detail_data.get('ingredients'))
-            product_loader.add_value(
-                'allergens', product_detail_data.get('allergens'))
-            product_loader.add_value(
-                'additives', product_detail_data.get('additives'))
-            product_loader.add_value(
-                'certifications', product_detail_data.get('certifications'))
-            product_loader.add_value(
-                'nutrition_group', product_detail_data.get('nutritionGroup'))
-            product_loader.add_value(
-                'nutrition_label_format', product_detail_data.get('nutritionLabelFormat'))
-            product_loader.add_value(
-                'nutrition_elements', nutrition_elements)
-            product_loader.add_value(
-                'serving_info', product_detail_data.get('servingInfo'))
-            product_loader.add_value(
-                'is_alcoholic', product_detail_data.get('isAlcoholic'))
-            product_loader.add_value(
-                'unit_of_measure', product_detail_data.get('uom'))
-
-            images = product_detail_data.get('images', [{}])
-            if images:
-                product_loader.add_value('image', images[0].get('image'))
-
-            product_loader.add_value(
-                'related_products', product_detail_data.get('related'))
-
-            yield product_loader.load_item()
-        except json.JSONDecodeError as e:
-            self.logger.error(
-                f"Failed to parse product details JSON: {str(e)}")
-        except Exception as e:
-            self.logger.error(f"Error processing product details: {str(e)}")
+        # Get nutrition elements before anything else
+        nutrition_elements = product_detail_data.get('nutritionElements')
+
+        # Skip this product if it has no nutrition elements or if they'll all be filtered out
+        if not nutrition_elements:
+            self.logger.info(
+                f"Skipping product with no nutrition elements: {product_detail_data.get('name')}")
+            return None
+
+        # Check if any nutrition elements have valid amount_per_serving values
+        has_valid_nutrition = False
+        for elem in nutrition_elements:
+            amount = elem.get('perServing')
+            if amount is not None and amount != 0 and amount != '' and amount != '0':
+                has_valid_nutrition = True
+                break
+
+        if not has_valid_nutrition:
+            self.logger.info(
+                f"Skipping product with no valid nutrition elements: {product_detail_data.get('name')}")
+            return None
+
+        details = {
+            'asin': product_detail_data.get('asin'),
+            'amazon_product_id': product_detail_data.get('id'),
+            'rank': product_detail_data.get('rank'),
+            'is_available': product_detail_data.get('isAvailable'),
+        }
+
+        categories = product_detail_data.get('categories', {})
+
+        # Only set category from product details if it exists, otherwise keep the one from URL
+        product_category = categories.get('name')
+        if product_category:
+            details['category'] = product_category
+        elif url_category:
+            # Use URL category if no category in product details
+            details['category'] = url_category
+
+        # Extract child categories as before
+        details['category_2'] = categories.get(
+            'childCategory', {}).get('name')
+
+        # Try to extract category_3 if it exists (from child of childCategory)
+        child_category = categories.get('childCategory', {})
+        if child_category and isinstance(child_category, dict) and 'childCategory' in child_category:
+            details['category_3'] = child_category.get(
+                'childCategory', {}).get('name')
+
+        details['diets'] = product_detail_data.get('diets')
+        details['ingredients'] = product_detail_data.get('ingredients')
+        details['allergens'] = product_detail_data.get('allergens')
+        details['additives'] = product_detail_data.get('additives')
+        details['certifications'] = product_detail_data.get('certifications')
+        details['nutrition_group'] = product_detail_data.get('nutritionGroup')
+        details['nutrition_label_format'] = product_detail_data.get(
+            'nutritionLabelFormat')
+        details['nutrition_elements'] = nutrition_elements
+        details['serving_info'] = product_detail_data.get('servingInfo')
+        details['is_alcoholic'] = product_detail_data.get('isAlcoholic')
+        details['unit_of_measure'] = product_detail_data.get('uom')
+
+        images = product_detail_data.get('images', [{}])
+        if images:
+            details['image'] = images[0].get('image')
+
+        details['related_products'] = product_detail_data.get('related')
+
+        product_loader = ItemLoader(item=ProductItem())
+        for field, value in details.items():
+            product_loader.add_value(field, value)
+        return dict(product_loader.load_item())
+
+    def load_product_item(self, partial, details):
+        """Combine listing fields and extracted detail values into a ProductItem."""
+        # Listing values go first: the listing category wins over the detail one.
+        # A listing value that is present but empty keeps its place in the item,
+        # as it would in an ItemLoader, and is filled from the details
+        values = {}
+        for field in PartialProduct.__slots__:
+            value = getattr(partial, field)
+            if arg_to_iter(value):
+                values[field] = take_first(value)
+        for field, value in details.items():
+            if values.get(field) is None:
+                values[field] = value
+        if self.seen_products is not None:
+            self.add_related_products(partial.store_id, details.get('related_products'))
+        return ProductItem({field: value for field, value in values.items() if value is not None})
+
+    def emit_product_item(self, partial, details):
+        """Yield the ProductItem of a listed product once its store's listings are all in."""
+        yield from self.emit_listed_item(self.load_product_item(partial, details))
+
+    def emit_listed_item(self, item):
+        """Yield the item of a listed product, or hold it while its store may still list it elsewhere.
+
+        Past LISTING_HOLD_MAX_ITEMS held items, the store's held items are
+        released with the categories listed so far.
+        """
+        if not self.awaits_listings(item):
+            yield self.add_listed_categories(item)
+            return
+        store_id = item.get('store_id')
+        held = self.held_items.setdefault(store_id, [])
+        held.append(item)
+        self.held_item_count += 1
+        self.crawler.stats.inc_value('wholefoods/listings/held_items')
+        if self.listing_hold_max_items is not None and self.held_item_count > self.listing_hold_max_items:
+            self.crawler.stats.inc_value('wholefoods/listings/released_early', len(held))
+            yield from self.release_held_items(store_id, force=True)
+
+    def awaits_listings(self, item):
+        """Whether the item's store has listing pages pending in categories the product wasn't listed in yet."""
+        pending = self.listing_pages_pending.get(item.get('store_id'))
+        if not pending:
+            return False
+        listed = self.listed_products.categories(item.get('store_id'), item.get('slug'))
+        return any(category not in listed for category in pending)
+
+    def listing_page_done(self, context):
+        """Count an answered (or failed) listing page, returning whether its category has none left pending."""
+        pending = self.listing_pages_pending.get(context.store_id, {})
+        count = pending.get(context.category, 0) - 1
+        if count > 0:
+            pending[context.category] = count
+            return False
+        pending.pop(context.category, None)
+        if not pending:
+            self.listing_pages_pending.pop(context.store_id, None)
+        return True
+
+    def release_held_items(self, store_id, force=False):
+        """Yield the held items of a store that no pending listing can add a category to, or all of them."""
+        held = self.held_items.pop(store_id, [])
+        released = []
+        for item in held:
+            if force or not self.awaits_listings(item):
+                released.append(item)
+            else:
+                self.held_items.setdefault(store_id, []).append(item)
+        self.held_item_count -= len(released)
+        for item in released:
+            yield self.add_listed_categories(item)
+
+    def add_listed_categories(self, item):
+        """Set every category the item's product was listed under, and the first of them as its category.
+
+        Categories are in the order of the crawl's categories, so the one a
+        product listed in several keeps doesn't depend on response timing.
+        """
+        categories = self.listed_products.categories(item.get('store_id'), item.get('slug'))
+        if categories:
+            item['category'] = categories[0]
+            item['listed_categories'] = categories
+        return item
+
+    def add_related_products(self, store_id, slugs):
+        """Queue the related products of a crawled product for the next depth, unless already seen."""
+        if self.related_level >= self.related_depth or not slugs:
+            return
+        for slug in slugs:
+            if slug and (store_id, slug) not in self.listed_products:
+                if self.seen_products.add(store_id, slug, self.related_level + 1):
+                    self.crawler.stats.inc_value('wholefoods/related/queued')
+
+    def load_related_product(self, context, product_detail_data, details):
+        """Create the ProductItem of a product found through related products, from its details alone."""
+        partial = PartialProduct.from_detail(product_detail_data, context.slug, context.store_id)
+        item = self.load_product_item(partial, details)
+        self.crawler.stats.inc_value('wholefoods/related/found')
+        self.crawler.stats.inc_value(f"wholefoods/related/found_category/{item.get('category')}")
+        return item
+
+    def crawl_related_products(self, spider):
+        """Request the next depth of related products once everything before it has been crawled.
+
+        Waiting for the idle crawl makes sure the listings are complete, so
+        only products that no listing had are requested.
+        """
+        if not self.build_id_available or self.related_level >= self.related_depth:
+            return
+        remaining = self.related_budget - self.related_requested if self.related_budget else None
+        if remaining is not None and remaining <= 0:
+            return
+
+        depth = self.related_level + 1
+        self.seen_products.commit()
+        requests = []
+        for store_id, slug in self.seen_products.at_depth(depth):
+            if (store_id, slug) in self.listed_products:
+                # Listed after it was queued
+                continue
+            if remaining is not None and len(requests) >= remaining:
+                self.logger.warning(
+                    f"RELATED_DISCOVERY_BUDGET of {self.related_budget} requests reached at depth {depth}")
+                self.crawler.stats.set_value('wholefoods/related/budget_exhausted_depth', depth)
+                break
+            requests.append(self.make_product_detail_request(slug, store_id, None, related_depth=depth))
+        self.related_level = depth
+        if not requests:
+            return
+
+        self.related_requested += len(requests)
+        self.crawler.stats.inc_value('wholefoods/related/requested', len(requests))
+        self.logger.info(f"Requesting {len(requests)} related products at depth {depth}")
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        raise DontCloseSpider
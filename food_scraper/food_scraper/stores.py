@@ -0,0 +1,180 @@
+import math
+import sqlite3
+import time
+from collections import namedtuple
+
+Store = namedtuple('Store', ['store_id', 'status', 'date_opened', 'latitude', 'longitude', 'street',
+                             'city', 'state', 'zip_code', 'postal_code', 'updated_at'])
+
+# Status of stores whose summary 404'd during a discovery run
+NOT_FOUND_STATUS = 'Not found'
+# Groups `per:` selectors pick one store from
+REPRESENTATIVE_KEYS = {
+    'state': lambda store: store.state,
+    'zip3': lambda store: (store.zip_code or store.postal_code or '')[:3] or None,
+}
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance between two points, in km."""
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def is_open(store):
+    return (store.status or '').lower() == 'open'
+
+
+class StoreIndex:
+    """Every store seen by a crawl, with a grid index over their coordinates.
+
+    Stores are kept in SQLite, one row per store_id with its latest
+    StoreItem, and loaded whole into memory: a few thousand stores are a few
+    hundred KiB. Stores with coordinates are bucketed in a grid of
+    cell_degrees x cell_degrees cells, so a radius query only measures the
+    stores of the cells overlapping the circle's bounding box.
+    """
+
+    def __init__(self, path, cell_degrees=1.0):
+        self.path = path
+        self.cell_degrees = cell_degrees
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS stores ('
+            'store_id INTEGER PRIMARY KEY, status TEXT, date_opened TEXT, latitude REAL, longitude REAL, '
+            'street TEXT, city TEXT, state TEXT, zip_code TEXT, postal_code TEXT, updated_at REAL NOT NULL)')
+        self.connection.commit()
+        self.stores = {}
+        # (row, column) -> stores in that cell
+        self.cells = {}
+        for row in self.connection.execute(f'SELECT {", ".join(Store._fields)} FROM stores'):
+            self._index(Store(*row))
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('STORE_INDEX_PATH'),
+                   settings.getfloat('STORE_INDEX_CELL_DEGREES'))
+
+    def _cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees))
+
+    def _index(self, store):
+        previous = self.stores.get(store.store_id)
+        if previous is not None and previous.latitude is not None and previous.longitude is not None:
+            self.cells[self._cell(previous.latitude, previous.longitude)].remove(previous)
+        self.stores[store.store_id] = store
+        if store.latitude is not None and store.longitude is not None:
+            self.cells.setdefault(self._cell(store.latitude, store.longitude), []).append(store)
+
+    def add(self, values):
+        """Insert or update a store from StoreItem values."""
+        store = Store(**{field: values.get(field) for field in Store._fields[:-1]},
+                      updated_at=time.time())
+        store = store._replace(store_id=int(store.store_id))
+        for field in ('latitude', 'longitude'):
+            if getattr(store, field) is not None:
+                store = store._replace(**{field: float(getattr(store, field))})
+        self.connection.execute(
+            f'INSERT OR REPLACE INTO stores ({", ".join(Store._fields)}) '
+            f'VALUES ({", ".join("?" * len(Store._fields))})', store)
+        self._index(store)
+        return store
+
+    def mark_not_found(self, store_ids):
+        """Mark known stores whose summary isn't served anymore; unknown ids are ignored."""
+        marked = [store_id for store_id in store_ids if store_id in self.stores]
+        for store_id in marked:
+            self._index(self.stores[store_id]._replace(status=NOT_FOUND_STATUS, updated_at=time.time()))
+            self.connection.execute('UPDATE stores SET status = ?, updated_at = ? WHERE store_id = ?',
+                                    (NOT_FOUND_STATUS, time.time(), store_id))
+        return marked
+
+    def commit(self):
+        self.connection.commit()
+
+    def near(self, latitude, longitude, radius_km):
+        """(distance in km, store) of the stores within radius_km of a point, closest first."""
+        latitude_span = radius_km / KM_PER_DEGREE
+        # Degrees of longitude shrink towards the poles
+        longitude_span = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        first_row, first_column = self._cell(latitude - latitude_span, longitude - longitude_span)
+        last_row, last_column = self._cell(latitude + latitude_span, longitude + longitude_span)
+        found = []
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                for store in self.cells.get((row, column), ()):
+                    distance = haversine_km(latitude, longitude, store.latitude, store.longitude)
+                    if distance <= radius_km:
+                        found.append((distance, store))
+        found.sort(key=lambda pair: (pair[0], pair[1].store_id))
+        return found
+
+    @staticmethod
+    def representatives(stores, key):
+        """One store per group of stores: the one closest to its group's mean position."""
+        groups = {}
+        for store in stores:
+            group = REPRESENTATIVE_KEYS[key](store)
+            if group is not None:
+                groups.setdefault(group, []).append(store)
+        picked = []
+        for group in sorted(groups):
+            members = sorted(groups[group], key=lambda store: store.store_id)
+            located = [store for store in members if store.latitude is not None and store.longitude is not None]
+            if not located:
+                picked.append(members[0])
+                continue
+            latitude = sum(store.latitude for store in located) / len(located)
+            longitude = sum(store.longitude for store in located) / len(located)
+            picked.append(min(located, key=lambda store: haversine_km(
+                latitude, longitude, store.latitude, store.longitude)))
+        return picked
+
+    def select(self, selector):
+        """Store ids picked by a selector, in the order it ranks them.
+
+        A selector is one or more ';'-separated steps applied in turn to the
+        open stores: 'near:LAT,LON,KM' keeps those within KM km of a point
+        (closest first), 'state:MA,NH' those in some states, 'per:state' or
+        'per:zip3' one representative store per state or ZIP3 area, and
+        'all' includes stores that aren't open.
+        """
+        steps = [step.strip() for step in selector.split(';') if step.strip()]
+        if not steps:
+            raise ValueError("Empty store selector")
+        open_only = 'all' not in steps
+        stores = sorted((store for store in self.stores.values() if not open_only or is_open(store)),
+                        key=lambda store: store.store_id)
+        for step in steps:
+            name, _, argument = step.partition(':')
+            if name == 'all':
+                continue
+            if name == 'near':
+                try:
+                    latitude, longitude, radius_km = (float(value) for value in argument.split(','))
+                except ValueError:
+                    raise ValueError(f"Invalid store selector '{step}', expected near:LAT,LON,KM")
+                candidates = {store.store_id for store in stores}
+                stores = [store for _, store in self.near(latitude, longitude, radius_km)
+                          if store.store_id in candidates]
+            elif name == 'state':
+                states = {state.strip().upper() for state in argument.split(',') if state.strip()}
+                stores = [store for store in stores if (store.state or '').upper() in states]
+            elif name == 'per':
+                if argument not in REPRESENTATIVE_KEYS:
+                    raise ValueError(
+                        f"Invalid store selector '{step}', expected per:{' or per:'.join(REPRESENTATIVE_KEYS)}")
+                stores = self.representatives(stores, argument)
+            else:
+                raise ValueError(
+                    f"Unknown store selector '{step}', expected near:, state:, per: or all")
+        return [store.store_id for store in stores]
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()